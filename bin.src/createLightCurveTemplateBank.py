@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse
+
+# Pack the ASCII RR Lyrae, Cepheid, eclipsing binary and black hole
+# microlensing light curve templates from sims_sed_library into a single
+# binary bank that can be memory-mapped by the variability models.
+# Point the SIMS_LC_TEMPLATE_BANK environment variable at the output
+# (or set Variability._lc_template_bank_file) to use it.
+
+if __name__ == '__main__':
+
+    from lsst.sims.catUtils.mixins import write_light_curve_template_bank
+
+    parser = argparse.ArgumentParser(description="Build a binary bank of "
+                                     "light curve templates")
+    parser.add_argument("--out_file", type=str, required=True,
+                        help="the bank file to be written")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="the directory containing the templates "
+                        "(default: SIMS_SED_LIBRARY_DIR)")
+
+    args = parser.parse_args()
+
+    bank = write_light_curve_template_bank(args.out_file, data_dir=args.data_dir)
+    print('wrote %d light curve templates to %s' % (len(bank), args.out_file))
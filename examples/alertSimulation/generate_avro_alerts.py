@@ -14,9 +14,10 @@ import argparse
 
 def process_obshistid(obshistid_list, in_dir, sql_prefix_list,
                       obshistid_to_htmid, out_dir, out_prefix,
-                      schema_dir, dmag_cutoff, log_file_name, lock):
+                      schema_dir, dmag_cutoff, log_file_name, lock,
+                      backend='avro', codec='null'):
 
-    avro_gen = AvroAlertGenerator()
+    avro_gen = AvroAlertGenerator(backend=backend, codec=codec)
     avro_gen.load_schema(schema_dir)
 
     for obshistid in obshistid_list:
@@ -48,6 +49,12 @@ if __name__ == "__main__":
                         '(default=0.005)')
     parser.add_argument('--schema_dir', type=str, default=None,
                         help='Directory containing avro schemas')
+    parser.add_argument('--backend', type=str, default='avro',
+                        help='Package used to encode the avro files: '
+                        'avro or fastavro (default=avro)')
+    parser.add_argument('--codec', type=str, default='null',
+                        help='Block compression codec of the avro files '
+                        '(default=null)')
     parser.add_argument('--opsim_db', type=str,
                         default=os.path.join('/local', 'lsst', 'danielsf',
                                              'OpSimData', 'minion_1016_sqlite.db'),
@@ -126,7 +133,8 @@ if __name__ == "__main__":
                           obshistid_to_htmid, args.out_dir,
                           args.out_prefix,
                           args.schema_dir, args.dmag_cutoff,
-                          args.log_file, None)
+                          args.log_file, None,
+                          backend=args.backend, codec=args.codec)
     else:
         lock = mproc.Lock()
         p_list = []
@@ -137,7 +145,8 @@ if __name__ == "__main__":
                                     sql_prefix_list, obshistid_to_htmid,
                                     args.out_dir, args.out_prefix,
                                     args.schema_dir, args.dmag_cutoff,
-                                    args.log_file, lock))
+                                    args.log_file, lock,
+                                    args.backend, args.codec))
             p.start()
             p_list.append(p)
 
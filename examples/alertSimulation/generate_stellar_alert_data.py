@@ -9,17 +9,16 @@ from lsst.sims.catUtils.utils import StellarAlertDBObj
 from lsst.sims.catUtils.utils import AlertStellarVariabilityCatalog
 
 
-import multiprocessing as mproc
-
 import time
 import gc
 import argparse
 
 
-def query_htmid(alert_gen, htmid_list, out_dir, out_prefix,
-                log_file_name, lock,
-                write_every, chunk_size, dmag_cutoff):
-
+def star_db_factory():
+    """
+    Connect to the stellar database (each process
+    started by run_parallel makes its own connection)
+    """
     try:
         db = StellarAlertDBObj(database='LSSTCATSIM',
                                host='fatboy.phys.washington.edu',
@@ -27,27 +26,8 @@ def query_htmid(alert_gen, htmid_list, out_dir, out_prefix,
                                cache_connection=False)
     except RuntimeError:
         db = StellarAlertDBObj(cache_connection=False)
+    return db
 
-    for i_htmid, htmid in enumerate(htmid_list):
-        t_start = time.time()
-        print('passing in %s' % str(htmid))
-        n_rows = alert_gen.alert_data_from_htmid(htmid, db, chunk_size=chunk_size,
-                                                 write_every=write_every,
-                                                 output_dir=out_dir,
-                                                 output_prefix=out_prefix,
-                                                 dmag_cutoff=dmag_cutoff,
-                                                 photometry_class=AlertStellarVariabilityCatalog,
-                                                 lock=lock,
-                                                 log_file_name=log_file_name)
-
-        lock.acquire()
-        with open(log_file_name, 'a') as out_file:
-            elapsed = (time.time()-t_start)/3600.0
-            out_file.write('htmid %d nobs %d n_rows %d time %.2e hrs; per_row %.2e -- n_htmid %d of %d\n' %
-                           (htmid, alert_gen.n_obs(htmid), n_rows, elapsed,
-                            elapsed/n_rows, i_htmid, len(htmid_list)))
-
-        lock.release()
 
 if __name__ == "__main__":
 
@@ -80,6 +60,11 @@ if __name__ == "__main__":
                         default=os.path.join('/local', 'lsst', 'danielsf',
                                              'OpSimData', 'minion_1016_sqlite.db'),
                         help='Path to OpSim database used for survey cadence')
+    parser.add_argument('--split_cost', type=float, default=None,
+                        help='Split trixels whose cost (number of stars times '
+                        'number of observations) exceeds this into their HTM '
+                        'children; the stars in each child are counted in '
+                        'the database (default = never split)')
 
     args = parser.parse_args()
 
@@ -105,52 +90,37 @@ if __name__ == "__main__":
     alert_gen = AlertDataGenerator()
     alert_gen.subdivide_obs(obs_list, htmid_level=6)
 
+    # count the stars in each trixel so that the trixels can be
+    # ordered (and split) by cost
+    star_db = star_db_factory()
+    n_obj_dict = {}
     n_tot_obs=0
     for htmid in alert_gen.htmid_list:
         n_tot_obs += alert_gen.n_obs(htmid)
+        n_obj_dict[htmid] = star_db.count_htmid(htmid)
 
     with open(args.log_file, 'a') as out_file:
         for htmid in alert_gen.htmid_list:
-            out_file.write('htmid %d n_obs %d\n' % (htmid, alert_gen.n_obs(htmid)))
+            out_file.write('htmid %d n_obs %d n_obj %d\n' %
+                           (htmid, alert_gen.n_obs(htmid), n_obj_dict[htmid]))
         out_file.write('n_htmid %d n_obs(total) %d\n' % (len(alert_gen.htmid_list), n_tot_obs))
 
-    # subdivide the trixels into n_proc lists, trying to make sure
-    # each process has an equal number of observations to simulate
-    htmid_list = []
-    n_htmid_list = []
-    for i_p in range(args.n_proc):
-        htmid_list.append([])
-        n_htmid_list.append(0)
-
-    for htmid in alert_gen.htmid_list:
-        n_obs = alert_gen.n_obs(htmid)
-        n_min = -1
-        i_min = -1
-        for i_htmid, n_htmid in enumerate(n_htmid_list):
-            if i_min<0 or n_htmid<n_min:
-                n_min = n_htmid
-                i_min = i_htmid
-        htmid_list[i_min].append(htmid)
-        n_htmid_list[i_min] += n_obs
-
-    # start the independent processes
+    # hand the trixels out to n_proc processes, most expensive first,
+    # splitting any trixel whose cost exceeds split_cost
     t_start = time.time()
-    print('htmid_list %s' % str(htmid_list))
-    lock = mproc.Lock()
-    p_list = []
-    for i_p in range(len(htmid_list)):
-        p = mproc.Process(target=query_htmid,
-                          args = (alert_gen, htmid_list[i_p],
-                                  args.out_dir, args.out_prefix,
-                                  args.log_file, lock,
-                                  args.write_every,
-                                  args.chunk_size, args.dmag_cutoff))
-
-        p.start()
-        p_list.append(p)
-
-    for p in p_list:
-        p.join()
+    results = alert_gen.run_parallel(star_db_factory, args.n_proc, args.log_file,
+                                     n_obj_dict=n_obj_dict,
+                                     split_cost=args.split_cost,
+                                     photometry_class=AlertStellarVariabilityCatalog,
+                                     output_dir=args.out_dir,
+                                     output_prefix=args.out_prefix,
+                                     write_every=args.write_every,
+                                     chunk_size=args.chunk_size,
+                                     dmag_cutoff=args.dmag_cutoff)
+
+    failed = [htmid for htmid in results if results[htmid] is None]
+    if len(failed) > 0:
+        print('failed htmid %s' % str(failed))
 
     with open(args.log_file, 'a') as out_file:
         elapsed = (time.time()-t_start)/3600.0
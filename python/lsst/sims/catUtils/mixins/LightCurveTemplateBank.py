@@ -0,0 +1,171 @@
+"""
+This module defines a binary bank of the ASCII light curve templates
+used by the periodic (RR Lyrae, Cepheid, eclipsing binary) and black
+hole microlensing variability models.
+
+The bank is written once by write_light_curve_template_bank() (see
+also bin.src/createLightCurveTemplateBank.py).  It consists of two
+files
+
+    bank_name             -- every template, as float64, back to back
+    bank_name.index.json  -- a dict mapping the template's file name
+                             (relative to SIMS_SED_LIBRARY_DIR) to its
+                             offset and shape in bank_name
+
+LightCurveTemplateBank opens bank_name as a read-only numpy.memmap, so
+that every InstanceCatalog and every worker process reading templates
+from the same bank shares a single copy of the data in the page cache.
+"""
+
+from builtins import object
+import os
+import json
+import numpy as np
+
+__all__ = ["LightCurveTemplateBank", "write_light_curve_template_bank"]
+
+
+# the sub-directories of SIMS_SED_LIBRARY_DIR containing light curve templates
+_TEMPLATE_SUB_DIRS = ('rrly_lc', 'cepheid_lc', 'eb_lc', 'microlens')
+
+
+def _index_name(bank_name):
+    """
+    Return the name of the index file corresponding to bank_name
+    """
+    return bank_name + '.index.json'
+
+
+def write_light_curve_template_bank(bank_name, data_dir=None, file_list=None):
+    """
+    Read in ASCII light curve templates and pack them into a single
+    binary bank file.
+
+    Parameters
+    ----------
+    bank_name is the name of the bank file to be written.  The index
+    will be written to bank_name+'.index.json'
+
+    data_dir is the directory relative to which template file names
+    are specified (default: SIMS_SED_LIBRARY_DIR)
+
+    file_list is an optional list of template file names (relative
+    to data_dir) to be stored.  If None, every file that can be read
+    by numpy.loadtxt under the rrly_lc, cepheid_lc, eb_lc and microlens
+    sub-directories of data_dir is stored.
+
+    Returns
+    -------
+    The LightCurveTemplateBank that was just written
+    """
+    if os.path.exists(bank_name):
+        raise RuntimeError('%s already exists' % bank_name)
+
+    if data_dir is None:
+        data_dir = os.environ.get("SIMS_SED_LIBRARY_DIR")
+        if data_dir is None:
+            raise RuntimeError("You must either specify data_dir or setup "
+                               "sims_sed_library to write a light curve "
+                               "template bank")
+
+    skip_unreadable = False
+    if file_list is None:
+        skip_unreadable = True
+        file_list = []
+        for sub_dir in _TEMPLATE_SUB_DIRS:
+            for dir_path, dir_names, file_names in os.walk(os.path.join(data_dir, sub_dir)):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    file_list.append(os.path.relpath(os.path.join(dir_path, file_name),
+                                                     data_dir))
+
+    index = {}
+    offset = 0
+    with open(bank_name, 'wb') as out_file:
+        for file_name in file_list:
+            try:
+                lc = np.loadtxt(os.path.join(data_dir, file_name),
+                                unpack=True, comments='#')
+            except ValueError:
+                if skip_unreadable:
+                    continue
+                raise
+
+            if lc.ndim != 2:
+                if skip_unreadable:
+                    continue
+                raise RuntimeError('%s is not a light curve template' % file_name)
+
+            lc = np.ascontiguousarray(lc, dtype=np.float64)
+            lc.tofile(out_file)
+            index[os.path.normpath(file_name)] = {'offset': offset,
+                                                  'shape': list(lc.shape)}
+            offset += lc.size
+
+    with open(_index_name(bank_name), 'w') as out_file:
+        json.dump(index, out_file)
+
+    return LightCurveTemplateBank(bank_name)
+
+
+class LightCurveTemplateBank(object):
+    """
+    A read-only, memory-mapped handle on a bank of light curve templates
+    written by write_light_curve_template_bank().
+
+    Templates are returned in the same format as
+
+        numpy.loadtxt(file_name, unpack=True, comments='#')
+
+    i.e. as 2-D arrays in which the first row is time and subsequent
+    rows are the light curve columns.  The returned arrays are views
+    into the bank and are not writeable.
+    """
+
+    def __init__(self, bank_name):
+        """
+        Parameters
+        ----------
+        bank_name is the name of the bank file
+        """
+        index_name = _index_name(bank_name)
+        if not os.path.exists(bank_name) or not os.path.exists(index_name):
+            raise RuntimeError('%s is not a light curve template bank' % bank_name)
+
+        with open(index_name, 'r') as in_file:
+            self._index = json.load(in_file)
+
+        self.bank_name = bank_name
+        if os.path.getsize(bank_name) > 0:
+            self._data = np.memmap(bank_name, dtype=np.float64, mode='r')
+        else:
+            self._data = np.zeros(0, dtype=np.float64)
+
+    def __contains__(self, file_name):
+        return os.path.normpath(file_name) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def file_names(self):
+        """
+        A sorted list of the template file names stored in the bank
+        """
+        return sorted(self._index.keys())
+
+    def get(self, file_name):
+        """
+        Return the light curve template corresponding to file_name
+        (specified relative to the data directory from which the bank
+        was written)
+        """
+        try:
+            entry = self._index[os.path.normpath(file_name)]
+        except KeyError:
+            raise RuntimeError('%s is not in the light curve template bank %s'
+                               % (file_name, self.bank_name))
+
+        shape = tuple(entry['shape'])
+        offset = entry['offset']
+        return self._data[offset:offset+shape[0]*shape[1]].reshape(shape)
@@ -0,0 +1,275 @@
+"""
+This module defines the in-memory (and on-disk) representation of the
+catalogs of parametrized light curves used by
+ParametrizedLightCurveMixin (see the docstring of that class for the
+format of the ASCII catalog files).
+
+A catalog is a dict of numpy arrays in compressed-sparse-row form
+
+    'ids' -- the sorted integer ids of the light curves
+    'n_components' -- the number of Fourier components of each light curve
+    'offsets' -- the index in the coefficient arrays of the first
+                 component of each light curve (length len(ids)+1)
+    'median' -- the median flux of each light curve
+    'quiescent' -- median + sum(c) for each light curve
+    'a', 'b', 'c', 'omega', 'tau' -- the Fourier coefficients of all of
+                 the light curves, concatenated
+
+Parsing the ASCII catalogs is slow, so load_parametrized_light_curve_catalog()
+can save the arrays as a directory of .npy files the first time a
+catalog is read.  Subsequent loads memory-map those files (so that all
+processes reading the catalog share one copy in the page cache).  The
+binary cache records the path, size and modification time of the ASCII
+file from which it was built and is rebuilt if any of them changes.
+"""
+
+from builtins import range
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import numpy as np
+
+__all__ = ["read_parametrized_light_curve_file",
+           "load_parametrized_light_curve_catalog",
+           "merge_parametrized_light_curve_catalogs"]
+
+
+_COEFF_NAMES = ('a', 'b', 'c', 'omega', 'tau')
+_ROW_NAMES = ('ids', 'n_components', 'offsets', 'median', 'quiescent')
+
+
+def _sorted_catalog(ids, n_components, median, quiescent, coeffs, offsets=None):
+    """
+    Assemble a catalog dict, sorting the light curves by id
+
+    Parameters
+    ----------
+    ids, n_components, median, quiescent are numpy arrays with one
+    entry per light curve
+
+    coeffs is a dict keyed on 'a', 'b', 'c', 'omega', 'tau' whose
+    values are the concatenated Fourier coefficients of the light
+    curves, in the order of ids
+
+    offsets is the index in coeffs of the first component of each
+    light curve (computed from n_components if None)
+
+    Returns
+    -------
+    A catalog dict (see the module docstring)
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    n_components = np.asarray(n_components, dtype=np.int64)
+    if offsets is None:
+        offsets = np.concatenate([[0], np.cumsum(n_components)]).astype(np.int64)
+
+    order = np.argsort(ids, kind='mergesort')
+    sorted_n_components = n_components[order]
+    sorted_offsets = np.concatenate([[0], np.cumsum(sorted_n_components)]).astype(np.int64)
+
+    # the index into the unsorted coefficient arrays of each component
+    # of the sorted light curves
+    coeff_dex = (np.repeat(offsets[:-1][order]-sorted_offsets[:-1], sorted_n_components) +
+                 np.arange(sorted_offsets[-1], dtype=np.int64))
+
+    unq_ids = np.unique(ids)
+    if len(unq_ids) != len(ids):
+        dup = ids[order][np.where(np.diff(ids[order]) == 0)[0][0]]
+        raise RuntimeError("You are trying to load light curve with the "
+                           "identifying tag %d.  That has already been " % dup
+                           + "loaded.  I am unsure how to proceed")
+
+    catalog = {'ids': ids[order],
+               'n_components': sorted_n_components,
+               'offsets': sorted_offsets,
+               'median': np.asarray(median, dtype=float)[order],
+               'quiescent': np.asarray(quiescent, dtype=float)[order]}
+
+    for name in _COEFF_NAMES:
+        catalog[name] = np.asarray(coeffs[name], dtype=float)[coeff_dex]
+
+    return catalog
+
+
+def read_parametrized_light_curve_file(file_name):
+    """
+    Parse an ASCII (or gzipped ASCII) catalog of parametrized light curves
+
+    Parameters
+    ----------
+    file_name is the name of the file to be read
+
+    Returns
+    -------
+    A catalog dict (see the module docstring)
+    """
+    if file_name.endswith('.gz'):
+        open_fn = gzip.open
+    else:
+        open_fn = open
+
+    ids = []
+    n_components = []
+    median = []
+    quiescent = []
+    coeffs = {}
+    for name in _COEFF_NAMES:
+        coeffs[name] = []
+
+    with open_fn(file_name, 'r') as input_file:
+        for line in input_file:
+            if type(line) == bytes:
+                line = line.decode("utf-8")
+            if line[0] == '#':
+                continue
+            params = line.strip().split()
+            name = params[0]
+            tag = int(name.split('_')[0][4:])
+            n_c = int(params[3])
+            local_median = float(params[4+n_c])
+            local_coeffs = {}
+            for i_name, coeff_name in enumerate(_COEFF_NAMES):
+                local_coeffs[coeff_name] = [float(params[5+n_c+i_c*5+i_name])
+                                            for i_c in range(n_c)]
+                coeffs[coeff_name] += local_coeffs[coeff_name]
+
+            ids.append(tag)
+            n_components.append(n_c)
+            median.append(local_median)
+            quiescent.append(local_median + np.array(local_coeffs['c']).sum())
+
+    return _sorted_catalog(ids, n_components, median, quiescent, coeffs)
+
+
+def _cache_name(file_name, cache_dir):
+    """
+    Return the name of the binary cache of file_name in cache_dir
+    """
+    return os.path.join(cache_dir, os.path.basename(file_name) + '.cache')
+
+
+def _source_signature(file_name):
+    """
+    Return the absolute path, size and modification time of file_name,
+    which are used to decide whether a binary cache is out of date
+    """
+    stat = os.stat(file_name)
+    return {'source_name': os.path.abspath(file_name),
+            'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+
+def _read_cache(file_name, cache_name):
+    """
+    Return the catalog stored in the binary cache cache_name (as
+    memory-mapped arrays), or None if the cache does not exist or
+    does not match file_name
+    """
+    index_name = os.path.join(cache_name, 'index.json')
+    if not os.path.exists(index_name):
+        return None
+
+    with open(index_name, 'r') as in_file:
+        index = json.load(in_file)
+
+    signature = _source_signature(file_name)
+    for key in signature:
+        if index.get(key, None) != signature[key]:
+            return None
+
+    catalog = {}
+    for name in _ROW_NAMES + _COEFF_NAMES:
+        catalog[name] = np.load(os.path.join(cache_name, '%s.npy' % name), mmap_mode='r')
+    return catalog
+
+
+def _write_cache(catalog, file_name, cache_name):
+    """
+    Write catalog to the binary cache cache_name.  The cache is written
+    to a temporary directory and moved into place, so that processes
+    loading the catalog at the same time never see a partial cache.
+    """
+    parent_dir = os.path.dirname(os.path.abspath(cache_name))
+    scratch_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.tmp_param_lc_cache_')
+    try:
+        for name in _ROW_NAMES + _COEFF_NAMES:
+            np.save(os.path.join(scratch_dir, '%s.npy' % name), catalog[name])
+
+        index = _source_signature(file_name)
+        index['n_light_curves'] = len(catalog['ids'])
+        with open(os.path.join(scratch_dir, 'index.json'), 'w') as out_file:
+            json.dump(index, out_file)
+
+        if os.path.exists(cache_name):
+            shutil.rmtree(cache_name)
+        os.rename(scratch_dir, cache_name)
+    finally:
+        if os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir)
+
+
+def load_parametrized_light_curve_catalog(file_name, cache_dir=None):
+    """
+    Load a catalog of parametrized light curves
+
+    Parameters
+    ----------
+    file_name is the ASCII (or gzipped ASCII) catalog
+
+    cache_dir is the directory in which to look for (and, if necessary,
+    write) the binary cache of file_name.  If None, file_name is always
+    parsed and no cache is written.
+
+    Returns
+    -------
+    A catalog dict (see the module docstring).  If it was read from the
+    binary cache, its arrays are read-only memory maps.
+    """
+    if cache_dir is None:
+        return read_parametrized_light_curve_file(file_name)
+
+    cache_name = _cache_name(file_name, cache_dir)
+    catalog = _read_cache(file_name, cache_name)
+    if catalog is not None:
+        return catalog
+
+    catalog = read_parametrized_light_curve_file(file_name)
+    try:
+        _write_cache(catalog, file_name, cache_name)
+    except (IOError, OSError):
+        # the cache directory is not writeable; carry on without the cache
+        pass
+
+    return catalog
+
+
+def merge_parametrized_light_curve_catalogs(catalog_list):
+    """
+    Merge a list of catalog dicts into one, sorted by light curve id.
+    Raises a RuntimeError if the same id appears in more than one catalog.
+    """
+    if len(catalog_list) == 0:
+        coeffs = {}
+        for name in _COEFF_NAMES:
+            coeffs[name] = []
+        return _sorted_catalog([], [], [], [], coeffs)
+
+    if len(catalog_list) == 1:
+        return catalog_list[0]
+
+    offsets = [np.array([0], dtype=np.int64)]
+    n_coeff = 0
+    for catalog in catalog_list:
+        offsets.append(np.asarray(catalog['offsets'][1:]) + n_coeff)
+        n_coeff += catalog['offsets'][-1]
+
+    coeffs = {}
+    for name in _COEFF_NAMES:
+        coeffs[name] = np.concatenate([catalog[name] for catalog in catalog_list])
+
+    return _sorted_catalog(np.concatenate([catalog['ids'] for catalog in catalog_list]),
+                           np.concatenate([catalog['n_components'] for catalog in catalog_list]),
+                           np.concatenate([catalog['median'] for catalog in catalog_list]),
+                           np.concatenate([catalog['quiescent'] for catalog in catalog_list]),
+                           coeffs, offsets=np.concatenate(offsets))
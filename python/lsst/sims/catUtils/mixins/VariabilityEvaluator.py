@@ -0,0 +1,234 @@
+"""
+This module defines a cache-first service for evaluating the light
+curves of variable sources.  Pipelines which repeatedly ask for the
+delta magnitudes of the same objects at overlapping sets of epochs
+(e.g. cadence studies over the same fields) wrap their variability
+model in a VariabilityEvaluator, which remembers every (object, epoch)
+delta magnitude it has computed and only calls the variability models
+for the epochs it has not seen before.
+
+Objects are cached as a whole (the sorted epochs at which they have
+been evaluated and the corresponding delta magnitudes).  When the
+cache holds more than max_entries (object, epoch) pairs, the least
+recently used objects are evicted, either discarded or, if a spill
+directory was given, written to disk from where they are read back
+the next time they are requested.
+
+Combining epochs computed in separate calls is only valid for models
+whose delta magnitude at one epoch does not depend on the other epochs
+requested.  Objects using models marked with @variability_all_epochs
+(e.g. applyAgn, whose random walk in _agn_walk_mode = 'exact' is
+simulated at exactly the requested epochs) are therefore never cached;
+they are evaluated from scratch, at all of the requested epochs, on
+every call.
+"""
+
+from builtins import object
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ["VariabilityEvaluator"]
+
+
+class VariabilityEvaluator(object):
+    """
+    An LRU cache of delta magnitudes wrapped around the
+    iter_variability method of a Variability object (e.g. an
+    InstanceCatalog including VariabilityStars).
+
+    Objects whose variability model is marked with
+    @variability_all_epochs bypass the cache (see the module docstring).
+    """
+
+    def __init__(self, variability_model, max_entries=10000000, spill_dir=None,
+                 variability_cache=None, param_store=None):
+        """
+        Parameters
+        ----------
+        variability_model is an instantiation of a class inheriting
+        from Variability whose models are to be evaluated
+
+        max_entries is the maximum number of (object, epoch) pairs held
+        in memory
+
+        spill_dir is an optional directory to which evicted objects are
+        written (if None, evicted objects are discarded)
+
+        variability_cache and param_store are passed to the variability
+        models (see Variability.applyVariability)
+        """
+        self._model = variability_model
+        self._max_entries = max_entries
+        self._spill_dir = spill_dir
+        self._variability_cache = variability_cache
+        self._param_store = param_store
+
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+        # keyed on (simobjid, var_param); values are tuples of
+        # (sorted numpy array of epochs, (6, n_epochs) numpy array of dmag)
+        self._lc_cache = OrderedDict()
+        self._n_entries = 0
+        self._spilled = set()
+
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @property
+    def n_entries(self):
+        """
+        The number of (object, epoch) pairs held in memory
+        """
+        return self._n_entries
+
+    def clear(self):
+        """
+        Empty the cache (including anything spilled to disk) and
+        reset the hit and miss counters
+        """
+        for key in self._spilled:
+            file_name = self._spill_name(key)
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+        self._spilled = set()
+        self._lc_cache = OrderedDict()
+        self._n_entries = 0
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _spill_name(self, key):
+        """
+        Return the name of the file to which the object key is spilled
+        """
+        tag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._spill_dir, '%s.npz' % tag)
+
+    def _get(self, key):
+        """
+        Return the cached (epochs, dmag) of the object key (reading it
+        back from the spill directory if necessary), or None
+        """
+        if key in self._lc_cache:
+            # move key to the most recently used end of the cache
+            entry = self._lc_cache.pop(key)
+            self._lc_cache[key] = entry
+            return entry
+
+        if key in self._spilled:
+            file_name = self._spill_name(key)
+            with np.load(file_name) as spill_data:
+                entry = (spill_data['epochs'], spill_data['dmag'])
+            os.unlink(file_name)
+            self._spilled.discard(key)
+            self._put(key, entry)
+            return entry
+
+        return None
+
+    def _put(self, key, entry):
+        """
+        Store the (epochs, dmag) entry of the object key, evicting the
+        least recently used objects if the cache is full
+        """
+        if key in self._lc_cache:
+            self._n_entries -= len(self._lc_cache.pop(key)[0])
+        self._lc_cache[key] = entry
+        self._n_entries += len(entry[0])
+
+        while self._n_entries > self._max_entries and len(self._lc_cache) > 1:
+            old_key, old_entry = self._lc_cache.popitem(last=False)
+            self._n_entries -= len(old_entry[0])
+            if self._spill_dir is not None:
+                with open(self._spill_name(old_key), 'wb') as out_file:
+                    np.savez(out_file, epochs=old_entry[0], dmag=old_entry[1])
+                self._spilled.add(old_key)
+
+    def _uncached_objects(self, var_params):
+        """
+        Return a boolean numpy array marking the objects whose variability
+        model is marked with @variability_all_epochs (and which therefore
+        must not be cached)
+        """
+        self._model._build_variability_registry()
+        method_ints = [self._model._method_name_to_int[method_name]
+                       for method_name in self._model._method_all_epochs
+                       if self._model._method_all_epochs[method_name]]
+        if len(method_ints) == 0 or len(var_params) == 0:
+            return np.zeros(len(var_params), dtype=bool)
+
+        method_int_arr, params = self._model._decode_variability_params(var_params,
+                                                                        param_store=self._param_store)
+        return np.isin(method_int_arr, method_ints)
+
+    def evaluate(self, simobjid, var_params, expmjd):
+        """
+        Return the delta magnitudes of a set of objects
+
+        Parameters
+        ----------
+        simobjid is a numpy array of the unique ids of the objects
+
+        var_params is the corresponding numpy array of varParamStr (or of
+        simobjid, if the evaluator was constructed with a param_store).
+        Variability models which read columns from an InstanceCatalog
+        expect these to be the catalog's whole current chunk.
+
+        expmjd is a numpy array of MJD
+
+        Returns
+        -------
+        A numpy array of shape (6, len(simobjid), len(expmjd)) as returned
+        by Variability.applyVariability
+        """
+        expmjd = np.asarray(expmjd, dtype=float)
+        n_obj = len(simobjid)
+        d_mag = np.zeros((6, n_obj, len(expmjd)))
+        missing = np.zeros((n_obj, len(expmjd)), dtype=bool)
+
+        uncached = self._uncached_objects(var_params)
+
+        keys = []
+        for i_obj in range(n_obj):
+            key = (simobjid[i_obj], var_params[i_obj])
+            keys.append(key)
+            if uncached[i_obj]:
+                missing[i_obj, :] = True
+                continue
+            entry = self._get(key)
+            if entry is None:
+                missing[i_obj, :] = True
+                continue
+            epochs, cached_d_mag = entry
+            dex = np.clip(np.searchsorted(epochs, expmjd), 0, max(len(epochs)-1, 0))
+            found = (epochs[dex] == expmjd) if len(epochs) > 0 else np.zeros(len(expmjd), dtype=bool)
+            d_mag[:, i_obj, found] = cached_d_mag[:, dex[found]]
+            missing[i_obj, :] = np.logical_not(found)
+
+        n_missing = missing.sum()
+        self.n_misses += n_missing
+        self.n_hits += missing.size - n_missing
+        if n_missing == 0:
+            return d_mag
+
+        for obj_slice, time_slice, tile in self._model.iter_variability(var_params, expmjd,
+                                                                        mask=missing,
+                                                                        variability_cache=self._variability_cache,
+                                                                        param_store=self._param_store):
+            local_missing = missing[obj_slice, time_slice]
+            d_mag[:, obj_slice, time_slice][:, local_missing] = tile[:, local_missing]
+
+        for i_obj in np.where(missing.any(axis=1) & np.logical_not(uncached))[0]:
+            new_epochs = expmjd[missing[i_obj]]
+            new_d_mag = d_mag[:, i_obj, missing[i_obj]]
+            entry = self._get(keys[i_obj])
+            if entry is not None:
+                new_epochs = np.concatenate([entry[0], new_epochs])
+                new_d_mag = np.concatenate([entry[1], new_d_mag], axis=1)
+            # expmjd may contain repeated epochs
+            new_epochs, unq_dex = np.unique(new_epochs, return_index=True)
+            self._put(keys[i_obj], (new_epochs, new_d_mag[:, unq_dex]))
+
+        return d_mag
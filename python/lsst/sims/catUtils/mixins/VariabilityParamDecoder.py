@@ -0,0 +1,198 @@
+"""
+This module defines the class that turns the json-ized varParamStr
+values stored in the CatSim database into the columnar parameter
+arrays consumed by the variability models in VariabilityMixin.py
+"""
+
+from builtins import object
+import numbers
+import json
+import numpy as np
+
+__all__ = ["VariabilityParamDecoder"]
+
+
+class VariabilityParamDecoder(object):
+    """
+    Decode chunks of varParamStr values into per-model columns of
+    parameters.
+
+    A varParamStr looks like
+
+    {'m':method_name, 'p':{'p1': val1, 'p2': val2,...}}
+
+    (or, in older tables, {'varMethodName':method_name, 'pars':{...}}).
+
+    Each distinct varParamStr in a chunk is only passed through
+    json.loads once.  The result is memoized on the raw string, so
+    that parameter strings which repeat across chunks (as they do
+    many millions of times in the CatSim tables) are never decoded
+    twice in the same process.
+
+    Parameter columns are typed numpy arrays rather than arrays of
+    objects.  Rows that do not use a given variability model are
+    filled with
+
+        numpy.nan for float columns
+        -1 for int columns
+        'None' for str columns
+
+    Parameters whose values are neither all numbers nor all strings
+    fall back to object arrays filled with None.
+    """
+
+    def __init__(self, max_cache_size=1000000):
+        """
+        Parameters
+        ----------
+        max_cache_size is the maximum number of distinct varParamStr
+        values to memoize.  When the memo grows past this size, it is
+        emptied and refilled from scratch.
+        """
+        self._max_cache_size = max_cache_size
+
+        # a dict keyed on the raw varParamStr; values are tuples
+        # (method_name, dict_of_parameters)
+        self.memo = {}
+
+    def clear(self):
+        """
+        Empty the memo of decoded varParamStr
+        """
+        self.memo.clear()
+
+    def _decode_one(self, raw):
+        """
+        Decode a single varParamStr, returning a tuple
+        (method_name, dict_of_parameters).  Returns None if
+        raw is 'None'
+        """
+        try:
+            return self.memo[raw]
+        except KeyError:
+            pass
+
+        if raw == 'None':
+            return None
+
+        var_cmd = json.loads(raw)
+
+        if 'varMethodName' in var_cmd:
+            meth_key = 'varMethodName'
+        else:
+            meth_key = 'm'
+
+        if 'pars' in var_cmd:
+            par_key = 'pars'
+        else:
+            par_key = 'p'
+
+        decoded = (var_cmd[meth_key], var_cmd[par_key])
+
+        if len(self.memo) >= self._max_cache_size:
+            self.memo.clear()
+        self.memo[str(raw)] = decoded
+        return decoded
+
+    @staticmethod
+    def _typed_column(values, rows, local_dex, n_rows):
+        """
+        Build the column of a single parameter
+
+        Parameters
+        ----------
+        values is a list of the parameter's values, one for each
+        distinct varParamStr using the model (None where the
+        varParamStr did not specify the parameter)
+
+        rows is a numpy array of the rows in the chunk that use the model
+
+        local_dex is a numpy array, the same length as rows, containing
+        the index in values corresponding to each row
+
+        n_rows is the number of rows in the chunk
+
+        Returns
+        -------
+        A numpy array of length n_rows
+        """
+        present = [vv for vv in values if vv is not None]
+        if len(present) > 0 and all(isinstance(vv, numbers.Integral) for vv in present):
+            dtype = np.int64
+            fill = -1
+        elif len(present) > 0 and all(isinstance(vv, numbers.Number) for vv in present):
+            dtype = float
+            fill = np.nan
+        elif len(present) > 0 and all(isinstance(vv, str) for vv in present):
+            dtype = '<U%d' % max(4, max(len(vv) for vv in present))
+            fill = 'None'
+        else:
+            dtype = object
+            fill = None
+
+        unq_values = np.array([fill if vv is None else vv for vv in values], dtype=dtype)
+        column = np.full(n_rows, fill, dtype=dtype)
+        column[rows] = unq_values[local_dex]
+        return column
+
+    def decode(self, varParams_arr):
+        """
+        Decode a chunk of varParamStr values
+
+        Parameters
+        ----------
+        varParams_arr is a list or numpy array of varParamStr values
+        (None or 'None' for objects with no variability)
+
+        Returns
+        -------
+        method_name_arr is a numpy array of str containing the name of
+        the variability model applied to each row ('None' for rows
+        with no variability)
+
+        params is a dict keyed on the names of the variability models
+        present in the chunk.  params[method_name] is another dict keyed
+        on the names of the parameters required by method_name.  Its
+        values are numpy arrays with one entry for every row in the chunk
+        (even rows which do not use method_name).
+        """
+        n_rows = len(varParams_arr)
+        if n_rows == 0:
+            return np.array([], dtype=str), {}
+
+        raw_arr = np.asarray(varParams_arr).astype(str)
+        unq_raw, inverse = np.unique(raw_arr, return_inverse=True)
+        inverse = inverse.flatten()
+        decoded = [self._decode_one(raw) for raw in unq_raw]
+
+        unq_method = np.array([dd[0] if dd is not None else 'None' for dd in decoded])
+        method_names, unq_method_int = np.unique(unq_method, return_inverse=True)
+        unq_method_int = unq_method_int.flatten()
+        row_method_int = unq_method_int[inverse]
+        method_name_arr = method_names[row_method_int]
+
+        params = {}
+        for i_method, method_name in enumerate(method_names):
+            if method_name == 'None':
+                continue
+
+            local_unq = np.where(unq_method_int == i_method)[0]
+            local_map = -1*np.ones(len(unq_raw), dtype=int)
+            local_map[local_unq] = np.arange(len(local_unq), dtype=int)
+
+            rows = np.where(row_method_int == i_method)[0]
+            local_dex = local_map[inverse[rows]]
+
+            p_name_list = []
+            for i_unq in local_unq:
+                for p_name in decoded[i_unq][1]:
+                    if p_name not in p_name_list:
+                        p_name_list.append(p_name)
+
+            params[method_name] = {}
+            for p_name in p_name_list:
+                values = [decoded[i_unq][1].get(p_name, None) for i_unq in local_unq]
+                params[method_name][p_name] = self._typed_column(values, rows,
+                                                                 local_dex, n_rows)
+
+        return method_name_arr, params
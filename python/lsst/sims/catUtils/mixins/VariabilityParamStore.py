@@ -0,0 +1,276 @@
+"""
+This module defines an on-disk store of pre-decoded variability
+parameters.  The store is written once from the varParamStr column of
+a CatSim table (or a single trixel of that table) and can then be
+handed to Variability.applyVariability in place of the raw
+varParamStr, so that repeated simulations over the same patch of sky
+never touch json.
+
+The layout of the store is
+
+    store_dir/
+        htmid_NNNN/            (or all/ if the whole table was queried)
+            index.json
+            model_name/
+                simobjid.npy
+                param_name.npy
+                ...
+
+Every .npy file other than those containing Python objects is
+memory-mapped when it is read back in.  The simobjid.npy file in each
+model directory is sorted; the parameter files are ordered to match.
+"""
+
+from builtins import object
+import os
+import json
+import numpy as np
+
+from lsst.sims.catUtils.mixins.VariabilityParamDecoder import VariabilityParamDecoder
+
+__all__ = ["VariabilityParamStore", "write_variability_param_store"]
+
+
+def _partition_name(htmid):
+    """
+    Return the name of the sub-directory holding the partition
+    corresponding to htmid (None means the whole table)
+    """
+    if htmid is None:
+        return 'all'
+    return 'htmid_%d' % htmid
+
+
+def write_variability_param_store(dbobj, store_dir, htmid=None,
+                                  chunk_size=100000, constraint=None):
+    """
+    Query the varParamStr column of a CatalogDBObject, decode it and
+    write the result to disk as a VariabilityParamStore.
+
+    Parameters
+    ----------
+    dbobj is the CatalogDBObject whose variability parameters are being
+    stored.  It must provide the columns 'simobjid' and 'varParamStr'.
+    If htmid is not None, it must also provide the query_columns_htmid
+    method (see StellarAlertDBObjMixin in utils/alertDataGenerator.py).
+
+    store_dir is the directory in which to write the store
+
+    htmid is the htmid of the trixel to be stored.  If None, the
+    whole table is queried.
+
+    chunk_size is the number of rows to query from the database at once
+
+    constraint is an optional SQL constraint on the query
+
+    Returns
+    -------
+    The VariabilityParamStore that was just written
+    """
+    partition_dir = os.path.join(store_dir, _partition_name(htmid))
+    if os.path.exists(partition_dir):
+        raise RuntimeError('%s already exists' % partition_dir)
+
+    colnames = ['simobjid', 'varParamStr']
+    if htmid is None:
+        data_iter = dbobj.query_columns(colnames=colnames, chunk_size=chunk_size,
+                                        constraint=constraint)
+    else:
+        data_iter = dbobj.query_columns_htmid(colnames=colnames, htmid=htmid,
+                                              chunk_size=chunk_size,
+                                              constraint=constraint)
+
+    # Every distinct varParamStr in the partition is assigned an index;
+    # the rows of each chunk only record those indices.  The distinct
+    # strings are decoded together once the query is done, so that the
+    # parameter columns are typed over the whole partition (a parameter
+    # need not appear in, or have the same type in, every chunk).
+    unq_dex = {}
+    simobjid_list = []
+    raw_dex_list = []
+    for chunk in data_iter:
+        if len(chunk) == 0:
+            continue
+        raw_arr = np.asarray(chunk['varParamStr']).astype(str)
+        unq_raw, inverse = np.unique(raw_arr, return_inverse=True)
+        local_to_global = np.array([unq_dex.setdefault(raw, len(unq_dex))
+                                    for raw in unq_raw], dtype=int)
+        simobjid_list.append(np.asarray(chunk['simobjid']))
+        raw_dex_list.append(local_to_global[inverse.flatten()])
+
+    os.makedirs(partition_dir)
+    index = {'models': {}}
+    if len(unq_dex) > 0:
+        unq_raw = np.empty(len(unq_dex), dtype=object)
+        for raw, dex in unq_dex.items():
+            unq_raw[dex] = raw
+
+        unq_method, unq_params = VariabilityParamDecoder().decode(unq_raw)
+        simobjid_all = np.concatenate(simobjid_list)
+        raw_dex_all = np.concatenate(raw_dex_list)
+        row_method = unq_method[raw_dex_all]
+    else:
+        unq_params = {}
+
+    for method_name in unq_params:
+        model_dir = os.path.join(partition_dir, method_name)
+        os.mkdir(model_dir)
+        rows = np.where(row_method == method_name)[0]
+        simobjid = simobjid_all[rows]
+        sorted_dex = np.argsort(simobjid, kind='mergesort')
+        model_raw_dex = raw_dex_all[rows][sorted_dex]
+        np.save(os.path.join(model_dir, 'simobjid.npy'), simobjid[sorted_dex])
+
+        p_name_list = []
+        for p_name in unq_params[method_name]:
+            column = unq_params[method_name][p_name][model_raw_dex]
+            np.save(os.path.join(model_dir, '%s.npy' % p_name), column,
+                    allow_pickle=(column.dtype == object))
+            p_name_list.append(p_name)
+
+        index['models'][method_name] = {'n_rows': len(simobjid),
+                                        'params': p_name_list}
+
+    with open(os.path.join(partition_dir, 'index.json'), 'w') as out_file:
+        json.dump(index, out_file)
+
+    return VariabilityParamStore(store_dir, htmid=htmid)
+
+
+class VariabilityParamStore(object):
+    """
+    A read-only handle on a partition of the variability parameter
+    store written by write_variability_param_store().
+
+    The handle can be passed to Variability.applyVariability via the
+    param_store kwarg, in which case applyVariability should be called
+    with an array of simobjid rather than an array of varParamStr.
+    Only the variability models actually requested are read from disk.
+    """
+
+    def __init__(self, store_dir, htmid=None):
+        """
+        Parameters
+        ----------
+        store_dir is the directory containing the store
+
+        htmid is the htmid of the trixel partition to be read
+        (None if the store was written for a whole table)
+        """
+        self._partition_dir = os.path.join(store_dir, _partition_name(htmid))
+        index_name = os.path.join(self._partition_dir, 'index.json')
+        if not os.path.exists(index_name):
+            raise RuntimeError('%s is not a variability parameter store' %
+                               self._partition_dir)
+
+        with open(index_name, 'r') as in_file:
+            self._index = json.load(in_file)
+
+        self._model_cache = {}
+
+    @property
+    def model_names(self):
+        """
+        A sorted list of the variability models contained in the store
+        """
+        return sorted(self._index['models'].keys())
+
+    def _load_model(self, method_name):
+        """
+        Return a dict containing the (memory-mapped) arrays for the
+        variability model method_name
+        """
+        if method_name in self._model_cache:
+            return self._model_cache[method_name]
+
+        model_dir = os.path.join(self._partition_dir, method_name)
+        model = {'simobjid': np.load(os.path.join(model_dir, 'simobjid.npy'),
+                                     mmap_mode='r'),
+                 'params': {}}
+
+        for p_name in self._index['models'][method_name]['params']:
+            file_name = os.path.join(model_dir, '%s.npy' % p_name)
+            try:
+                model['params'][p_name] = np.load(file_name, mmap_mode='r')
+            except ValueError:
+                # arrays of Python objects cannot be memory-mapped
+                model['params'][p_name] = np.load(file_name, allow_pickle=True)
+
+        self._model_cache[method_name] = model
+        return model
+
+    @staticmethod
+    def _fill_value(dtype):
+        """
+        Return the value used by VariabilityParamDecoder for rows
+        which do not use a variability model
+        """
+        if dtype.kind in ('i', 'u'):
+            return -1
+        if dtype.kind == 'f':
+            return np.nan
+        if dtype.kind == 'U':
+            return 'None'
+        return None
+
+    def decode(self, simobjid_arr, model_names=None):
+        """
+        Look up the variability parameters of a chunk of objects
+
+        Parameters
+        ----------
+        simobjid_arr is a list or numpy array of simobjid
+
+        model_names is an optional list of the variability models
+        to look up.  If None, all of the models in the store are read.
+
+        Returns
+        -------
+        The same outputs as VariabilityParamDecoder.decode(), i.e.
+
+        method_name_arr is a numpy array of str containing the name
+        of the variability model applied to each object ('None' for
+        objects with no variability)
+
+        params is a dict keyed on the names of the variability models.
+        params[method_name] is a dict keyed on parameter names whose
+        values are numpy arrays with one entry per object.
+        """
+        simobjid_arr = np.asarray(simobjid_arr)
+        n_rows = len(simobjid_arr)
+
+        if model_names is None:
+            model_names = self.model_names
+
+        name_len = max([4] + [len(name) for name in model_names])
+        method_name_arr = np.full(n_rows, 'None', dtype='<U%d' % name_len)
+        params = {}
+
+        if n_rows == 0:
+            return method_name_arr, params
+
+        for method_name in model_names:
+            if method_name not in self._index['models']:
+                continue
+
+            model = self._load_model(method_name)
+            stored_id = model['simobjid']
+            if len(stored_id) == 0:
+                continue
+
+            pos = np.searchsorted(stored_id, simobjid_arr)
+            pos = np.minimum(pos, len(stored_id)-1)
+            found = np.where(stored_id[pos] == simobjid_arr)[0]
+            if len(found) == 0:
+                continue
+
+            method_name_arr[found] = method_name
+            params[method_name] = {}
+            for p_name in model['params']:
+                stored_col = model['params'][p_name]
+                column = np.full(n_rows, self._fill_value(stored_col.dtype),
+                                 dtype=stored_col.dtype)
+                column[found] = stored_col[pos[found]]
+                params[method_name][p_name] = column
+
+        return method_name_arr, params
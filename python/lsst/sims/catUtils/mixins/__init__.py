@@ -1,5 +1,10 @@
 from .AstrometryMixin import *
 from .PhotometryMixin import *
+from .VariabilityParamDecoder import *
+from .VariabilityParamStore import *
+from .ParametrizedLightCurveCatalog import *
+from .LightCurveTemplateBank import *
+from .VariabilityEvaluator import *
 from .VariabilityMixin import *
 from .EBVmixin import *
 from .CosmologyMixin import *
@@ -1,10 +1,12 @@
 import numpy as np
 import os
 import re
-import sqlite3
 from collections import OrderedDict
 import time
 import gc
+import json
+import multiprocessing as mproc
+from queue import Empty
 from lsst.utils import getPackageDir
 from lsst.sims.catalogs.definitions import InstanceCatalog
 from lsst.sims.utils import trixelFromHtmid, getAllTrixels
@@ -13,6 +15,7 @@ from lsst.sims.utils import angularSeparation, ObservationMetaData
 from lsst.sims.utils import arcsecFromRadians
 from lsst.sims.catUtils.utils import _baseLightCurveCatalog
 from lsst.sims.utils import _pupilCoordsFromRaDec
+from lsst.sims.utils import _angularSeparation, _icrsFromObserved
 from lsst.sims.coordUtils import chipNameFromPupilCoordsLSST
 from lsst.sims.coordUtils import pixelCoordsFromPupilCoordsLSST
 
@@ -24,12 +27,15 @@ from lsst.sims.catUtils.mixins import VariabilityGalaxies, AstrometryGalaxies
 from lsst.sims.catUtils.mixins import CameraCoordsLSST, PhotometryBase
 from lsst.sims.catUtils.mixins import ParametrizedLightCurveMixin
 from lsst.sims.catUtils.mixins import create_variability_cache
+from lsst.sims.catUtils.mixins import VariabilityParamStore
+from lsst.sims.catUtils.utils.alertDataWriters import alert_data_writer_class
 
 from lsst.sims.catUtils.baseCatalogModels import StarObj, GalaxyAgnObj
 from sqlalchemy.sql import text
 from lsst.sims.catalogs.db import ChunkIterator
 
 __all__ = ["AlertDataGenerator",
+           "AlertObservationContext",
            "AlertStellarVariabilityCatalog",
            "AlertAgnVariabilityCatalog",
            "_baseAlertCatalog",
@@ -38,14 +44,163 @@ __all__ = ["AlertDataGenerator",
            "StellarAlertDBObjMixin"]
 
 
+def _lsst_focal_plane_footprint(n_pix=256, half_width=0.045):
+    """
+    Build a conservative bitmap of the region of pupil coordinates
+    covered by the detectors of the LSST camera
+
+    Parameters
+    ----------
+    n_pix is the number of pixels on each side of the bitmap
+
+    half_width is the half width of the (square) bitmap in radians.
+    It must be larger than the focal plane.
+
+    Returns
+    -------
+    A dict containing
+        'bitmap' -- a boolean numpy array of shape (n_pix, n_pix);
+                    bitmap[i_x][i_y] is True if any point in the pixel
+                    could fall on a detector
+        'half_width' -- half_width
+        'max_radius' -- the largest pupil radius (in radians) of any
+                        True pixel
+    """
+    grid = np.linspace(-half_width, half_width, n_pix+1)
+    xpup_grid, ypup_grid = np.meshgrid(grid, grid, indexing='ij')
+    chip_names = chipNameFromPupilCoordsLSST(xpup_grid.flatten(), ypup_grid.flatten())
+    on_chip = np.not_equal(chip_names, None).reshape(n_pix+1, n_pix+1)
+
+    # a pixel is covered if any of its corners lands on a detector...
+    bitmap = (on_chip[:-1, :-1] | on_chip[1:, :-1] |
+              on_chip[:-1, 1:] | on_chip[1:, 1:])
+
+    # ...or if any of its neighbors is covered (detectors are much larger
+    # than the pixels, so this catches the slivers of detector that
+    # missed all of the corners of a pixel)
+    dilated = bitmap.copy()
+    dilated[1:, :] |= bitmap[:-1, :]
+    dilated[:-1, :] |= bitmap[1:, :]
+    dilated[:, 1:] |= bitmap[:, :-1]
+    dilated[:, :-1] |= bitmap[:, 1:]
+    bitmap = dilated
+    if bitmap[0, :].any() or bitmap[-1, :].any() or bitmap[:, 0].any() or bitmap[:, -1].any():
+        raise RuntimeError("The LSST focal plane extends beyond the focal plane "
+                           "bitmap; increase half_width (%e)" % half_width)
+
+    covered = np.where(bitmap)
+    corner_x = np.maximum(np.abs(grid[covered[0]]), np.abs(grid[covered[0]+1]))
+    corner_y = np.maximum(np.abs(grid[covered[1]]), np.abs(grid[covered[1]+1]))
+
+    return {'bitmap': bitmap,
+            'half_width': half_width,
+            'max_radius': np.sqrt(corner_x**2 + corner_y**2).max()}
+
+
+def _in_focal_plane_footprint(xpup, ypup, footprint):
+    """
+    Return a boolean numpy array that is True for the pupil coordinates
+    (xpup, ypup; in radians) which could fall on a detector according to
+    a footprint returned by _lsst_focal_plane_footprint
+    """
+    bitmap = footprint['bitmap']
+    n_pix = bitmap.shape[0]
+    pix_size = 2.0*footprint['half_width']/n_pix
+    i_x = np.floor((np.asarray(xpup)+footprint['half_width'])/pix_size).astype(int)
+    i_y = np.floor((np.asarray(ypup)+footprint['half_width'])/pix_size).astype(int)
+    in_bounds = (i_x >= 0) & (i_x < n_pix) & (i_y >= 0) & (i_y < n_pix)
+    in_footprint = np.zeros(len(i_x), dtype=bool)
+    in_footprint[in_bounds] = bitmap[i_x[in_bounds], i_y[in_bounds]]
+    return in_footprint
+
+
+def _detectable_variability_mask(dmag_arr_transpose, time_arr, quiescent_mags,
+                                 dmag_cutoff, obs_mag_cutoff):
+    """
+    Find the objects which vary by more than dmag_cutoff while being
+    brighter than the limiting magnitude in at least one band, considering
+    only the observations in which each object lands on a detector
+
+    Parameters
+    ----------
+    dmag_arr_transpose is a numpy array of shape (n_obj, n_bands, n_time)
+    containing the delta magnitudes of the objects
+
+    time_arr is a numpy array of shape (n_obj, n_time); positive values
+    mark the observations in which the object lands on a detector
+
+    quiescent_mags is a numpy array of shape (n_bands, n_obj) containing
+    the quiescent magnitudes of the objects
+
+    dmag_cutoff is the minimum |delta magnitude| needed to trigger an alert
+
+    obs_mag_cutoff is the limiting magnitude in each band
+
+    Returns
+    -------
+    A boolean numpy array of shape (n_obj,)
+    """
+    valid_times = (np.asarray(time_arr) > 0)[:, None, :]
+    if valid_times.shape[2] == 0:
+        return np.zeros(len(time_arr), dtype=bool)
+    abs_dmag_max = np.where(valid_times, np.abs(dmag_arr_transpose), -np.inf).max(axis=2)
+    dmag_min = np.where(valid_times, dmag_arr_transpose, np.inf).min(axis=2)
+    detectable = np.logical_and(abs_dmag_max > dmag_cutoff,
+                                np.asarray(quiescent_mags).transpose() + dmag_min <=
+                                np.asarray(obs_mag_cutoff)[None, :])
+    return detectable.any(axis=1)
+
+
 class StellarAlertDBObjMixin(object):
     """
     Mimics StarObj class, except it allows you to directly query
     all objects in a trixel specified by an htmid.
     """
+    def _htmid_column_name(self):
+        """
+        Return the name of the htmid column in the database table
+        (SQL is not case sensitive but python is)
+        """
+        if 'htmID' in self.columnMap:
+            return 'htmID'
+        elif 'htmid' in self.columnMap:
+            return 'htmid'
+        return 'htmId'
+
+    @staticmethod
+    def _htmid_range(htmid):
+        """
+        Return the minimum and maximum level 21 htmid (level=21 since
+        that is what is implemented on fatboy) contained in the trixel
+        specified by htmid.
+
+        Note that sqlalchemy does not like np.int64 as a data type
+        """
+        current_level = levelFromHtmid(htmid)
+        n_bits_off = 2*(21-current_level)
+        htmid_min = int(htmid << n_bits_off)
+        htmid_max = int((htmid+1) << n_bits_off)
+        return htmid_min, htmid_max
+
+    def count_htmid(self, htmid, constraint=None):
+        """
+        Return the number of objects in the trixel specified by htmid
+        (i.e. the number of rows query_columns_htmid would return),
+        found with a SELECT COUNT(*) on the same htmid range.
+
+        constraint is an optional SQL constraint on the query
+        """
+        htmid_min, htmid_max = self._htmid_range(htmid)
+        query = 'SELECT COUNT(*) FROM %s WHERE %s BETWEEN %d AND %d' % \
+                (self.tableid, self._htmid_column_name(), htmid_min, htmid_max)
+        if constraint is not None:
+            query += ' AND %s' % constraint
+        result = self.execute_arbitrary(query, dtype=np.dtype([('n_obj', np.int64)]))
+        return int(result['n_obj'][0])
+
     def query_columns_htmid(self, colnames=None, chunk_size=None,
                             constraint=None,
-                            limit=None, htmid=None):
+                            limit=None, htmid=None, order_by=None):
         """Execute a query from the primary catsim database
 
         Execute a query, taking advantage of the spherical geometry library and
@@ -66,6 +221,8 @@ class StellarAlertDBObjMixin(object):
             * limit : int (optional)
               limits the number of rows returned by the query
             * htmid is the htmid to be queried
+            * order_by : str (optional)
+              the name of a column (in `columnMap`) by which to sort the results
 
         **Returns**
 
@@ -75,16 +232,8 @@ class StellarAlertDBObjMixin(object):
               then result is an iterator over lists of the given size.
         """
 
-        # find the minimum and maximum htmid
-        # (level=21 since that is what is implemented
-        # on fatboy) that we are asking for
-        #
-        # Note that sqlalchemy does not like np.int64
-        # as a data type
-        current_level = levelFromHtmid(htmid)
-        n_bits_off = 2*(21-current_level)
-        htmid_min = int(htmid << n_bits_off)
-        htmid_max = int((htmid+1) << n_bits_off)
+        # find the minimum and maximum htmid that we are asking for
+        htmid_min, htmid_max = self._htmid_range(htmid)
 
         query = self._get_column_query(colnames)
 
@@ -94,13 +243,7 @@ class StellarAlertDBObjMixin(object):
         if not self.tableid.endswith('forceseek'):
             query = query.with_hint(self.table, ' WITH(FORCESEEK)', 'mssql')
 
-        # SQL is not case sensitive but python is:
-        if 'htmID' in self.columnMap:
-            htmid_name = 'htmID'
-        elif 'htmid' in self.columnMap:
-            htmid_name = 'htmid'
-        else:
-            htmid_name = 'htmId'
+        htmid_name = self._htmid_column_name()
 
         # Range join on htmid ranges
         query = query.filter(self.table.c[htmid_name].between(htmid_min, htmid_max))
@@ -108,6 +251,9 @@ class StellarAlertDBObjMixin(object):
         if constraint is not None:
             query = query.filter(text(constraint))
 
+        if order_by is not None:
+            query = query.order_by(text(self.columnMap[order_by]))
+
         if limit is not None:
             query = query.limit(limit)
 
@@ -220,6 +366,51 @@ class AgnAlertDBObj(GalaxyAgnObj):
         return results
 
 
+class AlertObservationContext(object):
+    """
+    The state that differs from one simulated observation to the next.
+    alert_data_from_htmid builds one of these per observation of a trixel
+    and switches a single _baseAlertCatalog between them (see
+    _baseAlertCatalog.set_observation_context) rather than instantiating
+    one catalog per observation.
+    """
+
+    _band_to_int = {'u': 0, 'g': 1, 'r': 2, 'i': 3, 'z': 4, 'y': 5}
+
+    def __init__(self, obs_metadata):
+        """
+        Parameters
+        ----------
+        obs_metadata is the ObservationMetaData of the observation
+        """
+        self.obs_metadata = obs_metadata
+        self.obshistid = obs_metadata.OpsimMetaData['obsHistID']
+        self.bandpass = obs_metadata.bandpass
+        self.i_band = self._band_to_int[obs_metadata.bandpass]
+        self.tai = obs_metadata.mjd.TAI
+        if obs_metadata.m5 is not None and obs_metadata.bandpass in obs_metadata.m5:
+            self.m5 = obs_metadata.m5[obs_metadata.bandpass]
+        else:
+            self.m5 = None
+        self.rotSkyPos = obs_metadata.rotSkyPos
+
+        # the ICRS position of the pointing (in radians)
+        ra, dec = _icrsFromObserved(np.array([obs_metadata._pointingRA]),
+                                    np.array([obs_metadata._pointingDec]),
+                                    obs_metadata=obs_metadata, epoch=2000.0,
+                                    includeRefraction=False)
+        self.ra_pointing_icrs = ra[0]
+        self.dec_pointing_icrs = dec[0]
+
+        # years between J2000 and the observation (for bounding
+        # how far proper motion can have moved an object)
+        self.years_from_j2000 = np.abs(self.tai-51544.5)/365.25
+
+        # the gamma of calcSNR_m5; set by the first call to
+        # _baseAlertCatalog.get_alertFlux in this context
+        self.gamma = None
+
+
 class _baseAlertCatalog(PhotometryBase, CameraCoordsLSST, _baseLightCurveCatalog):
 
     column_outputs = ['htmid', 'uniqueId', 'raICRS', 'decICRS',
@@ -232,6 +423,20 @@ class _baseAlertCatalog(PhotometryBase, CameraCoordsLSST, _baseLightCurveCatalog
                        ('properMotionDec', 0.0, float),
                        ('parallax', 0.0, float)]
 
+    def set_observation_context(self, context):
+        """
+        Point this catalog at a different observation without
+        re-instantiating it.
+
+        Parameters
+        ----------
+        context is an AlertObservationContext.  Its obs_metadata
+        becomes the catalog's obs_metadata.
+        """
+        self._observation_context = context
+        self.obs_metadata = context.obs_metadata
+        self._column_cache = {}
+
     def iter_catalog_chunks(self, chunk_size=None, query_cache=None, column_cache=None):
         """
         Returns an iterator over chunks of the catalog.
@@ -371,12 +576,23 @@ class _baseAlertCatalog(PhotometryBase, CameraCoordsLSST, _baseLightCurveCatalog
         flux = self._dummy_sed.fluxFromMag(mag)
         dflux = flux - quiescent_flux
 
+        # gamma depends on the observation, so it is kept on the
+        # observation context if the catalog has one
+        context = getattr(self, '_observation_context', None)
+        if context is None:
+            gamma = self._gamma
+        else:
+            gamma = context.gamma
+
         snr_tot, gamma = calcSNR_m5(mag, self.lsstBandpassDict[self.obs_metadata.bandpass],
                                     self.obs_metadata.m5[self.obs_metadata.bandpass],
-                                    self.phot_params, gamma=self._gamma)
+                                    self.phot_params, gamma=gamma)
 
-        if self._gamma is None:
-            self._gamma = gamma
+        if context is None:
+            if self._gamma is None:
+                self._gamma = gamma
+        elif context.gamma is None:
+            context.gamma = gamma
 
         return np.array([flux, dflux, snr_tot])
 
@@ -405,6 +621,57 @@ class AlertAgnVariabilityCatalog(_baseAlertCatalog,
                          self.column_by_name('z_ab'), self.column_by_name('y_ab')])
 
 
+def _write_progress_record(progress_file_name, lock, **record):
+    """
+    Append a JSON record (one per line) to the progress log written
+    by AlertDataGenerator.run_parallel
+    """
+    record['time'] = time.time()
+    record['pid'] = os.getpid()
+    if lock is not None:
+        lock.acquire()
+    try:
+        with open(progress_file_name, 'a') as out_file:
+            out_file.write('%s\n' % json.dumps(record, sort_keys=True))
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def _run_parallel_worker(alert_gen, dbobj_factory, task_queue, result_queue,
+                         lock, progress_file_name, alert_data_kwargs):
+    """
+    Pull htmids off of task_queue and simulate them with
+    alert_gen.alert_data_from_htmid until a None is pulled.
+    Put (htmid, n_rows) on result_queue after each task
+    (n_rows is None if the task failed).
+    """
+    dbobj = dbobj_factory()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        htmid, cost = task
+        n_obs = alert_gen.n_obs(htmid)
+        _write_progress_record(progress_file_name, lock, htmid=int(htmid),
+                               n_obs=n_obs, cost=cost, status='start')
+        t_start = time.time()
+        try:
+            n_rows = alert_gen.alert_data_from_htmid(htmid, dbobj, lock=lock,
+                                                     **alert_data_kwargs)
+        except Exception as err:
+            _write_progress_record(progress_file_name, lock, htmid=int(htmid),
+                                   n_obs=n_obs, cost=cost, status='failed',
+                                   elapsed=time.time()-t_start, error=repr(err))
+            result_queue.put((htmid, None))
+            continue
+
+        _write_progress_record(progress_file_name, lock, htmid=int(htmid),
+                               n_obs=n_obs, cost=cost, status='done',
+                               n_rows=int(n_rows), elapsed=time.time()-t_start)
+        result_queue.put((htmid, n_rows))
+
+
 class AlertDataGenerator(object):
     """
     This class will read in astrophysical sources and variability
@@ -440,6 +707,9 @@ class AlertDataGenerator(object):
     alert_data_from_htmid on each of the htmid in the class property
     htmid_list.  This last step can easily be parallelized using python's
     multiprocessing module, with each process handling a different htmid.
+    run_parallel does exactly that, handing the most expensive trixels
+    out first to whichever process is free (optionally splitting them
+    into their finer HTM children).
 
     The sqlite files produced by alert_data_from_htmid will each contain
     four tables.  They are as follows.  Columns are listed below the
@@ -519,6 +789,12 @@ class AlertDataGenerator(object):
 
     """
 
+    # the margin (in radians) added to the radius of the focal plane
+    # when rejecting objects that are too far from a pointing to land
+    # on a detector (this absorbs aberration, refraction and the
+    # difference between angular separation and pupil coordinates)
+    _focal_plane_margin = np.radians(0.25)
+
     def __init__(self,
                  testing=False):
         """
@@ -532,6 +808,9 @@ class AlertDataGenerator(object):
 
         self._variability_cache = create_variability_cache()
         self._stdout_lock = None
+        self._focal_plane_footprint = None
+        self._n_focal_plane_tested = 0
+        self._n_focal_plane_rejected = 0
         if not testing:
             plm = ParametrizedLightCurveMixin()
             plm.load_parametrized_light_curves(variability_cache = self._variability_cache)
@@ -556,6 +835,15 @@ class AlertDataGenerator(object):
             else:
                 self._dmag_lookup_file_exists = False
 
+    def _get_focal_plane_footprint(self):
+        """
+        Return the bitmap of the LSST focal plane used to reject objects
+        before looking up their chip names (see _lsst_focal_plane_footprint)
+        """
+        if self._focal_plane_footprint is None:
+            self._focal_plane_footprint = _lsst_focal_plane_footprint()
+        return self._focal_plane_footprint
+
     def acquire_lock(self):
         """
         If running with multiprocessing, acquire
@@ -688,59 +976,216 @@ class AlertDataGenerator(object):
         """
         return self._obs_list[self._htmid_dict[htmid]]
 
-    def _output_alert_data(self, conn, data_cache):
+    def _split_htmid(self, htmid):
+        """
+        Find the observations intersecting each of the four children
+        of the trixel specified by htmid and add the children to
+        self._htmid_dict.  Return the list of children which are
+        intersected by any observation.
         """
-        Write a cache of alert data to the sqlite file currently open.
+        parent_dex = self._htmid_dict[htmid]
+        halfspace_list = [halfSpaceFromRaDec(obs.pointingRA, obs.pointingDec, obs.boundLength)
+                          for obs in self._obs_list[parent_dex]]
+        child_list = []
+        for i_child in range(4):
+            child = (htmid << 2) + i_child
+            trixel = trixelFromHtmid(child)
+            child_dex = [obs_dex for obs_dex, hs in zip(parent_dex, halfspace_list)
+                         if hs.contains_trixel(trixel) != 'outside']
+            if len(child_dex) == 0:
+                continue
+            self._htmid_dict[child] = np.array(child_dex)
+            child_list.append(child)
+        return child_list
+
+    def parallel_task_list(self, n_obj_dict=None, split_cost=None, max_split_level=21,
+                           count_objects=None):
+        """
+        Assemble the list of trixels to be simulated by run_parallel,
+        ordered from the most to the least expensive.
+
+        Must run subdivide_obs in order for this method to
+        work.
 
         Parameters
         ----------
-        conn is the connection to the sqlite file (already open)
+        n_obj_dict is an optional dict mapping htmid to the number of
+        objects in the trixel (e.g. from a SELECT COUNT(*) on the database).
+        Unless count_objects is given, it must contain every htmid in
+        self.htmid_list; it may also contain the htmids of their children.
+
+        split_cost is an optional cost above which trixels are replaced
+        by their four HTM children (recursively).  Children which no
+        observation intersects are dropped.
 
-        data_cache is a dict containing all of the data to be written.
-        It will keyed on a string like 'i_j' where i is the obshistID
-        of an OpSim pointing and j is an arbitrary integer.  That key
-        will lead to another dict keyed on the columns being output to
-        the sqlite file.  The values of this second layer of dict are
-        numpy arrays.
+        max_split_level is the finest HTM level to which trixels will be
+        split (default 21, the level of the htmids in the database)
+
+        count_objects is an optional callable taking an htmid and
+        returning the number of objects in that trixel (e.g.
+        StellarAlertDBObjMixin.count_htmid).  It is called for every
+        trixel, including split children, which is not in n_obj_dict.
+
+        If neither n_obj_dict nor count_objects knows a trixel, a child
+        is assumed to contain a quarter of its parent's objects and a
+        trixel in self.htmid_list is assumed to contain one object (so
+        that its cost is its number of observations).
 
         Returns
         -------
-        The number of rows written to the sqlite file
+        A list of (htmid, cost) tuples, where cost is the number of
+        objects times the number of observations in the trixel,
+        sorted by decreasing cost.  Each htmid can be passed to
+        alert_data_from_htmid, n_obs and obs_from_htmid.
         """
+        if n_obj_dict is not None and count_objects is None:
+            missing = [htmid for htmid in self._htmid_list if htmid not in n_obj_dict]
+            if len(missing) > 0:
+                raise RuntimeError('n_obj_dict has no entry for htmid %s' % str(missing))
+
+        def n_obj_from_htmid(htmid, default):
+            if n_obj_dict is not None and htmid in n_obj_dict:
+                return float(n_obj_dict[htmid])
+            if count_objects is not None:
+                return float(count_objects(htmid))
+            return default
+
+        task_list = []
+        to_process = []
+        for htmid in self._htmid_list:
+            to_process.append((htmid, n_obj_from_htmid(htmid, 1.0)))
+
+        while len(to_process) > 0:
+            htmid, n_obj = to_process.pop()
+            cost = n_obj*self.n_obs(htmid)
+            if (split_cost is not None and cost > split_cost and
+                levelFromHtmid(htmid) < max_split_level):
+
+                for child in self._split_htmid(htmid):
+                    to_process.append((child, n_obj_from_htmid(child, 0.25*n_obj)))
+                continue
+
+            task_list.append((htmid, cost))
+
+        return sorted(task_list, key=lambda task: (-task[1], task[0]))
+
+    def run_parallel(self, dbobj_factory, n_proc, log_file_name,
+                     progress_file_name=None,
+                     n_obj_dict=None, split_cost=None, max_split_level=21,
+                     **kwargs):
+        """
+        Run alert_data_from_htmid on every trixel in self.htmid_list
+        (or on their children, if split) using n_proc independent processes.
 
-        cursor = conn.cursor()
-        n_rows_0 = cursor.execute('SELECT COUNT(uniqueId) FROM alert_data').fetchall()
+        The trixels (see parallel_task_list) are put on a queue from
+        the most to the least expensive; each process pulls the next
+        trixel off of the queue as soon as it is done with its last one.
 
-        chunk_lengths = np.zeros(len(data_cache))
+        Must run subdivide_obs in order for this method to
+        work.
 
-        for i_cache_tag, cache_tag in enumerate(data_cache):
-            obshistid = int(cache_tag.split('_')[0])
-            n_obj = len(data_cache[cache_tag]['uniqueId'])
-            chunk_lengths[i_cache_tag] = n_obj
+        Parameters
+        ----------
+        dbobj_factory is a callable taking no arguments and returning
+        the CatalogDBObject to be passed to alert_data_from_htmid (each
+        process creates its own connection to the database)
+
+        n_proc is the number of processes to run
+
+        log_file_name is the name of the text file passed to
+        alert_data_from_htmid
+
+        progress_file_name is the name of the file to which a JSON record
+        (one per line) is appended each time a trixel is queued, started,
+        done or failed.  Records contain htmid, pid, n_obs, cost, status
+        and time; 'done' records also contain n_rows and elapsed (seconds);
+        'failed' records also contain elapsed and error.  If None, it is
+        log_file_name with '_progress.json' appended.
+
+        n_obj_dict, split_cost and max_split_level are passed to
+        parallel_task_list.  If the CatalogDBObject returned by
+        dbobj_factory has a count_htmid method (e.g. StellarAlertDBObj),
+        the number of objects in each trixel (including split children)
+        which is not in n_obj_dict is found with a SELECT COUNT(*) on
+        the database.
+
+        If trixels are split, the output files are named after the htmids
+        of the children and var_param_store_dir (if any) must contain stores
+        written for the children.  self.htmid_list still lists the parents;
+        the keys of the returned dict are the htmids actually simulated
+        (e.g. to pass to AvroAlertGenerator.write_alerts_by_trixel).
+
+        kwargs are passed to alert_data_from_htmid (e.g. photometry_class,
+        output_dir, output_prefix, dmag_cutoff, chunk_size, output_format)
 
-            values = ((int(data_cache[cache_tag]['uniqueId'][i_obj]),
-                      obshistid,
-                      data_cache[cache_tag]['xPix'][i_obj],
-                      data_cache[cache_tag]['yPix'][i_obj],
-                      int(data_cache[cache_tag]['chipNum'][i_obj]),
-                      data_cache[cache_tag]['dflux'][i_obj],
-                      data_cache[cache_tag]['SNR'][i_obj],
-                      np.degrees(data_cache[cache_tag]['raICRS'][i_obj]),
-                      np.degrees(data_cache[cache_tag]['decICRS'][i_obj]))
-                      for i_obj in range(n_obj))
-            cursor.executemany('INSERT INTO alert_data VALUES (?,?,?,?,?,?,?,?,?)', values)
-        conn.commit()
+        Returns
+        -------
+        A dict mapping each simulated htmid to the number of rows
+        written to its alert_data table (None if the trixel failed)
+        """
+        if 'lock' in kwargs:
+            raise RuntimeError('run_parallel creates its own lock')
+
+        if progress_file_name is None:
+            progress_file_name = '%s_progress.json' % log_file_name
+
+        count_objects = None
+        dbobj = dbobj_factory()
+        if hasattr(dbobj, 'count_htmid'):
+            count_objects = dbobj.count_htmid
+
+        task_list = self.parallel_task_list(n_obj_dict=n_obj_dict,
+                                            split_cost=split_cost,
+                                            max_split_level=max_split_level,
+                                            count_objects=count_objects)
+
+        kwargs['log_file_name'] = log_file_name
+
+        lock = mproc.Lock()
+        task_queue = mproc.Queue()
+        result_queue = mproc.Queue()
+        for htmid, cost in task_list:
+            _write_progress_record(progress_file_name, None, htmid=int(htmid),
+                                   n_obs=self.n_obs(htmid), cost=cost, status='queued')
+            task_queue.put((htmid, cost))
+        for i_p in range(n_proc):
+            task_queue.put(None)
+
+        p_list = []
+        for i_p in range(n_proc):
+            p = mproc.Process(target=_run_parallel_worker,
+                              args=(self, dbobj_factory, task_queue, result_queue,
+                                    lock, progress_file_name, kwargs))
+            p.start()
+            p_list.append(p)
+
+        # drain the results before joining so that no process
+        # blocks on a full result_queue
+        results = {}
+        while len(results) < len(task_list):
+            try:
+                htmid, n_rows = result_queue.get(timeout=1.0)
+            except Empty:
+                if not any([p.is_alive() for p in p_list]) and result_queue.empty():
+                    break
+                continue
+            results[htmid] = n_rows
 
-        n_rows_1 = cursor.execute('SELECT COUNT(uniqueId) FROM alert_data').fetchall()
-        conn.commit()
-        n_written = (n_rows_1[0][0]-n_rows_0[0][0])
+        for p in p_list:
+            p.join()
 
-        return n_written
+        # trixels lost to a process which died without reporting
+        for htmid, cost in task_list:
+            if htmid not in results:
+                results[htmid] = None
+
+        return results
 
     def _filter_on_photometry_then_chip_name(self, chunk, column_query,
                                              obs_valid_dex, expmjd_list,
                                              photometry_catalog,
-                                             dmag_cutoff):
+                                             dmag_cutoff, param_store=None,
+                                             context_list=None):
         """
         Determine which simulated observations are actually worth storing
         by first figuring out which observations of which objects are
@@ -766,6 +1211,16 @@ class AlertDataGenerator(object):
         photometry_catalog is an instantiation of the InstanceCatalog class
         being used to calculate magnitudes for these variable sources.
 
+        dmag_cutoff indicates the minimum change magnitude needed to trigger a
+        simulated alert
+
+        param_store is an optional VariabilityParamStore from which to read
+        the variability parameters of the sources (instead of decoding
+        chunk['varParamStr'])
+
+        context_list is an optional list of the AlertObservationContexts
+        corresponding to obs_valid_dex (built here if None)
+
         Outputs
         -------
         chip_name_dict is a dict keyed on i_obs (which is the index of
@@ -777,8 +1232,10 @@ class AlertDataGenerator(object):
               on any detector)
 
              - a list of the xPupil coords for every object in chunk
+               (zero for objects rejected by the focal plane prefilter)
 
              - a list of the yPupil coords for every object in chunk
+               (zero for objects rejected by the focal plane prefilter)
 
              - a list of the indexes in chunk of those objects which actually
                landed on a detector
@@ -796,28 +1253,32 @@ class AlertDataGenerator(object):
         combination are valid.
         """
 
+        if context_list is None:
+            context_list = [AlertObservationContext(self._obs_list[obs_dex])
+                            for obs_dex in obs_valid_dex]
+
         ######################################################
         # Calculate the delta_magnitude for all of the sources
         #
         photometry_catalog._set_current_chunk(chunk)
-        dmag_arr = photometry_catalog.applyVariability(chunk['varParamStr'],
-                                                       variability_cache=self._variability_cache,
-                                                       expmjd=expmjd_list).transpose((2, 0, 1))
+        if param_store is None:
+            var_params = chunk['varParamStr']
+        else:
+            var_params = chunk['simobjid']
+        # dmag_arr holds every observation anyway, so evaluate all of the
+        # epochs in one block (models like applyAgn cannot be split in time);
+        # iter_variability still avoids a second (band, object, time) copy
+        n_raw_obj = len(chunk)
+        dmag_arr = np.zeros((len(expmjd_list), 6, n_raw_obj), dtype=float)
+        for obj_slice, time_slice, dmag_tile in photometry_catalog.iter_variability(var_params, expmjd_list,
+                                                                                   time_block_size=max(len(expmjd_list), 1),
+                                                                                   variability_cache=self._variability_cache,
+                                                                                   param_store=param_store):
+            dmag_arr[time_slice, :, obj_slice] = dmag_tile.transpose(2, 0, 1)
 
         dmag_arr_transpose = dmag_arr.transpose(2, 1, 0)
 
-        n_raw_obj = len(chunk)
-        photometrically_valid = -1*np.ones(n_raw_obj, dtype=int)
-        for i_obj in range(n_raw_obj):
-            keep_it = False
-            for i_filter in range(6):
-                if np.abs(dmag_arr_transpose[i_obj][i_filter]).max() >= dmag_cutoff:
-                    keep_it = True
-                    break
-            if keep_it:
-                photometrically_valid[i_obj] = 1
-
-        photometrically_valid = np.where(photometrically_valid >= 0)
+        photometrically_valid = np.where((np.abs(dmag_arr) >= dmag_cutoff).any(axis=(0, 1)))
 
         if 'properMotionRa'in column_query:
             pmra = chunk['properMotionRa'][photometrically_valid]
@@ -841,31 +1302,62 @@ class AlertDataGenerator(object):
         time_arr_transpose = -1*np.ones((len(obs_valid_dex), len(chunk['raJ2000'])),
                                         dtype=int)
 
+        # Before computing pupil coordinates and looking up chip names, reject
+        # the objects that are too far from the pointing to land on the focal
+        # plane (allowing for how far their proper motion and parallax could
+        # have moved them since J2000), and then those whose pupil coordinates
+        # fall outside the bitmap of the focal plane.
+        footprint = self._get_focal_plane_footprint()
+        ra_valid = chunk['raJ2000'][photometrically_valid]
+        dec_valid = chunk['decJ2000'][photometrically_valid]
+        max_separation = footprint['max_radius'] + self._focal_plane_margin
+        if pmra is not None:
+            total_pm = np.sqrt(np.power(pmra, 2) + np.power(pmdec, 2))
+
         for i_obs, obs_dex in enumerate(obs_valid_dex):
             obs = self._obs_list[obs_dex]
+            context = context_list[i_obs]
             chip_name_list = np.array([None]*n_raw_obj)
             xpup_list = np.zeros(n_raw_obj, dtype=float)
             ypup_list = np.zeros(n_raw_obj, dtype=float)
-            chip_int_arr = -1*np.ones(len(chip_name_list), dtype=int)
 
             if len(photometrically_valid[0]) > 0:
-                xpup_list_val, ypup_list_val = _pupilCoordsFromRaDec(chunk['raJ2000'][photometrically_valid],
-                                                                     chunk['decJ2000'][photometrically_valid],
-                                                                     pm_ra=pmra, pm_dec=pmdec,
-                                                                     parallax=px, v_rad=vrad,
-                                                                     obs_metadata=obs)
-
-                xpup_list[photometrically_valid] = xpup_list_val
-                ypup_list[photometrically_valid] = ypup_list_val
-
-                chip_name_list[photometrically_valid] = chipNameFromPupilCoordsLSST(xpup_list_val,
-                                                                                    ypup_list_val)
-
-                for i_chip, name in enumerate(chip_name_list):
-                    if name is not None:
-                        chip_int_arr[i_chip] = 1
-
-            valid_obj = np.where(chip_int_arr > 0)
+                local_max_separation = max_separation
+                if pmra is not None:
+                    local_max_separation = (max_separation + total_pm*context.years_from_j2000 +
+                                            np.abs(px))
+
+                near = np.where(_angularSeparation(ra_valid, dec_valid,
+                                                   context.ra_pointing_icrs,
+                                                   context.dec_pointing_icrs) <=
+                                local_max_separation)[0]
+
+                if len(near) > 0:
+                    if pmra is not None:
+                        pm_kwargs = {'pm_ra': pmra[near], 'pm_dec': pmdec[near],
+                                     'parallax': px[near], 'v_rad': vrad[near]}
+                    else:
+                        pm_kwargs = {}
+
+                    xpup_near, ypup_near = _pupilCoordsFromRaDec(ra_valid[near], dec_valid[near],
+                                                                 obs_metadata=obs, **pm_kwargs)
+
+                    in_footprint = np.where(_in_focal_plane_footprint(xpup_near, ypup_near,
+                                                                      footprint))[0]
+                else:
+                    in_footprint = np.array([], dtype=int)
+
+                self._n_focal_plane_tested += len(photometrically_valid[0])
+                self._n_focal_plane_rejected += len(photometrically_valid[0]) - len(in_footprint)
+
+                if len(in_footprint) > 0:
+                    candidates = photometrically_valid[0][near[in_footprint]]
+                    xpup_list[candidates] = xpup_near[in_footprint]
+                    ypup_list[candidates] = ypup_near[in_footprint]
+                    chip_name_list[candidates] = chipNameFromPupilCoordsLSST(xpup_near[in_footprint],
+                                                                             ypup_near[in_footprint])
+
+            valid_obj = np.where(np.not_equal(chip_name_list, None))
             time_arr_transpose[i_obs][valid_obj] = 1
 
             chip_name_dict[i_obs] = (chip_name_list,
@@ -885,7 +1377,10 @@ class AlertDataGenerator(object):
                               log_file_name=None,
                               photometry_class=None,
                               chunk_cutoff=-1,
-                              lock=None):
+                              lock=None,
+                              var_param_store_dir=None,
+                              output_format='sqlite',
+                              checkpoint=False):
 
         """
         Generate an sqlite file with all of the alert data for a given
@@ -927,6 +1422,32 @@ class AlertDataGenerator(object):
         lock is a multiprocessing.Lock() for use if running multiple
         instances of alert_data_from_htmid.  This will prevent multiple processes
         from writing to the log file or stdout simultaneously.
+
+        var_param_store_dir is an optional directory containing a
+        VariabilityParamStore written for this htmid by
+        write_variability_param_store().  If specified, variability
+        parameters are read from the store rather than decoded from
+        varParamStr.
+
+        output_format is 'sqlite' (the default; write the file
+        output_dir/output_prefix_htmid_sqlite.db), 'npy' (write the
+        directory of columnar files output_dir/output_prefix_htmid_npy;
+        see alertDataWriters.py) or 'npz' (the same directory, with each
+        part written as a compressed .npz file)
+
+        checkpoint is a boolean.  If True, objects are queried in order of
+        simobjid and every write to the sqlite file records the largest
+        simobjid whose output has been completely written.  If the sqlite
+        file of a previous, interrupted run with checkpoint=True exists,
+        the simulation resumes after its last checkpoint (if that run
+        was complete, nothing is simulated).  Only supported for the
+        sqlite output_format and CatalogDBObjects with a simobjid column
+        whose query_columns_htmid accepts order_by
+        (see StellarAlertDBObjMixin).
+
+        Returns
+        -------
+        The number of rows in the alert_data table
         """
 
         htmid_level = levelFromHtmid(htmid)
@@ -948,6 +1469,8 @@ class AlertDataGenerator(object):
 
         self._stdout_lock = lock
         this_pid = os.getpid()
+        self._n_focal_plane_tested = 0
+        self._n_focal_plane_rejected = 0
 
         t_start = time.time()  # so that we can get a sense of how long the full
                                # simulation will take
@@ -1014,36 +1537,43 @@ class AlertDataGenerator(object):
         obs_valid_dex = self._htmid_dict[htmid]
         print('n valid obs %d' % len(obs_valid_dex))
 
-        cat_list = []
         expmjd_list = []
-        mag_name_to_int = {'u': 0, 'g': 1, 'r': 2,
-                           'i': 3, 'z': 4, 'y': 5}
         for obs_dex in obs_valid_dex:
-            obs = self._obs_list[obs_dex]
-            cat = photometry_class(dbobj, obs_metadata=obs)
-            cat.lsstBandpassDict = self.bp_dict
-            cat_list.append(cat)
-            expmjd_list.append(obs.mjd.TAI)
+            expmjd_list.append(self._obs_list[obs_dex].mjd.TAI)
 
         expmjd_list = np.array(expmjd_list)
-        cat_list = np.array(cat_list)
         sorted_dex = np.argsort(expmjd_list)
 
         expmjd_list = expmjd_list[sorted_dex]
-        cat_list = cat_list[sorted_dex]
         obs_valid_dex = obs_valid_dex[sorted_dex]
 
+        # everything that differs between observations lives in
+        # context_list; a single catalog is switched between them
+        # to calculate the output columns
+        context_list = [AlertObservationContext(self._obs_list[obs_dex])
+                        for obs_dex in obs_valid_dex]
+        output_catalog = photometry_class(dbobj, obs_metadata=self._obs_list[obs_valid_dex[0]])
+        output_catalog.lsstBandpassDict = self.bp_dict
+
         available_columns = list(dbobj.columnMap.keys())
         column_query = []
         for col in desired_columns:
             if col in available_columns:
                 column_query.append(col)
 
-        n_bits_off = 2*(21-htmid_level)
+        if var_param_store_dir is None:
+            param_store = None
+        else:
+            if 'simobjid' not in column_query:
+                raise RuntimeError('Cannot use a VariabilityParamStore with '
+                                   'a CatalogDBObject that has no simobjid column')
+            param_store = VariabilityParamStore(var_param_store_dir, htmid=htmid)
+
+        if checkpoint and 'simobjid' not in column_query:
+            raise RuntimeError('Cannot checkpoint with a CatalogDBObject '
+                               'that has no simobjid column')
 
-        data_iter = dbobj.query_columns_htmid(colnames=column_query,
-                                              htmid=htmid,
-                                              chunk_size=chunk_size)
+        n_bits_off = 2*(21-htmid_level)
 
         photometry_catalog = photometry_class(dbobj, self._obs_list[obs_valid_dex[0]],
                                               column_outputs=['lsst_u',
@@ -1067,45 +1597,48 @@ class AlertDataGenerator(object):
                                     # "iterating over astrophysical objects" part
                                     # of the simulation will take
 
-        db_name = os.path.join(output_dir, '%s_%d_sqlite.db' % (output_prefix, htmid))
-        with sqlite3.connect(db_name, isolation_level='EXCLUSIVE') as conn:
-            creation_cmd = '''CREATE TABLE alert_data
-                           (uniqueId int, obshistId int, xPix float, yPix float,
-                            chipNum int, dflux float, snr float, ra float, dec float)'''
-
-            cursor = conn.cursor()
-            cursor.execute('PRAGMA journal_mode=WAL;')
-            conn.commit()
-            cursor.execute(creation_cmd)
-            conn.commit()
-
-            creation_cmd = '''CREATE TABLE metadata
-                           (obshistId int, TAI float, band int)'''
-            cursor.execute(creation_cmd)
-            conn.commit()
-
-            for obs_dex in obs_valid_dex:
-                obs = self._obs_list[obs_dex]
-                cmd = '''INSERT INTO metadata
-                      VALUES(%d, %.5f, %d)''' % (obs.OpsimMetaData['obsHistID'],
-                                                 obs.mjd.TAI,
-                                                 mag_name_to_int[obs.bandpass])
-
-                cursor.execute(cmd)
-            conn.commit()
-
-            creation_cmd = '''CREATE TABLE quiescent_flux
-                          (uniqueId int, band int, flux float, snr float)'''
-
-            cursor.execute(creation_cmd)
-            conn.commit()
-
-            creation_cmd = '''CREATE TABLE baseline_astrometry
-                           (uniqueId int, ra real, dec real, pmRA real,
-                            pmDec real, parallax real, TAI real)'''
-
-            cursor.execute(creation_cmd)
-            conn.commit()
+        # when checkpointing, objects are processed in order of simobjid
+        # so that everything up to last_simobjid has been written at
+        # each checkpoint
+        query_kwargs = {}
+        if checkpoint:
+            query_kwargs['order_by'] = 'simobjid'
+        last_simobjid = -1
+
+        writer_class = alert_data_writer_class(output_format)
+        with writer_class(output_dir, output_prefix, htmid, checkpoint=checkpoint) as writer:
+            if writer.complete:
+                self.acquire_lock()
+                with open(log_file_name, 'a') as out_file:
+                    out_file.write('htmid %d was already complete\n' % htmid)
+                self.release_lock()
+                return writer.n_rows
+
+            if writer.last_checkpoint is None:
+                writer.write_metadata(np.array([context.obshistid for context in context_list]),
+                                      expmjd_list,
+                                      np.array([context.i_band for context in context_list]))
+                data_iter = dbobj.query_columns_htmid(colnames=column_query,
+                                                      htmid=htmid,
+                                                      chunk_size=chunk_size,
+                                                      **query_kwargs)
+            else:
+                # resume after the objects whose output was written
+                i_chunk = writer.last_checkpoint['i_chunk']
+                last_simobjid = writer.last_checkpoint['simobjid']
+                n_rows = writer.n_rows
+                self.acquire_lock()
+                with open(log_file_name, 'a') as out_file:
+                    out_file.write('resuming htmid %d after simobjid %d (chunk %d; %d rows)\n' %
+                                   (htmid, last_simobjid, i_chunk, n_rows))
+                self.release_lock()
+                data_iter = dbobj.query_columns_htmid(colnames=column_query,
+                                                      htmid=htmid,
+                                                      chunk_size=chunk_size,
+                                                      constraint='%s > %d' %
+                                                      (dbobj.columnMap['simobjid'],
+                                                       last_simobjid),
+                                                      **query_kwargs)
 
             for chunk in data_iter:
                 n_raw_obj = len(chunk)
@@ -1114,6 +1647,9 @@ class AlertDataGenerator(object):
                 if chunk_cutoff > 0 and i_chunk >= chunk_cutoff:
                     break
 
+                if checkpoint and n_raw_obj > 0:
+                    last_simobjid = chunk['simobjid'].max()
+
                 n_time_last = 0
                 # filter the chunk so that we are only considering sources that are in
                 # the trixel being considered
@@ -1133,7 +1669,9 @@ class AlertDataGenerator(object):
                                                                        obs_valid_dex,
                                                                        expmjd_list,
                                                                        photometry_catalog,
-                                                                       dmag_cutoff)
+                                                                       dmag_cutoff,
+                                                                       param_store=param_store,
+                                                                       context_list=context_list)
 
                 q_f_dict = {}
                 q_m_dict = {}
@@ -1192,21 +1730,11 @@ class AlertDataGenerator(object):
                 # each object (in self._filter_on_photometry_then_chip_name(),
                 # we assumed that every object was detected at every time step).
 
-                photometrically_valid_obj = []
-                for i_obj in range(len(chunk)):
-                    keep_it = False
-                    valid_times = np.where(time_arr[i_obj] > 0)
-                    if len(valid_times[0]) == 0:
-                        continue
-                    for i_filter in range(len(mag_names)):
-                        if np.abs(dmag_arr_transpose[i_obj][i_filter][valid_times]).max() > dmag_cutoff:
-                            dmag_min = dmag_arr_transpose[i_obj][i_filter][valid_times].min()
-                            if q_m_dict[i_filter][i_obj] + dmag_min <= obs_mag_cutoff[i_filter]:
-                                keep_it = True
-                                break
-                    if keep_it:
-                        photometrically_valid_obj.append(i_obj)
-                photometrically_valid_obj = np.array(photometrically_valid_obj)
+                photometrically_valid_obj = _detectable_variability_mask(dmag_arr_transpose, time_arr,
+                                                                         np.array([q_m_dict[i_filter]
+                                                                                   for i_filter
+                                                                                   in range(len(mag_names))]),
+                                                                         dmag_cutoff, obs_mag_cutoff)
 
                 del dmag_arr_transpose
                 gc.collect()
@@ -1219,18 +1747,15 @@ class AlertDataGenerator(object):
                 ############################
                 # Process and output sources
                 #
-                for i_obs, obs_dex in enumerate(obs_valid_dex):
-                    obs = self._obs_list[obs_dex]
-                    obshistid = obs.OpsimMetaData['obsHistID']
-
-                    obs_mag = obs.bandpass
-                    actual_i_mag = mag_name_to_int[obs_mag]
-                    assert mag_names[actual_i_mag] == obs_mag
+                for i_obs, context in enumerate(context_list):
+                    obshistid = context.obshistid
+                    assert mag_names[context.i_band] == context.bandpass
 
                     # only include those sources which fall on a detector for this pointing
                     valid_chip_name, valid_xpup, valid_ypup, chip_valid_obj = chip_name_dict[i_obs]
 
-                    actually_valid_obj = np.intersect1d(photometrically_valid_obj, chip_valid_obj)
+                    actually_valid_obj = np.where(np.logical_and(photometrically_valid_obj,
+                                                                 time_arr[:, i_obs] > 0))[0]
                     if len(actually_valid_obj) == 0:
                         continue
 
@@ -1252,10 +1777,10 @@ class AlertDataGenerator(object):
                     local_column_cache['pupilFromSky'] = OrderedDict([('x_pupil', valid_xpup[actually_valid_obj]),
                                                                       ('y_pupil', valid_ypup[actually_valid_obj])])
 
-                    cat = cat_list[i_obs]
+                    output_catalog.set_observation_context(context_list[i_obs])
                     i_valid_chunk = 0
-                    for valid_chunk, chunk_map in cat.iter_catalog_chunks(query_cache=[valid_sources],
-                                                                          column_cache=local_column_cache):
+                    for valid_chunk, chunk_map in output_catalog.iter_catalog_chunks(query_cache=[valid_sources],
+                                                                                     column_cache=local_column_cache):
                         i_valid_chunk += 1
                         assert i_valid_chunk == 1
                         n_time_last += len(valid_chunk[0])
@@ -1270,26 +1795,24 @@ class AlertDataGenerator(object):
 
                         n_rows_cached += length_of_chunk
 
+                # these rows are written along with the next
+                # flush of output_data_cache
                 completely_valid = np.where(completely_valid > 0)
-                for i_filter in range(6):
-                    values = ((int(unq[completely_valid][i_q]),
-                               i_filter,
-                               q_f_dict[i_filter][completely_valid][i_q],
-                               q_snr_dict[i_filter][completely_valid][i_q])
-                              for i_q in range(len(completely_valid[0])))
-                    cursor.executemany('INSERT INTO quiescent_flux VALUES (?,?,?,?)', values)
-                    conn.commit()
-
-                values = ((int(unq[completely_valid][i_q]),
-                           q_ra[completely_valid][i_q],
-                           q_dec[completely_valid][i_q],
-                           q_pmra[completely_valid][i_q],
-                           q_pmdec[completely_valid][i_q],
-                           q_parallax[completely_valid][i_q],
-                           q_tai)
-                          for i_q in range(len(completely_valid[0])))
-
-                cursor.executemany('INSERT INTO baseline_astrometry VALUES (?,?,?,?,?,?,?)', values)
+                valid_unq = unq[completely_valid]
+                writer.write_quiescent_flux(np.tile(valid_unq, 6),
+                                            np.repeat(np.arange(6), len(valid_unq)),
+                                            np.concatenate([q_f_dict[i_filter][completely_valid]
+                                                            for i_filter in range(6)]),
+                                            np.concatenate([q_snr_dict[i_filter][completely_valid]
+                                                            for i_filter in range(6)]))
+
+                writer.write_baseline_astrometry(valid_unq,
+                                                 q_ra[completely_valid],
+                                                 q_dec[completely_valid],
+                                                 q_pmra[completely_valid],
+                                                 q_pmdec[completely_valid],
+                                                 q_parallax[completely_valid],
+                                                 q_tai)
 
                 if n_rows_cached >= write_every:
                     self.acquire_lock()
@@ -1300,7 +1823,8 @@ class AlertDataGenerator(object):
 
                     self.release_lock()
 
-                    n_rows += self._output_alert_data(conn, output_data_cache)
+                    n_rows += writer.write_alert_data(output_data_cache,
+                                                      i_chunk=i_chunk, simobjid=last_simobjid)
                     output_data_cache = {}
                     n_rows_cached = 0
 
@@ -1329,7 +1853,8 @@ class AlertDataGenerator(object):
                         self.release_lock()
 
             if len(output_data_cache) > 0:
-                n_rows += self._output_alert_data(conn, output_data_cache)
+                n_rows += writer.write_alert_data(output_data_cache,
+                                                  i_chunk=i_chunk, simobjid=last_simobjid)
                 output_data_cache = {}
 
             print('htmid %d that took %.2e hours; n_obj %d n_rows %d' %
@@ -1339,16 +1864,17 @@ class AlertDataGenerator(object):
             print("INDEXING %d" % htmid)
             self.release_lock()
 
-            cursor.execute('CREATE INDEX unq_obs ON alert_data (uniqueId, obshistId)')
-            cursor.execute('CREATE INDEX unq_flux ON quiescent_flux (uniqueId, band)')
-            cursor.execute('CREATE INDEX obs ON metadata (obshistid)')
-            cursor.execute('CREATE INDEX unq_ast ON baseline_astrometry (uniqueId)')
-            conn.commit()
-
-            self.acquire_lock()
-            with open(log_file_name, 'a') as out_file:
-                out_file.write('done with htmid %d -- %e %d\n' %
-                               (htmid, (time.time()-t_start)/3600.0, n_obj))
-            self.release_lock()
+        # leaving the with block indexes and closes the output
+
+        self.acquire_lock()
+        with open(log_file_name, 'a') as out_file:
+            out_file.write('done with htmid %d -- %e %d\n' %
+                           (htmid, (time.time()-t_start)/3600.0, n_obj))
+            if self._n_focal_plane_tested > 0:
+                out_file.write('    %d of %d (%.2e) object-observation pairs were '
+                               'off the focal plane\n' %
+                               (self._n_focal_plane_rejected, self._n_focal_plane_tested,
+                                float(self._n_focal_plane_rejected)/self._n_focal_plane_tested))
+        self.release_lock()
 
         return n_rows
@@ -0,0 +1,789 @@
+"""
+This module defines the backends with which AlertDataGenerator writes
+the data for each trixel, and the reader for the columnar backend.
+
+Both backends write the same four tables (see the docstring of
+AlertDataGenerator for their contents)
+
+    alert_data -- uniqueId, obshistId, xPix, yPix, chipNum, dflux, snr, ra, dec
+    metadata -- obshistId, TAI, band
+    quiescent_flux -- uniqueId, band, flux, snr
+    baseline_astrometry -- uniqueId, ra, dec, pmRA, pmDec, parallax, TAI
+
+SqliteAlertDataWriter writes them to the file
+
+    output_dir/output_prefix_htmid_sqlite.db
+
+If asked to checkpoint, it also writes the table
+
+    checkpoint -- i_chunk, simobjid, n_rows, complete
+
+with one row committed in the same transaction as each write of
+alert_data: the number of database chunks and the largest simobjid
+whose output has been written, the total number of alert_data rows
+written, and whether the file is complete.  A partially written file
+can then be reopened and appended to without duplicating any rows.
+
+NpyAlertDataWriter writes them to the directory
+
+    output_dir/output_prefix_htmid_npy/
+
+as one .npy file per column per chunk of rows
+
+    table_name/partition/part_NNNNNN/column_name.npy
+
+(or, for NpzAlertDataWriter, one compressed part_NNNNNN.npz per
+chunk).  alert_data is
+partitioned by obshistId (partition 'obshistid_NNN'); the other tables
+have a single partition named 'all'.  An index.json file lists the
+parts of each partition and their number of rows.  The directory is
+written under a temporary name and only moved into place once it is
+complete.  NpyAlertDataReader reads it back, memory-mapping the
+uncompressed column files and only touching the alert_data partitions
+of the obsHistIDs it is asked for.
+"""
+
+import os
+import json
+import shutil
+import sqlite3
+import itertools
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ["SqliteAlertDataWriter", "NpyAlertDataWriter",
+           "NpzAlertDataWriter", "NpyAlertDataReader",
+           "alert_data_writer_class"]
+
+
+_ALERT_DATA_COLUMNS = OrderedDict([('alert_data', (('uniqueId', np.int64),
+                                                   ('obshistId', np.int64),
+                                                   ('xPix', float),
+                                                   ('yPix', float),
+                                                   ('chipNum', np.int64),
+                                                   ('dflux', float),
+                                                   ('snr', float),
+                                                   ('ra', float),
+                                                   ('dec', float))),
+                                   ('metadata', (('obshistId', np.int64),
+                                                 ('TAI', float),
+                                                 ('band', np.int64))),
+                                   ('quiescent_flux', (('uniqueId', np.int64),
+                                                       ('band', np.int64),
+                                                       ('flux', float),
+                                                       ('snr', float))),
+                                   ('baseline_astrometry', (('uniqueId', np.int64),
+                                                            ('ra', float),
+                                                            ('dec', float),
+                                                            ('pmRA', float),
+                                                            ('pmDec', float),
+                                                            ('parallax', float),
+                                                            ('TAI', float)))])
+
+
+def _rows_from_columns(*columns):
+    """
+    Convert a set of columns into the rows passed to sqlite3's executemany
+
+    Parameters
+    ----------
+    columns are numpy arrays (all of the same length) or scalars (which
+    are repeated in every row)
+
+    Returns
+    -------
+    An iterator over tuples of native python types (sqlite3 does not
+    know how to bind numpy scalars), one per row.  The conversion is
+    done one whole column at a time.
+    """
+    n_rows = 0
+    for col in columns:
+        if np.ndim(col) > 0:
+            n_rows = len(col)
+            break
+
+    converted = []
+    for col in columns:
+        if np.ndim(col) == 0:
+            converted.append(itertools.repeat(np.asarray(col).item(), n_rows))
+        else:
+            converted.append(np.asarray(col).tolist())
+    return zip(*converted)
+
+
+def _alert_data_columns(obshistid, local_cache):
+    """
+    Convert one entry of the data cache assembled by
+    AlertDataGenerator.alert_data_from_htmid into the columns of
+    the alert_data table
+
+    Parameters
+    ----------
+    obshistid is the obsHistID of the pointing
+
+    local_cache is a dict of numpy arrays keyed on 'uniqueId', 'xPix',
+    'yPix', 'chipNum', 'dflux', 'SNR', 'raICRS', 'decICRS' (the last two
+    in radians)
+
+    Returns
+    -------
+    A list of numpy arrays in the order of the alert_data columns
+    """
+    n_obj = len(local_cache['uniqueId'])
+    return [np.asarray(local_cache['uniqueId']).astype(np.int64),
+            np.full(n_obj, obshistid, dtype=np.int64),
+            np.asarray(local_cache['xPix'], dtype=float),
+            np.asarray(local_cache['yPix'], dtype=float),
+            np.asarray(local_cache['chipNum']).astype(np.int64),
+            np.asarray(local_cache['dflux'], dtype=float),
+            np.asarray(local_cache['SNR'], dtype=float),
+            np.degrees(np.asarray(local_cache['raICRS'], dtype=float)),
+            np.degrees(np.asarray(local_cache['decICRS'], dtype=float))]
+
+
+def _metadata_tai(tai):
+    """
+    Round the TAI of the pointings to the 5 decimal places stored in
+    the metadata table (formatting and re-parsing each value, so that
+    both backends store exactly the same floats)
+    """
+    return np.array([float('%.5f' % value) for value in np.atleast_1d(tai)])
+
+
+def alert_data_writer_class(output_format):
+    """
+    Return the writer class for an output format ('sqlite', 'npy'
+    or 'npz')
+    """
+    if output_format == 'sqlite':
+        return SqliteAlertDataWriter
+    elif output_format == 'npy':
+        return NpyAlertDataWriter
+    elif output_format == 'npz':
+        return NpzAlertDataWriter
+    raise RuntimeError("Unknown alert data output_format '%s'; "
+                       "options are 'sqlite', 'npy' and 'npz'" % output_format)
+
+
+class SqliteAlertDataWriter(object):
+    """
+    Write the alert data of one trixel to an sqlite file.
+
+    Rows of quiescent_flux and baseline_astrometry are committed along
+    with the next call to write_alert_data.  The indexes are created
+    by close().  Use it as a context manager.
+    """
+
+    # the size (in KiB) of the page cache of the sqlite connection
+    _sqlite_cache_size_kb = 256000
+
+    def __init__(self, output_dir, output_prefix, htmid, checkpoint=False):
+        """
+        Parameters
+        ----------
+        output_dir is the directory in which to create the sqlite file
+
+        output_prefix is the prefix of the sqlite file's name
+
+        htmid is the trixel being simulated
+
+        checkpoint is a boolean.  If True, every write_alert_data records
+        a checkpoint (see the module docstring) and, if the file already
+        exists, it is reopened at its last checkpoint (or started over, if
+        it has none) rather than created.
+        """
+        self.file_name = os.path.join(output_dir, '%s_%d_sqlite.db' % (output_prefix, htmid))
+        self._checkpoint = checkpoint
+        self.last_checkpoint = None
+        if checkpoint and os.path.exists(self.file_name):
+            self.last_checkpoint = self._read_checkpoint()
+            if self.last_checkpoint is None:
+                # nothing was ever committed along with a checkpoint
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(self.file_name+suffix):
+                        os.unlink(self.file_name+suffix)
+
+        if self.last_checkpoint is None:
+            self._n_rows = 0
+            self._last_tag = (0, -1)
+        else:
+            self._n_rows = self.last_checkpoint['n_rows']
+            self._last_tag = (self.last_checkpoint['i_chunk'], self.last_checkpoint['simobjid'])
+
+        self._conn = sqlite3.connect(self.file_name, isolation_level='EXCLUSIVE')
+        self._cursor = self._conn.cursor()
+        self._cursor.execute('PRAGMA journal_mode=WAL;')
+        self._tune_connection()
+        self._conn.commit()
+
+        if self.last_checkpoint is not None:
+            return
+
+        creation_cmd = '''CREATE TABLE alert_data
+                       (uniqueId int, obshistId int, xPix float, yPix float,
+                        chipNum int, dflux float, snr float, ra float, dec float)'''
+        self._cursor.execute(creation_cmd)
+
+        creation_cmd = '''CREATE TABLE metadata
+                       (obshistId int, TAI float, band int)'''
+        self._cursor.execute(creation_cmd)
+
+        creation_cmd = '''CREATE TABLE quiescent_flux
+                      (uniqueId int, band int, flux float, snr float)'''
+        self._cursor.execute(creation_cmd)
+
+        creation_cmd = '''CREATE TABLE baseline_astrometry
+                       (uniqueId int, ra real, dec real, pmRA real,
+                        pmDec real, parallax real, TAI real)'''
+        self._cursor.execute(creation_cmd)
+
+        if checkpoint:
+            creation_cmd = '''CREATE TABLE checkpoint
+                           (i_chunk int, simobjid int, n_rows int, complete int)'''
+            self._cursor.execute(creation_cmd)
+        self._conn.commit()
+
+    def _read_checkpoint(self):
+        """
+        Return the last checkpoint of an existing file as a dict keyed
+        on 'i_chunk', 'simobjid', 'n_rows' and 'complete' (or None if
+        the file has no checkpoint)
+        """
+        with sqlite3.connect(self.file_name) as conn:
+            cursor = conn.cursor()
+            tables = [row[0] for row in
+                      cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            if 'checkpoint' not in tables:
+                if 'alert_data' in tables:
+                    raise RuntimeError('%s exists but was not written with '
+                                       'checkpoints; cannot resume it' % self.file_name)
+                return None
+            rows = cursor.execute('SELECT i_chunk, simobjid, n_rows, complete FROM checkpoint '
+                                  'ORDER BY rowid DESC LIMIT 1').fetchall()
+        if len(rows) == 0:
+            return None
+        return {'i_chunk': rows[0][0], 'simobjid': rows[0][1],
+                'n_rows': rows[0][2], 'complete': bool(rows[0][3])}
+
+    @property
+    def complete(self):
+        """
+        True if the file was reopened after having been completely written
+        """
+        return self.last_checkpoint is not None and self.last_checkpoint['complete']
+
+    @property
+    def n_rows(self):
+        """
+        The total number of rows written to alert_data (including
+        those written before the file was reopened)
+        """
+        return self._n_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._conn.rollback()
+            self._conn.close()
+
+    def _tune_connection(self):
+        """
+        Set the PRAGMAs of the sqlite connection.  These PRAGMAs only
+        last as long as the connection.
+
+        Without checkpoints, a file whose process dies is started over,
+        so we trade durability for write speed (synchronous=OFF; a crash
+        of the operating system can corrupt the file).
+
+        With checkpoints, a file whose process dies is resumed from its
+        last committed checkpoint, which must survive the crash.  In WAL
+        mode, synchronous=NORMAL never corrupts the file and only syncs
+        at WAL checkpoints, not at every commit (a power loss can roll
+        back the last few commits, which resuming then redoes).
+        """
+        if self._checkpoint:
+            self._cursor.execute('PRAGMA synchronous=NORMAL;')
+        else:
+            self._cursor.execute('PRAGMA synchronous=OFF;')
+        self._cursor.execute('PRAGMA cache_size=%d;' % (-1*self._sqlite_cache_size_kb))
+        self._cursor.execute('PRAGMA temp_store=MEMORY;')
+
+    def write_metadata(self, obshistid, tai, band):
+        """
+        Write the metadata table
+
+        Parameters
+        ----------
+        obshistid, tai and band are numpy arrays of the obsHistID,
+        TAI and band (as an int; u=0, g=1, etc.) of the pointings
+        """
+        values = _rows_from_columns(np.asarray(obshistid).astype(np.int64),
+                                    _metadata_tai(tai),
+                                    np.asarray(band).astype(np.int64))
+        self._cursor.executemany('INSERT INTO metadata VALUES (?,?,?)', values)
+        self._conn.commit()
+
+    def write_alert_data(self, data_cache, i_chunk=None, simobjid=None):
+        """
+        Write a cache of alert data
+
+        Parameters
+        ----------
+        data_cache is a dict containing all of the data to be written.
+        It will keyed on a string like 'i_j' where i is the obshistID
+        of an OpSim pointing and j is an arbitrary integer.  That key
+        will lead to another dict keyed on the columns being output to
+        the sqlite file.  The values of this second layer of dict are
+        numpy arrays.
+
+        i_chunk and simobjid are the number of database chunks and the
+        largest simobjid whose output has now been completely written.
+        If the writer checkpoints, they are recorded in the checkpoint
+        table (and must be specified).
+
+        Returns
+        -------
+        The number of rows written
+        """
+        n_written = 0
+
+        # all of the rows are written in one transaction, committed below
+        for cache_tag in data_cache:
+            obshistid = int(cache_tag.split('_')[0])
+            columns = _alert_data_columns(obshistid, data_cache[cache_tag])
+            n_written += len(columns[0])
+            self._cursor.executemany('INSERT INTO alert_data VALUES (?,?,?,?,?,?,?,?,?)',
+                                     _rows_from_columns(*columns))
+        self._n_rows += n_written
+
+        if self._checkpoint:
+            if i_chunk is None or simobjid is None:
+                raise RuntimeError('Must specify i_chunk and simobjid when checkpointing')
+            self._last_tag = (int(i_chunk), int(simobjid))
+            self._cursor.execute('INSERT INTO checkpoint VALUES (?,?,?,0)',
+                                 self._last_tag + (self._n_rows,))
+        self._conn.commit()
+
+        return n_written
+
+    def write_quiescent_flux(self, unique_id, band, flux, snr):
+        """
+        Add rows to the quiescent_flux table (all arguments are numpy
+        arrays of the same length)
+        """
+        self._cursor.executemany('INSERT INTO quiescent_flux VALUES (?,?,?,?)',
+                                 _rows_from_columns(np.asarray(unique_id).astype(np.int64),
+                                                    np.asarray(band).astype(np.int64),
+                                                    flux, snr))
+
+    def write_baseline_astrometry(self, unique_id, ra, dec, pmra, pmdec, parallax, tai):
+        """
+        Add rows to the baseline_astrometry table (all arguments except
+        tai, which may be a scalar, are numpy arrays of the same length)
+        """
+        self._cursor.executemany('INSERT INTO baseline_astrometry VALUES (?,?,?,?,?,?,?)',
+                                 _rows_from_columns(np.asarray(unique_id).astype(np.int64),
+                                                    ra, dec, pmra, pmdec, parallax, tai))
+
+    def close(self):
+        """
+        Index the tables (marking the file complete, if checkpointing)
+        and close the file
+        """
+        if self.complete:
+            self._conn.close()
+            return
+        if self._checkpoint:
+            self._cursor.execute('INSERT INTO checkpoint VALUES (?,?,?,1)',
+                                 self._last_tag + (self._n_rows,))
+        self._cursor.execute('CREATE INDEX unq_obs ON alert_data (uniqueId, obshistId)')
+        self._cursor.execute('CREATE INDEX unq_flux ON quiescent_flux (uniqueId, band)')
+        self._cursor.execute('CREATE INDEX obs ON metadata (obshistid)')
+        self._cursor.execute('CREATE INDEX unq_ast ON baseline_astrometry (uniqueId)')
+        self._conn.commit()
+        self._conn.close()
+
+
+class NpyAlertDataWriter(object):
+    """
+    Write the alert data of one trixel to a directory of columnar .npy
+    files (see the module docstring for the layout).
+
+    Rows are buffered in memory and written as one part per partition
+    each time write_alert_data is called (and by close()).  Use it as a
+    context manager.
+    """
+
+    def __init__(self, output_dir, output_prefix, htmid, compressed=False, checkpoint=False):
+        """
+        Parameters
+        ----------
+        output_dir is the directory in which to create the data directory
+
+        output_prefix is the prefix of the data directory's name
+
+        htmid is the trixel being simulated
+
+        compressed is a boolean.  If True, each part is written as a
+        compressed .npz file (which cannot be memory-mapped when read).
+
+        checkpoint must be False (only SqliteAlertDataWriter can resume
+        a partially written trixel)
+        """
+        if checkpoint:
+            raise RuntimeError('NpyAlertDataWriter does not support checkpoints; '
+                               'use the sqlite output format')
+        self.last_checkpoint = None
+        self._n_rows = 0
+        self.file_name = os.path.join(output_dir, '%s_%d_npy' % (output_prefix, htmid))
+        self._compressed = compressed
+        self._scratch_dir = tempfile.mkdtemp(dir=output_dir, prefix='.tmp_%s_%d_npy_' %
+                                             (output_prefix, htmid))
+        self._index = OrderedDict()
+        self._index['htmid'] = htmid
+        self._index['compressed'] = compressed
+        self._index['tables'] = OrderedDict()
+        for table_name in _ALERT_DATA_COLUMNS:
+            self._index['tables'][table_name] = OrderedDict()
+            self._index['tables'][table_name]['columns'] = [col[0] for col in
+                                                            _ALERT_DATA_COLUMNS[table_name]]
+            self._index['tables'][table_name]['partitions'] = OrderedDict()
+
+        # keyed on (table_name, partition); values are lists of lists of columns
+        self._buffer = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif os.path.exists(self._scratch_dir):
+            shutil.rmtree(self._scratch_dir)
+
+    def _append(self, table_name, partition, columns):
+        """
+        Buffer rows for a partition of a table
+
+        Parameters
+        ----------
+        table_name is the name of the table
+
+        partition is the name of the partition
+
+        columns is a list of numpy arrays in the order of the table's columns
+        """
+        if len(columns[0]) == 0:
+            return
+        key = (table_name, partition)
+        if key not in self._buffer:
+            self._buffer[key] = []
+        self._buffer[key].append(columns)
+
+    def _flush(self):
+        """
+        Write each buffered partition as a new part
+        """
+        for (table_name, partition), column_list in self._buffer.items():
+            col_defs = _ALERT_DATA_COLUMNS[table_name]
+            partition_dict = self._index['tables'][table_name]['partitions']
+            if partition not in partition_dict:
+                partition_dict[partition] = []
+            part_name = 'part_%06d' % len(partition_dict[partition])
+            partition_dir = os.path.join(self._scratch_dir, table_name, partition)
+            if not os.path.exists(partition_dir):
+                os.makedirs(partition_dir)
+
+            data = OrderedDict()
+            for i_col, (col_name, col_type) in enumerate(col_defs):
+                data[col_name] = np.concatenate([columns[i_col] for columns in
+                                                 column_list]).astype(col_type)
+
+            if self._compressed:
+                np.savez_compressed(os.path.join(partition_dir, '%s.npz' % part_name), **data)
+            else:
+                part_dir = os.path.join(partition_dir, part_name)
+                os.mkdir(part_dir)
+                for col_name in data:
+                    np.save(os.path.join(part_dir, '%s.npy' % col_name), data[col_name])
+
+            partition_dict[partition].append({'name': part_name,
+                                              'n_rows': len(data[col_defs[0][0]])})
+        self._buffer = OrderedDict()
+
+    def write_metadata(self, obshistid, tai, band):
+        """
+        Write the metadata table
+
+        Parameters
+        ----------
+        obshistid, tai and band are numpy arrays of the obsHistID,
+        TAI and band (as an int; u=0, g=1, etc.) of the pointings
+        """
+        self._append('metadata', 'all', [np.asarray(obshistid),
+                                         _metadata_tai(tai),
+                                         np.asarray(band)])
+        self._flush()
+
+    @property
+    def complete(self):
+        """
+        Always False (see SqliteAlertDataWriter.complete)
+        """
+        return False
+
+    @property
+    def n_rows(self):
+        """
+        The total number of rows written to alert_data
+        """
+        return self._n_rows
+
+    def write_alert_data(self, data_cache, i_chunk=None, simobjid=None):
+        """
+        Write a cache of alert data (see SqliteAlertDataWriter.write_alert_data;
+        i_chunk and simobjid are ignored)
+
+        Returns
+        -------
+        The number of rows written
+        """
+        n_written = 0
+        for cache_tag in data_cache:
+            obshistid = int(cache_tag.split('_')[0])
+            columns = _alert_data_columns(obshistid, data_cache[cache_tag])
+            n_written += len(columns[0])
+            self._append('alert_data', 'obshistid_%d' % obshistid, columns)
+        self._flush()
+        self._n_rows += n_written
+        return n_written
+
+    def write_quiescent_flux(self, unique_id, band, flux, snr):
+        """
+        Add rows to the quiescent_flux table (all arguments are numpy
+        arrays of the same length)
+        """
+        self._append('quiescent_flux', 'all', [np.asarray(unique_id), np.asarray(band),
+                                               np.asarray(flux), np.asarray(snr)])
+
+    def write_baseline_astrometry(self, unique_id, ra, dec, pmra, pmdec, parallax, tai):
+        """
+        Add rows to the baseline_astrometry table (all arguments except
+        tai, which may be a scalar, are numpy arrays of the same length)
+        """
+        unique_id = np.asarray(unique_id)
+        self._append('baseline_astrometry', 'all',
+                     [unique_id, np.asarray(ra), np.asarray(dec), np.asarray(pmra),
+                      np.asarray(pmdec), np.asarray(parallax),
+                      np.full(len(unique_id), tai, dtype=float)])
+
+    def close(self):
+        """
+        Write any buffered rows and the index, and move the data
+        directory into place
+        """
+        self._flush()
+        with open(os.path.join(self._scratch_dir, 'index.json'), 'w') as out_file:
+            json.dump(self._index, out_file)
+        if os.path.exists(self.file_name):
+            shutil.rmtree(self.file_name)
+        os.rename(self._scratch_dir, self.file_name)
+
+
+class NpzAlertDataWriter(NpyAlertDataWriter):
+    """
+    An NpyAlertDataWriter which writes each part as a compressed .npz
+    file.  The data directory has the same name and layout, and is read
+    back by NpyAlertDataReader.
+    """
+
+    def __init__(self, output_dir, output_prefix, htmid, checkpoint=False):
+        super(NpzAlertDataWriter, self).__init__(output_dir, output_prefix, htmid,
+                                                 compressed=True, checkpoint=checkpoint)
+
+
+class NpyAlertDataReader(object):
+    """
+    Read the alert data written by NpyAlertDataWriter
+    """
+
+    def __init__(self, dir_name, mmap=True):
+        """
+        Parameters
+        ----------
+        dir_name is the data directory (output_dir/output_prefix_htmid_npy)
+
+        mmap is a boolean.  If True, uncompressed column files are
+        memory-mapped rather than read into memory.
+        """
+        self._dir_name = dir_name
+        self._mmap_mode = 'r' if mmap else None
+        with open(os.path.join(dir_name, 'index.json'), 'r') as in_file:
+            self._index = json.load(in_file)
+
+    @property
+    def obshistid_list(self):
+        """
+        The obsHistIDs for which there are rows in alert_data
+        """
+        partitions = self._index['tables']['alert_data']['partitions']
+        return sorted([int(name.replace('obshistid_', '')) for name in partitions])
+
+    def n_rows(self, table_name, obshistid=None):
+        """
+        Return the number of rows in a table (in the alert_data partition
+        of obshistid, if specified) without reading any data
+        """
+        partitions = self._partitions(table_name, obshistid)
+        return sum([part['n_rows'] for partition in partitions
+                    for part in self._index['tables'][table_name]['partitions'][partition]])
+
+    def _partitions(self, table_name, obshistid):
+        """
+        Return the names of the partitions of table_name to be read
+        """
+        if table_name not in self._index['tables']:
+            raise RuntimeError("There is no table '%s' in %s" % (table_name, self._dir_name))
+
+        partition_dict = self._index['tables'][table_name]['partitions']
+        if obshistid is None:
+            return list(partition_dict.keys())
+
+        if table_name != 'alert_data':
+            raise RuntimeError("Only alert_data is partitioned by obshistid")
+
+        partition = 'obshistid_%d' % obshistid
+        if partition not in partition_dict:
+            return []
+        return [partition]
+
+    def read(self, table_name, obshistid=None, columns=None):
+        """
+        Read a table
+
+        Parameters
+        ----------
+        table_name is 'alert_data', 'metadata', 'quiescent_flux' or
+        'baseline_astrometry'
+
+        obshistid is an optional obsHistID.  If specified, only the
+        alert_data partition of that pointing is read.
+
+        columns is an optional list of the columns to read (default all)
+
+        Returns
+        -------
+        A dict of numpy arrays keyed on column name.  If the table is
+        stored in a single uncompressed part, the arrays are read-only
+        memory maps.
+        """
+        col_defs = OrderedDict(_ALERT_DATA_COLUMNS[table_name])
+        if columns is None:
+            columns = list(col_defs.keys())
+        for col_name in columns:
+            if col_name not in col_defs:
+                raise RuntimeError("Table '%s' has no column '%s'" % (table_name, col_name))
+
+        data = OrderedDict()
+        for col_name in columns:
+            data[col_name] = []
+
+        for partition in self._partitions(table_name, obshistid):
+            partition_dir = os.path.join(self._dir_name, table_name, partition)
+            for part in self._index['tables'][table_name]['partitions'][partition]:
+                if self._index['compressed']:
+                    with np.load(os.path.join(partition_dir, '%s.npz' % part['name'])) as part_data:
+                        for col_name in columns:
+                            data[col_name].append(part_data[col_name])
+                else:
+                    for col_name in columns:
+                        data[col_name].append(np.load(os.path.join(partition_dir, part['name'],
+                                                                   '%s.npy' % col_name),
+                                                      mmap_mode=self._mmap_mode))
+
+        for col_name in columns:
+            if len(data[col_name]) == 1:
+                data[col_name] = data[col_name][0]
+            elif len(data[col_name]) == 0:
+                data[col_name] = np.array([], dtype=col_defs[col_name])
+            else:
+                data[col_name] = np.concatenate(data[col_name])
+        return data
+
+    def diasource_data(self, obshistid):
+        """
+        Return the alert_data rows of a pointing joined with metadata and
+        quiescent_flux, as queried from the sqlite files by
+        AvroAlertGenerator.write_alerts
+
+        Parameters
+        ----------
+        obshistid is the obsHistID of the pointing
+
+        Returns
+        -------
+        A numpy recarray with columns uniqueId, xPix, yPix, chipNum, dflux,
+        tot_snr, ra, dec, band, TAI, quiescent_flux, quiescent_snr, sorted
+        by uniqueId
+        """
+        dtype = np.dtype([('uniqueId', int), ('xPix', float), ('yPix', float),
+                          ('chipNum', int), ('dflux', float), ('tot_snr', float),
+                          ('ra', float), ('dec', float), ('band', int), ('TAI', float),
+                          ('quiescent_flux', float), ('quiescent_snr', float)])
+
+        metadata = self.read('metadata')
+        meta_dex = np.where(metadata['obshistId'] == obshistid)[0]
+        if len(meta_dex) == 0:
+            return np.recarray(0, dtype=dtype)
+        band = metadata['band'][meta_dex[0]]
+        tai = metadata['TAI'][meta_dex[0]]
+
+        alert_data = self.read('alert_data', obshistid=obshistid)
+        quiescent = self.read('quiescent_flux')
+        in_band = np.where(quiescent['band'] == band)
+        q_unq = np.asarray(quiescent['uniqueId'][in_band])
+        q_sorted = np.argsort(q_unq, kind='mergesort')
+        q_unq = q_unq[q_sorted]
+        q_flux = np.asarray(quiescent['flux'][in_band])[q_sorted]
+        q_snr = np.asarray(quiescent['snr'][in_band])[q_sorted]
+
+        # inner join on uniqueId
+        unq = np.asarray(alert_data['uniqueId'])
+        q_dex = np.clip(np.searchsorted(q_unq, unq), 0, max(len(q_unq)-1, 0))
+        if len(q_unq) > 0:
+            has_quiescent = np.where(q_unq[q_dex] == unq)[0]
+        else:
+            has_quiescent = np.array([], dtype=int)
+        order = has_quiescent[np.argsort(unq[has_quiescent], kind='mergesort')]
+        q_dex = q_dex[order]
+
+        output = np.recarray(len(order), dtype=dtype)
+        output['uniqueId'] = unq[order]
+        for out_name, col_name in (('xPix', 'xPix'), ('yPix', 'yPix'),
+                                   ('chipNum', 'chipNum'), ('dflux', 'dflux'),
+                                   ('tot_snr', 'snr'), ('ra', 'ra'), ('dec', 'dec')):
+            output[out_name] = np.asarray(alert_data[col_name])[order]
+        output['band'] = band
+        output['TAI'] = tai
+        output['quiescent_flux'] = q_flux[q_dex]
+        output['quiescent_snr'] = q_snr[q_dex]
+        return output
+
+    def diaobject_data(self):
+        """
+        Return the baseline_astrometry table as a numpy recarray with
+        columns uniqueId, ra, dec, TAI, pmRA, pmDec, parallax
+        """
+        dtype = np.dtype([('uniqueId', int), ('ra', float), ('dec', float),
+                          ('TAI', float), ('pmRA', float), ('pmDec', float),
+                          ('parallax', float)])
+        data = self.read('baseline_astrometry')
+        output = np.recarray(len(data['uniqueId']), dtype=dtype)
+        for col_name in dtype.names:
+            output[col_name] = data[col_name]
+        return output
@@ -4,16 +4,27 @@
 try:
     import avro.schema
     from avro.io import DatumWriter
-    from avro.datafile import DataFileWriter
+    from avro.datafile import DataFileWriter, VALID_CODECS
 except ImportError:
     pass
 
+_fastavro_is_installed = True
+try:
+    import fastavro
+except ImportError:
+    _fastavro_is_installed = False
+
 from lsst.sims.catalogs.db import DBObject
+from lsst.sims.catUtils.utils.alertDataWriters import NpyAlertDataReader
 import os
+import io
 import numpy as np
 import json
 import warnings
 import time
+import multiprocessing as mproc
+from collections import OrderedDict
+from queue import Empty
 
 __all__ = ["AvroAlertGenerator"]
 
@@ -48,24 +59,284 @@ def load_single_avsc(file_path, names):
     return schema
 
 
+_DIASOURCE_DTYPE = [('uniqueId', int), ('xPix', float), ('yPix', float),
+                    ('chipNum', int), ('dflux', float), ('tot_snr', float),
+                    ('ra', float), ('dec', float), ('band', int), ('TAI', float),
+                    ('quiescent_flux', float), ('quiescent_snr', float)]
+
+_DIAOBJECT_QUERY = 'SELECT uniqueId, ra, dec, TAI, pmRA, pmDec, parallax FROM baseline_astrometry'
+
+_DIAOBJECT_DTYPE = np.dtype([('uniqueId', int), ('ra', float), ('dec', float),
+                             ('TAI', float), ('pmRA', float), ('pmDec', float),
+                             ('parallax', float)])
+
+
+def _diasource_query(obshistid=None):
+    """
+    Return the query (and the numpy dtype of its results) joining the
+    alert_data, metadata and quiescent_flux tables of an AlertDataGenerator
+    sqlite file.  If obshistid is None, the query returns the rows of every
+    pointing (with an extra column obshistId) sorted by obshistId and
+    uniqueId; otherwise it returns only the rows of that pointing sorted
+    by uniqueId.
+    """
+    query = 'SELECT alert.uniqueId, alert.xPix, alert.yPix, '
+    query += 'alert.chipNum, alert.dflux, alert.snr, alert.ra, alert.dec, '
+    query += 'meta.band, meta.TAI, quiescent.flux, quiescent.snr '
+    if obshistid is None:
+        query += ', alert.obshistId '
+    query += 'FROM alert_data as alert '
+    query += 'INNER JOIN metadata AS meta ON alert.obshistId=meta.obshistId '
+    query += 'INNER JOIN quiescent_flux AS quiescent ON quiescent.uniqueId=alert.uniqueID '
+    query += 'AND quiescent.band=meta.band '
+    if obshistid is None:
+        query += 'ORDER BY alert.obshistId, alert.uniqueId'
+        return query, np.dtype(_DIASOURCE_DTYPE + [('obshistId', int)])
+
+    query += 'WHERE alert.obshistId=%d ' % obshistid
+    query += 'ORDER BY alert.uniqueId'
+    return query, np.dtype(_DIASOURCE_DTYPE)
+
+
+def _log_message(msg, lock, log_file_name):
+    """
+    Print msg and (optionally) append it to log_file_name, holding
+    lock (if not None) so that processes do not interleave messages
+    """
+    if lock is not None:
+        lock.acquire()
+    try:
+        print(msg)
+        if log_file_name is not None:
+            with open(log_file_name, 'a') as out_file:
+                out_file.write(msg)
+                out_file.write('\n')
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+class _FastAvroFileWriter(object):
+    """
+    An avro container file written with fastavro.  It provides the
+    append/close interface of avro.datafile.DataFileWriter.
+    """
+
+    def __init__(self, file_name, parsed_schema, append=False,
+                 codec='null', sync_interval=None):
+        """
+        Parameters
+        ----------
+        file_name is the name of the avro file
+
+        parsed_schema is the output of fastavro.parse_schema
+
+        append is a boolean.  If True, records are appended to the
+        existing file file_name (with the schema and codec with
+        which it was written).
+
+        codec is the block compression codec
+
+        sync_interval is the approximate size in bytes of the blocks
+        (if None, fastavro's default)
+        """
+        self._file = open(file_name, 'a+b' if append else 'wb')
+        writer_kwargs = {'codec': codec}
+        if sync_interval is not None:
+            writer_kwargs['sync_interval'] = sync_interval
+        self._writer = fastavro.write.Writer(self._file, parsed_schema, **writer_kwargs)
+
+    def append(self, datum):
+        self._writer.write(datum)
+
+    def close(self):
+        self._writer.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _AvroWriterPool(object):
+    """
+    The per-obsHistID avro files written by one process of
+    AvroAlertGenerator.write_alerts_by_trixel.  At most max_open_files
+    are open at once; the least recently used file is closed to make
+    room for a new one and re-opened in append mode if more alerts
+    arrive for it.
+    """
+
+    def __init__(self, avro_gen, out_dir, out_prefix, max_open_files):
+        self._avro_gen = avro_gen
+        self._out_dir = out_dir
+        self._out_prefix = out_prefix
+        self._max_open_files = max_open_files
+        self._writers = OrderedDict()
+        self.n_alerts = {}
+
+    def append(self, obshistid, alert_list):
+        """
+        Assign alertIds to the alerts in alert_list and append
+        them to the avro file of obshistid
+        """
+        if obshistid in self._writers:
+            data_writer = self._writers.pop(obshistid)
+        else:
+            if len(self._writers) >= self._max_open_files:
+                self._writers.popitem(last=False)[1].close()
+
+            out_name = os.path.join(self._out_dir, '%s_%d.avro' % (self._out_prefix, obshistid))
+            if obshistid in self.n_alerts:
+                data_writer = self._avro_gen._open_writer(out_name, append=True)
+            else:
+                if os.path.exists(out_name):
+                    os.unlink(out_name)
+                data_writer = self._avro_gen._open_writer(out_name)
+                self.n_alerts[obshistid] = 0
+
+        self._writers[obshistid] = data_writer
+
+        # avro requires a python int (not a numpy integer) for a long
+        alert_id_offset = int(obshistid) << 20
+        for avro_alert in alert_list:
+            self.n_alerts[obshistid] += 1
+            avro_alert['alertId'] = alert_id_offset + self.n_alerts[obshistid]
+            data_writer.append(avro_alert)
+
+    def close(self):
+        for data_writer in self._writers.values():
+            data_writer.close()
+        self._writers = OrderedDict()
+
+
+def _avro_writer_worker(avro_gen, out_dir, out_prefix, max_open_files,
+                        alert_queue, result_queue):
+    """
+    Pull (obshistid, alert_list) batches off of alert_queue and write
+    them with an _AvroWriterPool until a None is pulled.  Put
+    (n_alerts, error) on result_queue, where n_alerts is a dict mapping
+    obshistid to the number of alerts written and error is None or a
+    description of the first exception raised.  Batches pulled after an
+    exception are discarded so that the processes filling alert_queue
+    never block.
+    """
+    pool = _AvroWriterPool(avro_gen, out_dir, out_prefix, max_open_files)
+    error = None
+    while True:
+        batch = alert_queue.get()
+        if batch is None:
+            break
+        if error is not None:
+            continue
+        try:
+            pool.append(*batch)
+        except Exception as err:
+            error = repr(err)
+    try:
+        pool.close()
+    except Exception as err:
+        if error is None:
+            error = repr(err)
+    result_queue.put((pool.n_alerts, error))
+
+
+def _avro_trixel_worker(avro_gen, task_queue, alert_queue_list, result_queue,
+                        lock, log_file_name, trixel_kwargs):
+    """
+    Pull htmids off of task_queue and fan their alerts out to
+    alert_queue_list with avro_gen._fan_out_trixel until a None is
+    pulled.  Put (htmid, n_alerts) on result_queue after each trixel
+    (n_alerts is None if the trixel failed).
+
+    The random fields of each trixel are drawn from their own stream
+    (see AvroAlertGenerator._seed_trixel), so that they do not depend
+    on which process simulates which trixels.
+    """
+    while True:
+        htmid = task_queue.get()
+        if htmid is None:
+            break
+        t_start = time.time()
+        avro_gen._seed_trixel(htmid)
+        try:
+            n_alerts = avro_gen._fan_out_trixel(htmid, alert_queue_list, **trixel_kwargs)
+        except Exception as err:
+            _log_message('failed htmid %d: %s' % (htmid, repr(err)), lock, log_file_name)
+            result_queue.put((htmid, None))
+            continue
+
+        elapsed = (time.time()-t_start)/3600.0
+        _log_message('finished htmid %d; %d alerts in %.2e hrs' % (htmid, n_alerts, elapsed),
+                     lock, log_file_name)
+        result_queue.put((htmid, n_alerts))
+
+
 class AvroAlertGenerator(object):
     """
     This class reads in the sqlite files created by the AlertDataGenerator
     and converts them into avro files separated by obsHistID (the unique
     integer identifying each pointing in an OpSim run).
+
+    write_alerts writes the file of a single obsHistID;
+    write_alerts_by_trixel writes the files of every obsHistID at once,
+    reading each of the AlertDataGenerator's files only once.
+
+    The files are encoded either with the avro package or (much faster)
+    with fastavro; see the backend argument of __init__.
     """
 
-    def __init__(self):
+    def __init__(self, legacy_random_stream=False, backend='avro',
+                 codec='null', sync_interval=None):
+        """
+        Parameters
+        ----------
+        legacy_random_stream is a boolean.  The flags and covariances of
+        the diaSources and diaObjects are random numbers drawn from
+        RandomState(7123) (write_alerts_by_trixel reseeds it for each
+        trixel; see _seed_trixel).  If legacy_random_stream is True, they are
+        drawn one record at a time, reproducing the output of earlier
+        versions of this class exactly.  Otherwise (the default) they
+        are drawn one column at a time, which is much faster.
+
+        backend is the package used to encode the avro files: 'avro'
+        (the default) or 'fastavro', which compiles the alert schema
+        once and encodes records much faster.  Both write standard
+        avro container files.
+
+        codec is the block compression codec of the avro files ('null',
+        'deflate' or, if the libraries are installed, e.g. 'snappy')
+
+        sync_interval is the approximate size in bytes of the blocks of
+        the avro files.  Only supported by the 'fastavro' backend (the
+        'avro' backend always uses avro.datafile.SYNC_INTERVAL).  If None,
+        the backend's default is used.
+        """
+        if backend not in ('avro', 'fastavro'):
+            raise RuntimeError("backend must be 'avro' or 'fastavro'; you gave '%s'" % backend)
+        if backend == 'fastavro' and not _fastavro_is_installed:
+            raise RuntimeError("backend='fastavro' requires fastavro, which is not installed")
+        if backend == 'avro' and sync_interval is not None:
+            raise RuntimeError("sync_interval is only supported by backend='fastavro'")
+
         self._diasource_schema = None
         self._diasource_ct = {}
         self._rng = np.random.RandomState(7123)
         self._n_bit_shift = 10
+        self._legacy_random_stream = legacy_random_stream
+        self._backend = backend
+        self._codec = codec
+        self._sync_interval = sync_interval
 
     def load_schema(self, schema_dir):
         """
         Load the schema for the avro files.  Currently, these are in
 
         https://github.com/lsst-dm/sample-avro-alert/tree/master/schema
+
+        If the backend is 'fastavro', the combined schema is compiled here.
         """
         file_names = [os.path.join(schema_dir, 'diasource.avsc'),
                       os.path.join(schema_dir, 'diaobject.avsc'),
@@ -75,6 +346,86 @@ class AvroAlertGenerator(object):
 
         self._alert_schema = combine_schemas(file_names)
 
+        if self._backend == 'fastavro':
+            self._fastavro_schema = fastavro.parse_schema(json.loads(str(self._alert_schema)))
+            # fastavro only complains about a missing compression
+            # library when it writes a block
+            try:
+                fastavro.write.Writer(io.BytesIO(), self._fastavro_schema,
+                                      codec=self._codec).dump()
+            except ValueError as err:
+                raise RuntimeError("codec '%s' is not available: %s" % (self._codec, str(err)))
+        elif self._codec not in VALID_CODECS:
+            raise RuntimeError("codec '%s' is not available; valid codecs are %s" %
+                               (self._codec, str(sorted(VALID_CODECS))))
+
+    def _open_writer(self, file_name, append=False):
+        """
+        Open an avro file for writing with the backend of this
+        AvroAlertGenerator
+
+        Parameters
+        ----------
+        file_name is the name of the avro file
+
+        append is a boolean.  If True, alerts are appended to the
+        existing file file_name.
+
+        Returns
+        -------
+        An object with the append(datum) and close() methods (and the
+        context manager interface) of avro.datafile.DataFileWriter
+        """
+        if self._backend == 'fastavro':
+            return _FastAvroFileWriter(file_name, self._fastavro_schema, append=append,
+                                       codec=self._codec, sync_interval=self._sync_interval)
+        if append:
+            return DataFileWriter(open(file_name, 'a+b'), DatumWriter())
+        return DataFileWriter(open(file_name, 'wb'), DatumWriter(),
+                              self._alert_schema, self._codec)
+
+    def _seed_trixel(self, htmid):
+        """
+        Reseed the random number generator with a seed derived from
+        7123 and htmid (split into 32 bit words, as RandomState requires)
+        """
+        htmid = int(htmid)
+        self._rng = np.random.RandomState([7123, htmid >> 32, htmid & 0xffffffff])
+
+    def _random_fields(self, n_records, n_uniform):
+        """
+        Draw the random fields of n_records records
+
+        Parameters
+        ----------
+        n_records is the number of records
+
+        n_uniform is the number of uniform deviates per record
+
+        Returns
+        -------
+        flags is a numpy array of n_records random integers in [10, 1000)
+
+        uniform is a (n_records, n_uniform) numpy array of uniform
+        deviates in [0, 1)
+
+        If self._legacy_random_stream, each record's flag is drawn
+        followed by its uniform deviates (the order in which they were
+        drawn when records were built one at a time).
+        """
+        if not self._legacy_random_stream:
+            flags = self._rng.randint(10, 1000, size=n_records)
+            uniform = self._rng.random_sample((n_records, n_uniform))
+            return flags, uniform
+
+        flags = np.zeros(n_records, dtype=int)
+        uniform = np.zeros((n_records, n_uniform), dtype=float)
+        for i_record in range(n_records):
+            flags[i_record] = self._rng.randint(10, 1000)
+            for i_uniform in range(n_uniform):
+                uniform[i_record][i_uniform] = self._rng.random_sample()
+        return flags, uniform
+
     def _create_sources(self, obshistid, diasource_data):
         """
         Create a list of diaSources that adhere to the corresponding
@@ -94,9 +445,7 @@ class AvroAlertGenerator(object):
         an avro-formatted diaSource.
         """
 
-        bp_name_dict = {0: 'u', 1: 'g', 2: 'r', 3: 'i', 4: 'z', 5: 'y'}
-
-        avro_diasource_list = []
+        bp_name_arr = np.array(['u', 'g', 'r', 'i', 'z', 'y'])
 
         tot_flux = diasource_data['dflux'] + diasource_data['quiescent_flux']
         full_noise = tot_flux/diasource_data['tot_snr']
@@ -104,49 +453,57 @@ class AvroAlertGenerator(object):
         diff_noise = np.sqrt(full_noise**2 + quiescent_noise**2)
         diff_snr = np.abs(diasource_data['dflux']/diff_noise)
 
-        for i_source in range(len(diasource_data)):
-            diasource = diasource_data[i_source]
-            if diasource['uniqueId'] not in self._diasource_ct:
-                self._diasource_ct[diasource['uniqueId']] = 1
-
-            avro_diasource = {}
-            avro_diasource['diaSourceId'] = np.long((diasource['uniqueId'] << self._n_bit_shift) +
-                                                    self._diasource_ct[diasource['uniqueId']])
-            self._diasource_ct[diasource['uniqueId']] += 1
-            avro_diasource['ccdVisitId'] = np.long((diasource['chipNum']*10**7) + obshistid)
-            avro_diasource['diaObjectId'] = np.long(diasource['uniqueId'])
-
-            avro_diasource['midPointTai'] = diasource['TAI']
-            avro_diasource['filterName'] = bp_name_dict[diasource['band']]
-            avro_diasource['ra'] = diasource['ra']
-            avro_diasource['decl'] = diasource['dec']
-            avro_diasource['flags'] = self._rng.randint(10, 1000)
-
-            avro_diasource['x'] = diasource['xPix']
-            avro_diasource['y'] = diasource['yPix']
-            avro_diasource['snr'] = diff_snr[i_source]
-            avro_diasource['psFlux'] = diasource['dflux']
-
-            ra_dec_cov = {}
-            ra_dec_cov['raSigma'] = self._rng.random_sample()*0.001
-            ra_dec_cov['declSigma'] = self._rng.random_sample()*0.001
-            ra_dec_cov['ra_decl_Cov'] = self._rng.random_sample()*0.001
+        # raSigma, declSigma, ra_decl_Cov, xSigma, ySigma, x_y_Cov
+        flags, cov = self._random_fields(len(diasource_data), 6)
+        cov[:, :3] *= 0.001
+        cov[:, 3:5] = cov[:, 3:5]*0.001*3600.0/0.2
+        cov[:, 5] *= 0.001
 
-            avro_diasource['ra_decl_Cov'] = ra_dec_cov
+        ccd_visit_id = diasource_data['chipNum'].astype(np.int64)*10**7 + obshistid
 
-            x_y_cov = {}
-            x_y_cov['xSigma'] = self._rng.random_sample()*0.001*3600.0/0.2
-            x_y_cov['ySigma'] = self._rng.random_sample()*0.001*3600.0/0.2
-            x_y_cov['x_y_Cov'] = self._rng.random_sample()*0.001
-
-            avro_diasource['x_y_Cov'] = x_y_cov
-
-            avro_diasource['totFlux'] = diasource['quiescent_flux'] + diasource['dflux']
-            avro_diasource['totFluxErr'] = full_noise[i_source]
-            avro_diasource['diffFlux'] = diasource['dflux']
-            avro_diasource['diffFluxErr'] = diff_noise[i_source]
-
-            avro_diasource_list.append(avro_diasource)
+        avro_diasource_list = []
+        for (unq, ccd_visit, tai, band, ra, dec, flag, x_pix, y_pix, snr, dflux,
+             tot, tot_err, diff_err, cov_row) in zip(diasource_data['uniqueId'].tolist(),
+                                                     ccd_visit_id.tolist(),
+                                                     diasource_data['TAI'].tolist(),
+                                                     bp_name_arr[diasource_data['band']].tolist(),
+                                                     diasource_data['ra'].tolist(),
+                                                     diasource_data['dec'].tolist(),
+                                                     flags.tolist(),
+                                                     diasource_data['xPix'].tolist(),
+                                                     diasource_data['yPix'].tolist(),
+                                                     diff_snr.tolist(),
+                                                     diasource_data['dflux'].tolist(),
+                                                     tot_flux.tolist(),
+                                                     full_noise.tolist(),
+                                                     diff_noise.tolist(),
+                                                     cov.tolist()):
+
+            source_ct = self._diasource_ct.get(unq, 1)
+            self._diasource_ct[unq] = source_ct + 1
+
+            avro_diasource_list.append({'diaSourceId': (unq << self._n_bit_shift) + source_ct,
+                                        'ccdVisitId': ccd_visit,
+                                        'diaObjectId': unq,
+                                        'midPointTai': tai,
+                                        'filterName': band,
+                                        'ra': ra,
+                                        'decl': dec,
+                                        'flags': flag,
+                                        'x': x_pix,
+                                        'y': y_pix,
+                                        'snr': snr,
+                                        'psFlux': dflux,
+                                        'ra_decl_Cov': {'raSigma': cov_row[0],
+                                                        'declSigma': cov_row[1],
+                                                        'ra_decl_Cov': cov_row[2]},
+                                        'x_y_Cov': {'xSigma': cov_row[3],
+                                                    'ySigma': cov_row[4],
+                                                    'x_y_Cov': cov_row[5]},
+                                        'totFlux': tot,
+                                        'totFluxErr': tot_err,
+                                        'diffFlux': dflux,
+                                        'diffFluxErr': diff_err})
 
         return avro_diasource_list
 
@@ -166,41 +523,81 @@ class AvroAlertGenerator(object):
         astrophysical source).  Each value is a properly formatted
         diaObject corresponding to its key.
         """
-        diaobject_dict = {}
-        for i_object in range(len(diaobject_data)):
-            diaobject = diaobject_data[i_object]
-
-            avro_diaobject = {}
-            avro_diaobject['flags'] = np.long(self._rng.randint(10, 1000))
-            avro_diaobject['diaObjectId'] = np.long(diaobject['uniqueId'])
-            avro_diaobject['ra'] = diaobject['ra']
-            avro_diaobject['decl'] = diaobject['dec']
+        # raSigma, declSigma, ra_decl_Cov, pmParallaxLnL, pmParallaxChi2
+        flags, random_vals = self._random_fields(len(diaobject_data), 5)
+        random_vals[:, :3] *= 0.001
 
-            ra_dec_cov = {}
-            ra_dec_cov['raSigma'] = self._rng.random_sample()*0.001
-            ra_dec_cov['declSigma'] = self._rng.random_sample()*0.001
-            ra_dec_cov['ra_decl_Cov'] = self._rng.random_sample()*0.001
+        diaobject_dict = {}
+        for (unq, ra, dec, tai, pm_ra, pm_dec, parallax, flag,
+             random_row) in zip(diaobject_data['uniqueId'].tolist(),
+                                diaobject_data['ra'].tolist(),
+                                diaobject_data['dec'].tolist(),
+                                diaobject_data['TAI'].tolist(),
+                                diaobject_data['pmRA'].tolist(),
+                                diaobject_data['pmDec'].tolist(),
+                                diaobject_data['parallax'].tolist(),
+                                flags.tolist(),
+                                random_vals.tolist()):
+
+            diaobject_dict[unq] = {'flags': flag,
+                                   'diaObjectId': unq,
+                                   'ra': ra,
+                                   'decl': dec,
+                                   'ra_decl_Cov': {'raSigma': random_row[0],
+                                                   'declSigma': random_row[1],
+                                                   'ra_decl_Cov': random_row[2]},
+                                   'radecTai': tai,
+                                   'pmRa': pm_ra,
+                                   'pmDecl': pm_dec,
+                                   'parallax': parallax,
+                                   'pm_parallax_Cov': {'pmRaSigma': 0.0,
+                                                       'pmDeclSigma': 0.0,
+                                                       'parallaxSigma': 0.0,
+                                                       'pmRa_pmDecl_Cov': 0.0,
+                                                       'pmRa_parallax_Cov': 0.0,
+                                                       'pmDecl_parallax_Cov': 0.0},
+                                   'pmParallaxLnL': random_row[3],
+                                   'pmParallaxChi2': random_row[4],
+                                   'pmParallaxNdata': 0}
+        return diaobject_dict
 
-            avro_diaobject['ra_decl_Cov'] = ra_dec_cov
-            avro_diaobject['radecTai'] = diaobject['TAI']
+    def _create_alerts(self, obshistid, diasource_data, diaobject_dict, dmag_cutoff):
+        """
+        Create the alerts of one pointing (without alertIds)
 
-            avro_diaobject['pmRa'] = diaobject['pmRA']
-            avro_diaobject['pmDecl'] = diaobject['pmDec']
-            avro_diaobject['parallax'] = diaobject['parallax']
-            pm_parallax_cov = {}
+        Parameters
+        ----------
+        obshistid is an integer corresponding to the OpSim pointing
+        being simulated
 
-            for field in ('pmRaSigma', 'pmDeclSigma', 'parallaxSigma', 'pmRa_pmDecl_Cov',
-                          'pmRa_parallax_Cov', 'pmDecl_parallax_Cov'):
-                pm_parallax_cov[field] = 0.0
+        diasource_data is a numpy recarray containing the diaSource
+        data of the pointing (see _create_sources)
 
-            avro_diaobject['pm_parallax_Cov'] = pm_parallax_cov
+        diaobject_dict is the output of _create_objects for the
+        trixel containing the diaSources
 
-            avro_diaobject['pmParallaxLnL'] = self._rng.random_sample()
-            avro_diaobject['pmParallaxChi2'] = self._rng.random_sample()
-            avro_diaobject['pmParallaxNdata'] = 0
+        dmag_cutoff is the minimum delta magnitude needed to trigger an alert
 
-            diaobject_dict[diaobject['uniqueId']] = avro_diaobject
-        return diaobject_dict
+        Returns
+        -------
+        A list of dicts, each of which is an avro-formatted alert
+        missing only its alertId.
+        """
+        dmag = 2.5*np.log10(1.0+diasource_data['dflux']/diasource_data['quiescent_flux'])
+        valid_alerts = np.where(np.abs(dmag) >= dmag_cutoff)
+        diasource_data = diasource_data[valid_alerts]
+        avro_diasource_list = self._create_sources(obshistid, diasource_data)
+
+        avro_alert_list = []
+        for unq, avro_diasource in zip(diasource_data['uniqueId'].tolist(),
+                                       avro_diasource_list):
+            avro_alert = {}
+            avro_alert['l1dbId'] = unq
+            avro_alert['diaSource'] = avro_diasource
+            avro_alert['diaObject'] = diaobject_dict[unq]
+            avro_alert_list.append(avro_alert)
+
+        return avro_alert_list
 
     def write_alerts(self, obshistid, data_dir, prefix_list,
                      htmid_list, out_dir, out_prefix,
@@ -213,8 +610,9 @@ class AvroAlertGenerator(object):
         obshistid is the integer uniquely identifying the OpSim pointing
         being simulated
 
-        data_dir is the directory containing the sqlite files created by
-        the AlertDataGenerator
+        data_dir is the directory containing the sqlite files (or the
+        directories of columnar files written with output_format='npy')
+        created by the AlertDataGenerator
 
         prefix_list is a list of prefixes for those sqlite files.
 
@@ -222,7 +620,9 @@ class AvroAlertGenerator(object):
         this obshistid's field of view. For each htmid in htmid_list and each
         prefix in prefix_list, this method will process the files
             data_dir/prefix_htmid_sqlite.db
-        searching for alerts that correspond to this obshistid
+        (or data_dir/prefix_htmid_npy, reading only the alert data
+        of this obshistid) searching for alerts that correspond to
+        this obshistid
 
         out_dir is the directory to which the avro files should be written
 
@@ -236,88 +636,277 @@ class AvroAlertGenerator(object):
 
         log_file_name is the name of an optional text file to which progress is
         written.
+
+        Notes
+        -----
+        Every call re-reads (and re-formats) the baseline_astrometry of
+        each trixel in htmid_list.  To write the alerts of many pointings,
+        write_alerts_by_trixel reads each trixel only once.
         """
 
         out_name = os.path.join(out_dir, '%s_%d.avro' % (out_prefix, obshistid))
         if os.path.exists(out_name):
             os.unlink(out_name)
 
-        with DataFileWriter(open(out_name, "wb"),
-                            DatumWriter(), self._alert_schema) as data_writer:
-
-            diasource_query = 'SELECT alert.uniqueId, alert.xPix, alert.yPix, '
-            diasource_query += 'alert.chipNum, alert.dflux, alert.snr, alert.ra, alert.dec, '
-            diasource_query += 'meta.band, meta.TAI, quiescent.flux, quiescent.snr '
-            diasource_query += 'FROM alert_data as alert '
-            diasource_query += 'INNER JOIN metadata AS meta ON alert.obshistId=meta.obshistId '
-            diasource_query += 'INNER JOIN quiescent_flux AS quiescent ON quiescent.uniqueId=alert.uniqueID '
-            diasource_query += 'AND quiescent.band=meta.band '
-            diasource_query += 'WHERE alert.obshistId=%d ' % obshistid
-            diasource_query += 'ORDER BY alert.uniqueId'
-
-            diasource_dtype = np.dtype([('uniqueId', int), ('xPix', float), ('yPix', float),
-                                        ('chipNum', int), ('dflux', float), ('tot_snr', float),
-                                        ('ra', float), ('dec', float), ('band', int), ('TAI', float),
-                                        ('quiescent_flux', float), ('quiescent_snr', float)])
-
-            diaobject_query = 'SELECT uniqueId, ra, dec, TAI, pmRA, pmDec, parallax '
-            diaobject_query += 'FROM baseline_astrometry'
+        with self._open_writer(out_name) as data_writer:
 
-            diaobject_dtype = np.dtype([('uniqueId', int), ('ra', float), ('dec', float),
-                                        ('TAI', float), ('pmRA', float), ('pmDec', float),
-                                        ('parallax', float)])
+            diasource_query, diasource_dtype = _diasource_query(obshistid)
 
             t_start = time.time()
             alert_ct = 0
+            # avro requires a python int (not a numpy integer) for a long
+            alert_id_offset = int(obshistid) << 20
             for htmid in htmid_list:
                 for prefix in prefix_list:
                     db_name = os.path.join(data_dir, '%s_%d_sqlite.db' % (prefix, htmid))
-                    if not os.path.exists(db_name):
+                    npy_name = os.path.join(data_dir, '%s_%d_npy' % (prefix, htmid))
+                    if os.path.exists(db_name):
+                        db_obj = DBObject(db_name, driver='sqlite')
+
+                        diaobject_data = db_obj.execute_arbitrary(_DIAOBJECT_QUERY,
+                                                                  dtype=_DIAOBJECT_DTYPE)
+
+                        diasource_data = db_obj.execute_arbitrary(diasource_query,
+                                                                  dtype=diasource_dtype)
+                    elif os.path.exists(npy_name):
+                        npy_reader = NpyAlertDataReader(npy_name)
+                        diasource_data = npy_reader.diasource_data(obshistid)
+                        if len(diasource_data) == 0:
+                            continue
+                        diaobject_data = npy_reader.diaobject_data()
+                    else:
                         warnings.warn('%s does not exist' % db_name)
                         continue
 
-                    db_obj = DBObject(db_name, driver='sqlite')
+                    diaobject_dict = self._create_objects(diaobject_data)
 
-                    diaobject_data = db_obj.execute_arbitrary(diaobject_query,
-                                                              dtype=diaobject_dtype)
+                    avro_alert_list = self._create_alerts(obshistid, diasource_data,
+                                                          diaobject_dict, dmag_cutoff)
 
-                    diaobject_dict = self._create_objects(diaobject_data)
+                    for avro_alert in avro_alert_list:
+                        alert_ct += 1
+                        avro_alert['alertId'] = alert_id_offset + alert_ct
+                        data_writer.append(avro_alert)
 
-                    diasource_data = db_obj.execute_arbitrary(diasource_query,
-                                                              dtype=diasource_dtype)
+        elapsed = (time.time()-t_start)/3600.0
 
-                    dmag = 2.5*np.log10(1.0+diasource_data['dflux']/diasource_data['quiescent_flux'])
-                    valid_alerts = np.where(np.abs(dmag) >= dmag_cutoff)
-                    diasource_data = diasource_data[valid_alerts]
-                    avro_diasource_list = self._create_sources(obshistid, diasource_data)
+        msg = 'finished obshistid %d; %d alerts in %.2e hrs' % (obshistid, alert_ct, elapsed)
 
-                    for i_source in range(len(avro_diasource_list)):
-                        alert_ct += 1
-                        unq = diasource_data[i_source]['uniqueId']
-                        diaobject = diaobject_dict[unq]
-                        diasource = avro_diasource_list[i_source]
+        _log_message(msg, lock, log_file_name)
 
-                        avro_alert = {}
-                        avro_alert['alertId'] = np.long((obshistid << 20) + alert_ct)
-                        avro_alert['l1dbId'] = np.long(unq)
-                        avro_alert['diaSource'] = diasource
-                        avro_alert['diaObject'] = diaobject
+    def _fan_out_trixel(self, htmid, alert_queue_list, data_dir, prefix_list,
+                        dmag_cutoff, obshistid_set=None):
+        """
+        Read the alert data of a trixel once, create its diaObjects once
+        and put the alerts of each pointing on alert_queue_list (see
+        write_alerts_by_trixel)
 
-                        data_writer.append(avro_alert)
+        Parameters
+        ----------
+        htmid is the htmid of the trixel
 
-        if lock is not None:
-            lock.acquire()
+        alert_queue_list is a list of multiprocessing.Queues.  The alerts
+        of obshistid are put on alert_queue_list[obshistid % len(alert_queue_list)]
+        as (obshistid, alert_list) tuples (one per pointing per prefix).
 
-        elapsed = (time.time()-t_start)/3600.0
+        data_dir, prefix_list and dmag_cutoff are as in write_alerts
 
-        msg = 'finished obshistid %d; %d alerts in %.2e hrs' % (obshistid, alert_ct, elapsed)
+        obshistid_set is an optional set of the obsHistIDs whose alerts
+        should be written (default all of them)
 
-        print(msg)
+        Returns
+        -------
+        The number of alerts put on the queues
+        """
+        diasource_query, diasource_dtype = _diasource_query()
+
+        n_alerts = 0
+        for prefix in prefix_list:
+            db_name = os.path.join(data_dir, '%s_%d_sqlite.db' % (prefix, htmid))
+            npy_name = os.path.join(data_dir, '%s_%d_npy' % (prefix, htmid))
+            if os.path.exists(db_name):
+                db_obj = DBObject(db_name, driver='sqlite')
+                diaobject_data = db_obj.execute_arbitrary(_DIAOBJECT_QUERY,
+                                                          dtype=_DIAOBJECT_DTYPE)
+                diasource_data = db_obj.execute_arbitrary(diasource_query,
+                                                          dtype=diasource_dtype)
+
+                # the rows are sorted on obshistId
+                (obshistid_arr,
+                 i_start) = np.unique(diasource_data['obshistId'], return_index=True)
+                i_end = np.append(i_start[1:], len(diasource_data))
+                obs_data_list = [(obshistid, diasource_data[i_start[i_obs]:i_end[i_obs]])
+                                 for i_obs, obshistid in enumerate(obshistid_arr.tolist())]
+            elif os.path.exists(npy_name):
+                npy_reader = NpyAlertDataReader(npy_name)
+                diaobject_data = npy_reader.diaobject_data()
+                # the npy files are partitioned on obshistid; only read
+                # the partitions that are needed
+                obs_data_list = [(obshistid, None) for obshistid in npy_reader.obshistid_list]
+            else:
+                warnings.warn('%s does not exist' % db_name)
+                continue
+
+            diaobject_dict = self._create_objects(diaobject_data)
+
+            for obshistid, obs_diasource_data in obs_data_list:
+                if obshistid_set is not None and obshistid not in obshistid_set:
+                    continue
+                if obs_diasource_data is None:
+                    obs_diasource_data = npy_reader.diasource_data(obshistid)
+                avro_alert_list = self._create_alerts(obshistid, obs_diasource_data,
+                                                      diaobject_dict, dmag_cutoff)
+                if len(avro_alert_list) == 0:
+                    continue
+                alert_queue_list[obshistid % len(alert_queue_list)].put((obshistid,
+                                                                         avro_alert_list))
+                n_alerts += len(avro_alert_list)
+
+        return n_alerts
+
+    def write_alerts_by_trixel(self, data_dir, prefix_list, htmid_list,
+                               out_dir, out_prefix, dmag_cutoff,
+                               n_proc=1, n_writers=1, max_open_files=64,
+                               obshistid_list=None, log_file_name=None):
+        """
+        Write the alerts of every pointing overlapping the trixels in
+        htmid_list to avro files named out_dir/out_prefix_obshistid.avro
+        (the same alerts written by calling write_alerts on each obsHistID,
+        except for the random flags and covariances; see Notes).
+
+        Rather than reading every trixel once per pointing, this method
+        reads each trixel's data file (and creates its diaObjects) once.
+        n_proc processes pull trixels off of a queue and pass the alerts
+        of each pointing to n_writers writer processes; each pointing is
+        written by the process obshistid % n_writers, which keeps at most
+        max_open_files avro files open at once.
 
-        if log_file_name is not None:
-            with open(log_file_name, 'a') as out_file:
-                out_file.write(msg)
-                out_file.write('\n')
+        Parameters
+        ----------
+        data_dir, prefix_list, out_dir, out_prefix and dmag_cutoff are
+        as in write_alerts
 
-        if lock is not None:
-            lock.release()
+        htmid_list is the list of htmids of the trixels to process
+        (e.g. the keys of the dict returned by AlertDataGenerator.run_parallel;
+        if run_parallel split any trixels, AlertDataGenerator.htmid_list
+        lists the parents, whose files do not exist, rather than the
+        children).  The alerts of a trixel are held in memory while it
+        is being processed.
+
+        n_proc is the number of processes reading trixels
+
+        n_writers is the number of processes writing avro files
+
+        max_open_files is the maximum number of avro files each writer
+        process keeps open
+
+        obshistid_list is an optional list of the obsHistIDs to write
+        (default every obsHistID in the data files)
+
+        log_file_name is the name of an optional text file to which progress
+        is written
+
+        Returns
+        -------
+        A dict mapping obsHistID to the number of alerts written.  No file
+        is written for pointings without any alerts.
+
+        Notes
+        -----
+        The alerts are assigned the same diaSourceIds as they would be
+        by calling write_alerts on the pointings in ascending order of
+        obsHistID (the diaSource counters of this AvroAlertGenerator are
+        not updated, since they are only incremented in the child processes).
+        The alertIds of a pointing are unique, but their order depends on
+        the order in which the trixels are finished.
+
+        The random flags and covariances of each trixel's diaSources and
+        diaObjects are drawn from a stream seeded with 7123 and the htmid,
+        so they are reproducible whatever n_proc is, but differ from those
+        drawn by write_alerts.
+        """
+        if max_open_files < 1:
+            raise RuntimeError('max_open_files must be at least 1; you gave %d' % max_open_files)
+
+        trixel_kwargs = {'data_dir': data_dir,
+                         'prefix_list': prefix_list,
+                         'dmag_cutoff': dmag_cutoff,
+                         'obshistid_set': None if obshistid_list is None else set(obshistid_list)}
+
+        lock = mproc.Lock()
+        task_queue = mproc.Queue()
+        result_queue = mproc.Queue()
+        writer_result_queue = mproc.Queue()
+
+        # bound the number of unwritten batches held in memory
+        alert_queue_list = [mproc.Queue(maxsize=4*n_proc) for i_w in range(n_writers)]
+
+        for htmid in htmid_list:
+            task_queue.put(htmid)
+        for i_p in range(n_proc):
+            task_queue.put(None)
+
+        writer_list = []
+        for alert_queue in alert_queue_list:
+            p = mproc.Process(target=_avro_writer_worker,
+                              args=(self, out_dir, out_prefix,
+                                    max_open_files, alert_queue, writer_result_queue))
+            p.start()
+            writer_list.append(p)
+
+        p_list = []
+        for i_p in range(n_proc):
+            p = mproc.Process(target=_avro_trixel_worker,
+                              args=(self, task_queue, alert_queue_list, result_queue,
+                                    lock, log_file_name, trixel_kwargs))
+            p.start()
+            p_list.append(p)
+
+        trixel_results = {}
+        while len(trixel_results) < len(htmid_list):
+            try:
+                htmid, n_alerts = result_queue.get(timeout=1.0)
+            except Empty:
+                if not all([p.is_alive() for p in writer_list]):
+                    # the readers could block forever on a full queue
+                    for p in p_list + writer_list:
+                        p.terminate()
+                    raise RuntimeError('An avro writer process died; '
+                                       'the files in %s are incomplete' % out_dir)
+                if not any([p.is_alive() for p in p_list]) and result_queue.empty():
+                    break
+                continue
+            trixel_results[htmid] = n_alerts
+
+        for p in p_list:
+            p.join()
+
+        for alert_queue in alert_queue_list:
+            alert_queue.put(None)
+
+        writer_results = []
+        while len(writer_results) < n_writers:
+            try:
+                writer_results.append(writer_result_queue.get(timeout=1.0))
+            except Empty:
+                if not any([p.is_alive() for p in writer_list]) and writer_result_queue.empty():
+                    break
+
+        for p in writer_list:
+            p.join()
+
+        failed_htmid = sorted([htmid for htmid in htmid_list
+                               if trixel_results.get(htmid, None) is None])
+
+        error_list = [error for n_alerts, error in writer_results if error is not None]
+        if len(writer_results) < n_writers:
+            error_list.append('%d writer processes did not report' % (n_writers-len(writer_results)))
+
+        if len(failed_htmid) > 0 or len(error_list) > 0:
+            raise RuntimeError('write_alerts_by_trixel failed; '
+                               'htmids: %s; writer errors: %s' % (str(failed_htmid), str(error_list)))
+
+        alert_ct = {}
+        for n_alerts, error in writer_results:
+            alert_ct.update(n_alerts)
+        return alert_ct
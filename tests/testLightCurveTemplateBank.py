@@ -0,0 +1,139 @@
+import unittest
+import os
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catUtils.mixins import LightCurveTemplateBank
+from lsst.sims.catUtils.mixins import write_light_curve_template_bank
+from lsst.sims.catUtils.mixins import StellarVariabilityModels
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class LightCurveTemplateBankTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Write some fake periodic and microlensing light curve templates
+        """
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='LightCurveTemplateBankTestCase-')
+        cls.data_dir = os.path.join(cls.scratch_dir, 'data')
+        rng = np.random.RandomState(6612)
+
+        cls.rrly_names = []
+        os.makedirs(os.path.join(cls.data_dir, 'rrly_lc', 'RRab'))
+        for i_lc in range(3):
+            name = os.path.join('rrly_lc', 'RRab', '%d_per.txt' % i_lc)
+            period = rng.random_sample()*0.5+0.3
+            tt = np.arange(0.0, period, period/300.0)
+            cols = [tt]
+            for i_band in range(6):
+                cols.append(rng.random_sample()*np.sin(2.0*np.pi*tt/period+i_band) +
+                            0.1*np.cos(4.0*np.pi*tt/period))
+            np.savetxt(os.path.join(cls.data_dir, name), np.array(cols).transpose(),
+                       header='time u g r i z y')
+            cls.rrly_names.append(name)
+
+        cls.bh_names = []
+        os.makedirs(os.path.join(cls.data_dir, 'microlens', 'bh_binary_source'))
+        for i_lc in range(2):
+            name = os.path.join('microlens', 'bh_binary_source', 'lc_%d' % i_lc)
+            tt = np.arange(0.0, 2.0, 0.01)
+            mag = 1.0 + rng.random_sample()*np.exp(-0.5*((tt-1.0)/0.2)**2)
+            np.savetxt(os.path.join(cls.data_dir, name), np.array([tt, mag]).transpose())
+            cls.bh_names.append(name)
+
+        # a file that is not a light curve
+        with open(os.path.join(cls.data_dir, 'rrly_lc', 'README'), 'w') as out_file:
+            out_file.write('these are RR Lyrae light curves\n')
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def test_bank_contents(self):
+        """
+        Test that the templates read from the bank are identical to
+        those read from the ASCII files
+        """
+        bank_name = os.path.join(self.scratch_dir, 'contents_bank.dat')
+        bank = write_light_curve_template_bank(bank_name, data_dir=self.data_dir)
+        self.assertEqual(len(bank), len(self.rrly_names)+len(self.bh_names))
+        self.assertNotIn(os.path.join('rrly_lc', 'README'), bank)
+
+        bank = LightCurveTemplateBank(bank_name)
+        for name in self.rrly_names + self.bh_names:
+            self.assertIn(name, bank)
+            control = np.loadtxt(os.path.join(self.data_dir, name), unpack=True, comments='#')
+            test = bank.get(name)
+            np.testing.assert_array_equal(test, control, err_msg=name)
+            self.assertFalse(test.flags.writeable)
+
+        with self.assertRaises(RuntimeError):
+            bank.get('rrly_lc/RRab/not_a_file.txt')
+
+        with self.assertRaises(RuntimeError):
+            write_light_curve_template_bank(bank_name, data_dir=self.data_dir)
+
+    def test_variability_models(self):
+        """
+        Test that applyRRly and applyBHMicrolens give the same results
+        whether templates are read from the bank or the ASCII files
+        """
+        bank_name = os.path.join(self.scratch_dir, 'model_bank.dat')
+        write_light_curve_template_bank(bank_name, data_dir=self.data_dir)
+
+        rng = np.random.RandomState(1245)
+        n_obj = 12
+        mjd_arr = rng.random_sample(9)*3653.3+59580.0
+
+        rrly_params = {}
+        rrly_params['filename'] = np.array([self.rrly_names[ii]
+                                            for ii in rng.randint(0, len(self.rrly_names), n_obj)])
+        rrly_params['tStartMjd'] = rng.random_sample(n_obj)*1000.0+40000.0
+
+        bh_params = {}
+        bh_params['filename'] = np.array([self.bh_names[ii]
+                                          for ii in rng.randint(0, len(self.bh_names), n_obj)])
+        bh_params['t0'] = rng.random_sample(n_obj)*730.0+59580.0
+
+        valid_dexes = [np.array([0, 1, 2, 4, 5, 7, 8, 11])]
+
+        results = []
+        for bank_file in (None, bank_name):
+            star_var = StellarVariabilityModels()
+            star_var.initializeVariability(doCache=True)
+            star_var.variabilityDataDir = self.data_dir
+            star_var._lc_template_bank_file = bank_file
+            results.append((star_var.applyRRly(valid_dexes, rrly_params, mjd_arr),
+                            star_var.applyBHMicrolens(valid_dexes, bh_params, mjd_arr),
+                            star_var.applyBHMicrolens(valid_dexes, bh_params, mjd_arr[3])))
+
+        for control, test in zip(results[0], results[1]):
+            np.testing.assert_array_equal(control, test)
+
+        # the scalar and vector expmjd results must agree
+        np.testing.assert_array_equal(results[1][1][:, :, 3], results[1][2])
+
+        # objects that do not use the model get no variability
+        for i_obj in (3, 6, 9, 10):
+            np.testing.assert_array_equal(results[1][1][:, i_obj, :], 0.0)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -458,6 +458,134 @@ class MLT_flare_test_case(unittest.TestCase):
                     else:
                         self.assertEqual(delta_mag_vector[i_band][i_obj][i_time], 0.0)
 
+    def test_MLT_block_size(self):
+        """
+        Test that applyMLTflaring does not depend on the number of
+        (object, time) pairs it evaluates at once, and that epochs
+        many light curve durations past the end of the light curve
+        are folded back onto the light curve correctly
+        """
+        rng = np.random.RandomState(812)
+        n_obj = 40
+        mjd_arr = rng.random_sample(23)*3653.3+59580.0
+
+        params = {}
+        params['lc'] = np.array(['lc_1.txt', 'lc_2.txt', 'None'])[rng.randint(0, 3, size=n_obj)]
+        params['t0'] = rng.random_sample(n_obj)*1.0e5
+
+        parallax = radiansFromArcsec(rng.random_sample(n_obj)*0.2+0.01)
+        ebv = rng.random_sample(n_obj)*2.0
+        quiescent_mags = {}
+        quiescent_mags['u'] = rng.random_sample(n_obj)*4.0+18.0
+        quiescent_mags['g'] = rng.random_sample(n_obj)*4.0+18.0
+
+        results = []
+        for block_size in (1000000, 17, 1):
+            mlt_obj = MLTflaringMixin()
+            mlt_obj.photParams = PhotometricParameters()
+            mlt_obj.lsstBandpassDict = BandpassDict.loadTotalBandpassesFromFiles()
+            mlt_obj._mlt_lc_file = self.mlt_lc_name
+            mlt_obj._actually_calculated_columns = ['delta_lsst_u', 'delta_lsst_g']
+            mlt_obj._mlt_block_size = block_size
+            results.append(mlt_obj.applyMLTflaring([np.arange(n_obj, dtype=int)], params, mjd_arr,
+                                                   parallax=parallax, ebv=ebv,
+                                                   quiescent_mags=quiescent_mags))
+
+        self.assertEqual(results[0].shape, (6, n_obj, len(mjd_arr)))
+        np.testing.assert_array_equal(results[0], results[1])
+        np.testing.assert_array_equal(results[0], results[2])
+
+        # compare with folding the epochs one light curve duration at a time
+        ss = Sed()
+        for i_obj in range(n_obj):
+            if params['lc'][i_obj] == 'None':
+                np.testing.assert_array_equal(results[0][:, i_obj, :], 0.0)
+                continue
+            if params['lc'][i_obj] == 'lc_1.txt':
+                time_arr = np.arange(0.0, 3652.51, 0.1)
+                u_flux = 1.0e42*(1.0+np.power(np.sin(time_arr/100.0), 2))
+            else:
+                time_arr = np.arange(0.0, 365.251, 0.01)
+                u_flux = 2.0e41*(1.0+np.power(np.sin(time_arr/50.0), 2))
+            time_arr = time_arr + mlt_obj._survey_start
+            dt = time_arr.max() - time_arr.min()
+            for i_time, mjd in enumerate(mjd_arr):
+                tt = mjd + params['t0'][i_obj]
+                while tt > time_arr.max():
+                    tt -= dt
+                dflux = np.interp(tt, time_arr, u_flux)
+                dflux *= 1.0/(4.0*np.pi*np.power(3.08576e18/(206265.0*parallax[i_obj]), 2))
+                dflux *= np.interp(ebv[i_obj], mlt_obj._mlt_dust_lookup['ebv'],
+                                   mlt_obj._mlt_dust_lookup['u'])
+                base_flux = ss.fluxFromMag(quiescent_mags['u'][i_obj])
+                control = ss.magFromFlux(base_flux + dflux) - quiescent_mags['u'][i_obj]
+                self.assertAlmostEqual(results[0][0][i_obj][i_time], control, 6)
+
+    def test_mlt_dust_lookup(self):
+        """
+        Test that the table of dust attenuation factors for flares matches
+        applying dust to a black body one E(B-V) at a time, and that it is
+        cached on disk
+        """
+        from lsst.sims.catUtils.mixins.VariabilityMixin import _GLOBAL_MLT_DUST_LOOKUPS
+        from lsst.sims.catUtils.mixins.VariabilityMixin import _mlt_dust_lookup_key
+
+        bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
+        cache_dir = tempfile.mkdtemp(dir=self.scratch_dir, prefix='dust_lookup_')
+
+        mlt_obj = MLTflaringMixin()
+        mlt_obj.lsstBandpassDict = bp_dict
+        mlt_obj._mlt_dust_lookup_dir = cache_dir
+        key = _mlt_dust_lookup_key(bp_dict, mlt_obj._mlt_flare_temperature)
+        _GLOBAL_MLT_DUST_LOOKUPS.pop(key, None)
+        dust_lookup = mlt_obj._get_mlt_dust_lookup()
+        self.assertEqual(os.listdir(cache_dir), ['mlt_dust_lookup_%s.npz' % key])
+
+        bb_wavelen = np.arange(200.0, 1500.0, 0.1)
+        exp_term = 1.0/(np.exp(1.4387e7/(9000.0*bb_wavelen)) - 1.0)
+        bb_flambda = np.exp(-5.0*np.log(bb_wavelen) + np.log(exp_term))
+        bb_sed = Sed(wavelen=bb_wavelen, flambda=bb_flambda)
+        base_fluxes = bp_dict.fluxListForSed(bb_sed)
+        a_x, b_x = bb_sed.setupCCM_ab()
+        for i_ebv in (0, 1, 17, 250, 700):
+            ebv_val = dust_lookup['ebv'][i_ebv]
+            wv, fl = bb_sed.addDust(a_x, b_x, ebv=ebv_val,
+                                    wavelen=bb_wavelen, flambda=bb_flambda)
+            dusty_fluxes = bp_dict.fluxListForSed(Sed(wavelen=wv, flambda=fl))
+            for i_bp, bp in enumerate(bp_dict.keys()):
+                self.assertAlmostEqual(dust_lookup[bp][i_ebv],
+                                       dusty_fluxes[i_bp]/base_fluxes[i_bp], 10)
+
+        # the table is shared by other catalogs in this process...
+        other_obj = MLTflaringMixin()
+        other_obj.lsstBandpassDict = bp_dict
+        other_obj._mlt_dust_lookup_dir = cache_dir
+        self.assertIs(other_obj._get_mlt_dust_lookup(), dust_lookup)
+
+        # ...and read back from disk by new processes
+        _GLOBAL_MLT_DUST_LOOKUPS.pop(key)
+        from_disk = other_obj._get_mlt_dust_lookup()
+        self.assertEqual(set(from_disk.keys()), set(dust_lookup.keys()))
+        for name in dust_lookup:
+            np.testing.assert_array_equal(from_disk[name], dust_lookup[name])
+
+        # by default, the table is cached in the user's cache directory,
+        # not next to the MLT light curves in sims_data
+        default_dir = tempfile.mkdtemp(dir=self.scratch_dir, prefix='default_dust_lookup_')
+        old_env = os.environ.get('SIMS_CATUTILS_CACHE_DIR', None)
+        os.environ['SIMS_CATUTILS_CACHE_DIR'] = default_dir
+        try:
+            default_obj = MLTflaringMixin()
+            default_obj.lsstBandpassDict = bp_dict
+            _GLOBAL_MLT_DUST_LOOKUPS.pop(key)
+            default_obj._get_mlt_dust_lookup()
+            self.assertEqual(os.listdir(default_dir), ['mlt_dust_lookup_%s.npz' % key])
+        finally:
+            if old_env is None:
+                os.environ.pop('SIMS_CATUTILS_CACHE_DIR')
+            else:
+                os.environ['SIMS_CATUTILS_CACHE_DIR'] = old_env
+
     def test_mlt_clean_up(self):
         """
         Test that the MLT cache is correctly loaded after sims_clean_up is
@@ -0,0 +1,188 @@
+import unittest
+import os
+import gzip
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catUtils.mixins import read_parametrized_light_curve_file
+from lsst.sims.catUtils.mixins import load_parametrized_light_curve_catalog
+from lsst.sims.catUtils.mixins import merge_parametrized_light_curve_catalogs
+from lsst.sims.catUtils.mixins import ParametrizedLightCurveMixin
+from lsst.sims.catUtils.mixins.VariabilityMixin import create_variability_cache
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+def write_fake_lc_file(file_name, id_list, rng):
+    """
+    Write a gzipped parametrized light curve catalog with random
+    coefficients for the light curves in id_list.  Return a dict
+    keyed on id containing the coefficients.
+    """
+    truth = {}
+    with gzip.open(file_name, 'w') as out_file:
+        out_file.write(b'# a header\n')
+        for lc_id in id_list:
+            n_c = rng.randint(1, 9)
+            median = rng.random_sample()*100.0+100.0
+            coeffs = rng.random_sample((n_c, 5))
+            out_file.write(b'kplr%d_lc.txt 100 1.0e+02 %d ' % (lc_id, n_c))
+            for i_c in range(n_c):
+                out_file.write(b'%e ' % (1.0/(i_c+1)))
+            out_file.write(b'%.17e ' % median)
+            for i_c in range(n_c):
+                out_file.write(b'%.17e %.17e %.17e %.17e %.17e ' % tuple(coeffs[i_c]))
+            out_file.write(b'\n')
+            truth[lc_id] = (median, coeffs)
+    return truth
+
+
+class ParametrizedLightCurveCatalogTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='ParametrizedLightCurveCatalogTestCase-')
+
+    def tearDown(self):
+        if os.path.exists(self.scratch_dir):
+            shutil.rmtree(self.scratch_dir)
+
+    def test_read_file(self):
+        """
+        Test that the CSR arrays read from an ASCII catalog match its contents
+        """
+        rng = np.random.RandomState(4412)
+        file_name = os.path.join(self.scratch_dir, 'lc_params.txt.gz')
+        id_list = rng.choice(np.arange(1000, 2000), size=30, replace=False)
+        truth = write_fake_lc_file(file_name, id_list, rng)
+
+        catalog = read_parametrized_light_curve_file(file_name)
+        np.testing.assert_array_equal(catalog['ids'], np.sort(id_list))
+        for row, lc_id in enumerate(catalog['ids']):
+            median, coeffs = truth[lc_id]
+            i_start = catalog['offsets'][row]
+            i_end = catalog['offsets'][row+1]
+            self.assertEqual(i_end-i_start, catalog['n_components'][row])
+            self.assertEqual(catalog['median'][row], median)
+            for i_name, name in enumerate(('a', 'b', 'c', 'omega', 'tau')):
+                np.testing.assert_array_equal(catalog[name][i_start:i_end], coeffs[:, i_name])
+            self.assertEqual(catalog['quiescent'][row], median+coeffs[:, 2].sum())
+
+    def test_cache(self):
+        """
+        Test that the binary cache is written, memory-mapped on the
+        next load, and rebuilt when the ASCII catalog changes
+        """
+        rng = np.random.RandomState(88)
+        file_name = os.path.join(self.scratch_dir, 'lc_params.txt.gz')
+        cache_dir = os.path.join(self.scratch_dir, 'cache')
+        os.mkdir(cache_dir)
+        write_fake_lc_file(file_name, np.arange(50, 90), rng)
+
+        control = load_parametrized_light_curve_catalog(file_name, cache_dir=cache_dir)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, 'lc_params.txt.gz.cache', 'index.json')))
+        self.assertNotIsInstance(control['a'], np.memmap)
+
+        test = load_parametrized_light_curve_catalog(file_name, cache_dir=cache_dir)
+        self.assertIsInstance(test['a'], np.memmap)
+        self.assertEqual(set(test.keys()), set(control.keys()))
+        for name in control:
+            np.testing.assert_array_equal(test[name], control[name])
+
+        # the cache is not used if the source file has changed
+        write_fake_lc_file(file_name, np.arange(50, 95), rng)
+        stat = os.stat(file_name)
+        os.utime(file_name, (stat.st_atime, stat.st_mtime+10.0))
+        test = load_parametrized_light_curve_catalog(file_name, cache_dir=cache_dir)
+        self.assertNotIsInstance(test['a'], np.memmap)
+        self.assertEqual(len(test['ids']), 45)
+        test = load_parametrized_light_curve_catalog(file_name, cache_dir=cache_dir)
+        self.assertIsInstance(test['a'], np.memmap)
+        self.assertEqual(len(test['ids']), 45)
+
+        # no temporary directories are left behind
+        self.assertEqual(os.listdir(cache_dir), ['lc_params.txt.gz.cache'])
+
+    def test_merge(self):
+        """
+        Test that merging catalogs sorts their light curves and
+        refuses duplicate ids
+        """
+        rng = np.random.RandomState(1732)
+        file_1 = os.path.join(self.scratch_dir, 'lc_params_1.txt.gz')
+        file_2 = os.path.join(self.scratch_dir, 'lc_params_2.txt.gz')
+        file_3 = os.path.join(self.scratch_dir, 'lc_params_3.txt.gz')
+        write_fake_lc_file(file_1, np.arange(0, 40, 2), rng)
+        write_fake_lc_file(file_2, np.arange(1, 40, 2), rng)
+        write_fake_lc_file(file_3, np.array([7]), rng)
+        catalog_1 = read_parametrized_light_curve_file(file_1)
+        catalog_2 = read_parametrized_light_curve_file(file_2)
+
+        merged = merge_parametrized_light_curve_catalogs([catalog_1, catalog_2])
+        np.testing.assert_array_equal(merged['ids'], np.arange(40))
+        for catalog in (catalog_1, catalog_2):
+            for row, lc_id in enumerate(catalog['ids']):
+                merged_row = np.searchsorted(merged['ids'], lc_id)
+                for name in ('a', 'b', 'c', 'omega', 'tau'):
+                    np.testing.assert_array_equal(merged[name][merged['offsets'][merged_row]:
+                                                               merged['offsets'][merged_row+1]],
+                                                  catalog[name][catalog['offsets'][row]:
+                                                                catalog['offsets'][row+1]])
+
+        with self.assertRaises(RuntimeError):
+            merge_parametrized_light_curve_catalogs([merged,
+                                                     read_parametrized_light_curve_file(file_3)])
+
+        # the same thing through the mixin
+        variability_cache = create_variability_cache()
+        plc = ParametrizedLightCurveMixin()
+        plc.load_parametrized_light_curves(file_1, variability_cache=variability_cache)
+        plc.load_parametrized_light_curves(file_2, variability_cache=variability_cache)
+        with self.assertRaises(RuntimeError):
+            plc.load_parametrized_light_curves(file_3, variability_cache=variability_cache)
+        self.assertEqual(variability_cache['_PARAMETRIZED_MODELS_LOADED'], [file_1, file_2])
+
+    def test_mixin_with_cache(self):
+        """
+        Test that ParametrizedLightCurveMixin gives the same magnitudes
+        whether or not its models were read from the binary cache
+        """
+        rng = np.random.RandomState(6675)
+        file_name = os.path.join(self.scratch_dir, 'lc_params.txt.gz')
+        cache_dir = os.path.join(self.scratch_dir, 'cache')
+        os.mkdir(cache_dir)
+        write_fake_lc_file(file_name, np.arange(100, 160), rng)
+
+        params = {}
+        params['lc'] = rng.randint(99, 160, size=100)
+        params['lc'][np.where(params['lc'] == 99)] = -1
+        params['t0'] = rng.random_sample(100)*1000.0
+        expmjd = rng.random_sample(11)*3000.0+59580.0
+
+        results = []
+        for i_load in range(3):
+            variability_cache = create_variability_cache()
+            plc = ParametrizedLightCurveMixin()
+            plc.load_parametrized_light_curves(file_name, variability_cache=variability_cache,
+                                               cache_dir=None if i_load == 0 else cache_dir)
+            results.append(plc.applyParametrizedLightCurve([], params, expmjd,
+                                                           variability_cache=variability_cache))
+
+        np.testing.assert_array_equal(results[0], results[1])
+        np.testing.assert_array_equal(results[0], results[2])
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 import tempfile
 import gzip
 import os
+import shutil
 import numpy as np
 
 import lsst.utils.tests
@@ -367,6 +368,69 @@ class ParametrizedLightCurve_testCase(unittest.TestCase):
         if os.path.exists(lc_temp_file_name):
             os.unlink(lc_temp_file_name)
 
+    def test_applyParametrizedLightCurve_blocks(self):
+        """
+        Test that applyParametrizedLightCurve gives the same answer
+        regardless of how many objects are evaluated at once, even
+        when the light curves have different numbers of Fourier
+        components
+        """
+        lc_temp_file_name = tempfile.mktemp(prefix='test_applyParametrizedLightCurve_blocks',
+                                            suffix='.gz')
+
+        rng = np.random.RandomState(88123)
+        n_lc = 20
+        with gzip.open(lc_temp_file_name, 'w') as out_file:
+            out_file.write(b'# a header\n')
+            for i_lc in range(n_lc):
+                n_c = rng.randint(1, 15)
+                out_file.write(b'kplr%d_lc.txt 100 1.0e+02 %d ' % (999800000+i_lc, n_c))
+                for i_c in range(n_c):
+                    out_file.write(b'%e ' % (1.0/(i_c+1)))
+                out_file.write(b'%e ' % (rng.random_sample()*100.0+100.0))
+                for i_c in range(n_c):
+                    out_file.write(b'%.15e %.15e %.15e %.15e %.15e ' %
+                                   (rng.random_sample()*5.0,
+                                    (rng.random_sample()-0.5)*2.0,
+                                    (rng.random_sample()-0.5)*0.1,
+                                    rng.random_sample()*20.0,
+                                    rng.random_sample()*100.0))
+                out_file.write(b'\n')
+
+        n_obj = 200
+        params = {}
+        params['lc'] = rng.randint(999800000, 999800000+n_lc, size=n_obj)
+        params['lc'][::7] = -1
+        params['t0'] = rng.random_sample(n_obj)*1000.0
+
+        kp = ParametrizedLightCurveMixin()
+        kp.load_parametrized_light_curves(lc_temp_file_name)
+
+        expmjd = rng.random_sample(12)*10000.0 + 59580.0
+        d_mag_control = kp.applyParametrizedLightCurve([], params, expmjd)
+        self.assertEqual(d_mag_control.shape, (6, n_obj, len(expmjd)))
+
+        kp._parametrized_lc_block_size = 50
+        d_mag_test = kp.applyParametrizedLightCurve([], params, expmjd)
+        np.testing.assert_array_equal(d_mag_test, d_mag_control)
+
+        for i_obj in range(n_obj):
+            if params['lc'][i_obj] < 0:
+                np.testing.assert_array_equal(d_mag_control[:, i_obj, :], 0.0)
+                continue
+            q_flux, d_flux = kp._calc_dflux(params['lc'][i_obj],
+                                            expmjd-params['t0'][i_obj])
+            d_mag_truth = -2.5*np.log10(1.0+d_flux/q_flux)
+            for i_filter in range(6):
+                np.testing.assert_array_equal(d_mag_control[i_filter][i_obj], d_mag_truth)
+
+        with self.assertRaises(KeyError):
+            kp._calc_dflux(999700000, expmjd)
+
+        sims_clean_up()
+        if os.path.exists(lc_temp_file_name):
+            os.unlink(lc_temp_file_name)
+
     def test_ParametrizedLightCurve_in_catalog(self):
         """
         Test the performance of applyParametrizedLightCurve()
@@ -488,6 +552,41 @@ class ParametrizedLightCurve_testCase(unittest.TestCase):
         if os.path.exists(lc_temp_file_name):
             os.unlink(lc_temp_file_name)
 
+    def test_variability_cache_dir(self):
+        """
+        Test that binary caches of the sims_data light curves go to
+        $SIMS_CATUTILS_CACHE_DIR (or ~/.cache), never to sims_data
+        """
+        from lsst.sims.catUtils.mixins.VariabilityMixin import _variability_cache_dir
+
+        scratch_dir = tempfile.mkdtemp(prefix='test_variability_cache_dir_')
+        old_env = {}
+        for env_name in ('SIMS_CATUTILS_CACHE_DIR', 'XDG_CACHE_HOME'):
+            old_env[env_name] = os.environ.pop(env_name, None)
+        try:
+            os.environ['XDG_CACHE_HOME'] = scratch_dir
+            self.assertEqual(_variability_cache_dir(),
+                             os.path.join(scratch_dir, 'sims_catUtils'))
+            self.assertTrue(os.path.isdir(os.path.join(scratch_dir, 'sims_catUtils')))
+
+            cache_dir = os.path.join(scratch_dir, 'explicit', 'cache')
+            os.environ['SIMS_CATUTILS_CACHE_DIR'] = cache_dir
+            self.assertEqual(_variability_cache_dir(), cache_dir)
+            self.assertTrue(os.path.isdir(cache_dir))
+
+            # a directory which cannot be created means no cache
+            blocker = os.path.join(scratch_dir, 'a_file')
+            open(blocker, 'w').close()
+            os.environ['SIMS_CATUTILS_CACHE_DIR'] = os.path.join(blocker, 'cache')
+            self.assertIsNone(_variability_cache_dir())
+        finally:
+            for env_name in old_env:
+                if old_env[env_name] is None:
+                    os.environ.pop(env_name, None)
+                else:
+                    os.environ[env_name] = old_env[env_name]
+            shutil.rmtree(scratch_dir)
+
 
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
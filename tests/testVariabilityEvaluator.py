@@ -0,0 +1,207 @@
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catalogs.decorators import register_method
+from lsst.sims.catUtils.mixins import StellarVariabilityModels
+from lsst.sims.catUtils.mixins import ExtraGalacticVariabilityModels
+from lsst.sims.catUtils.mixins import VariabilityEvaluator
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class CountingVariabilityModels(StellarVariabilityModels):
+    """
+    A variability model which records every (object, epoch) pair at
+    which it is evaluated
+    """
+
+    def __init__(self):
+        self.evaluated = []
+
+    @register_method('counting')
+    def applyCounting(self, valid_dexes, params, expmjd,
+                      variability_cache=None):
+        if len(params) == 0:
+            return np.array([[], [], [], [], [], []])
+        expmjd = np.asarray(expmjd, dtype=float)
+        n_obj = self.num_variable_obj(params)
+        dmag = np.zeros((6, n_obj, len(expmjd)))
+        for i_obj in valid_dexes[0]:
+            for mjd in expmjd:
+                self.evaluated.append((i_obj, mjd))
+            for i_band in range(6):
+                dmag[i_band][i_obj] = (params['amp'][i_obj]*np.sin(expmjd/(i_band+1.0)))
+        return dmag
+
+
+class ExactAgnCountingModels(CountingVariabilityModels, ExtraGalacticVariabilityModels):
+    """
+    CountingVariabilityModels plus AGN simulated exactly at the
+    requested epochs
+    """
+
+    _agn_walk_mode = 'exact'
+
+    def column_by_name(self, col_name):
+        return self.redshift_arr
+
+
+class VariabilityEvaluatorTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='VariabilityEvaluatorTestCase-')
+        rng = np.random.RandomState(7712)
+        self.n_obj = 12
+        self.simobjid = np.arange(100, 100+self.n_obj)
+        var_param_list = []
+        for i_obj in range(self.n_obj):
+            if i_obj % 5 == 0:
+                var_param_list.append('None')
+                continue
+            var_param_list.append(json.dumps({'m': 'counting',
+                                              'p': {'amp': rng.random_sample()}}))
+        self.var_params = np.array(var_param_list)
+
+    def tearDown(self):
+        if os.path.exists(self.scratch_dir):
+            shutil.rmtree(self.scratch_dir)
+
+    def test_only_missing_epochs(self):
+        """
+        Test that the evaluator matches applyVariability and only
+        evaluates the models at epochs it has not seen before
+        """
+        model = CountingVariabilityModels()
+        evaluator = VariabilityEvaluator(model)
+
+        mjd_1 = np.array([60000.0, 60001.5, 60003.0, 60010.0])
+        test = evaluator.evaluate(self.simobjid, self.var_params, mjd_1)
+        control = model.applyVariability(self.var_params, expmjd=mjd_1)
+        np.testing.assert_array_equal(test, control)
+        self.assertEqual(evaluator.n_hits, 0)
+        self.assertEqual(evaluator.n_misses, self.n_obj*len(mjd_1))
+        self.assertEqual(evaluator.n_entries, self.n_obj*len(mjd_1))
+
+        # repeat two of the epochs and add two new ones
+        mjd_2 = np.array([60001.5, 60020.0, 60010.0, 60030.0])
+        model.evaluated = []
+        test = evaluator.evaluate(self.simobjid, self.var_params, mjd_2)
+        evaluated_mjd = set([pair[1] for pair in model.evaluated])
+        self.assertEqual(evaluated_mjd, set([60020.0, 60030.0]))
+        self.assertEqual(len(model.evaluated), 2*(self.n_obj-3))
+        control = model.applyVariability(self.var_params, expmjd=mjd_2)
+        np.testing.assert_array_equal(test, control)
+        self.assertEqual(evaluator.n_hits, 2*self.n_obj)
+        self.assertEqual(evaluator.n_misses, self.n_obj*(len(mjd_1)+2))
+        self.assertEqual(evaluator.n_entries, self.n_obj*(len(mjd_1)+2))
+
+        # a request which is entirely cached does not call the model
+        model.evaluated = []
+        test = evaluator.evaluate(self.simobjid, self.var_params,
+                                  np.concatenate([mjd_1, mjd_2]))
+        self.assertEqual(len(model.evaluated), 0)
+        np.testing.assert_array_equal(test[:, :, :len(mjd_1)],
+                                      model.applyVariability(self.var_params, expmjd=mjd_1))
+
+        evaluator.clear()
+        self.assertEqual(evaluator.n_entries, 0)
+        self.assertEqual(evaluator.n_hits, 0)
+        self.assertEqual(evaluator.n_misses, 0)
+
+    def test_eviction_and_spill(self):
+        """
+        Test that the least recently used objects are evicted (and, if
+        requested, spilled to and recovered from disk)
+        """
+        mjd_arr = np.array([60000.0, 60002.0, 60004.0])
+        control = CountingVariabilityModels().applyVariability(self.var_params, expmjd=mjd_arr)
+
+        for spill_dir in (None, os.path.join(self.scratch_dir, 'spill')):
+            model = CountingVariabilityModels()
+            evaluator = VariabilityEvaluator(model, max_entries=4*len(mjd_arr),
+                                             spill_dir=spill_dir)
+
+            test = evaluator.evaluate(self.simobjid, self.var_params, mjd_arr)
+            np.testing.assert_array_equal(test, control)
+            self.assertEqual(evaluator.n_entries, 4*len(mjd_arr))
+            if spill_dir is not None:
+                self.assertEqual(len(os.listdir(spill_dir)), self.n_obj-4)
+
+            # the last four objects are still in memory
+            model.evaluated = []
+            test = evaluator.evaluate(self.simobjid[-4:], self.var_params[-4:], mjd_arr)
+            self.assertEqual(len(model.evaluated), 0)
+
+            # the first objects were either discarded or spilled
+            model.evaluated = []
+            test = evaluator.evaluate(self.simobjid, self.var_params, mjd_arr)
+            np.testing.assert_array_equal(test, control)
+            if spill_dir is None:
+                self.assertGreater(len(model.evaluated), 0)
+            else:
+                self.assertEqual(len(model.evaluated), 0)
+                self.assertEqual(evaluator.n_misses, self.n_obj*len(mjd_arr))
+
+            self.assertLessEqual(evaluator.n_entries, 4*len(mjd_arr))
+            evaluator.clear()
+            if spill_dir is not None:
+                self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_all_epochs_models_bypass_cache(self):
+        """
+        Test that objects using models marked with @variability_all_epochs
+        (here, AGN in _agn_walk_mode = 'exact') are never cached, so that
+        their light curves are consistent with applyVariability
+        """
+        rng = np.random.RandomState(1123)
+        var_param_list = list(self.var_params)
+        agn_dex = [2, 7, 8]
+        for i_obj in agn_dex:
+            var_param_list[i_obj] = json.dumps({'m': 'applyAgn',
+                                                'p': {'agn_tau': rng.random_sample()*100.0+100.0,
+                                                      'agn_sfu': rng.random_sample()*2.0,
+                                                      'agn_sfg': rng.random_sample()*2.0,
+                                                      'agn_sfr': rng.random_sample()*2.0,
+                                                      'agn_sfi': rng.random_sample()*2.0,
+                                                      'agn_sfz': rng.random_sample()*2.0,
+                                                      'agn_sfy': rng.random_sample()*2.0,
+                                                      't0_mjd': 48000.0+rng.random_sample()*5.0,
+                                                      'seed': int(rng.randint(0, 20000))}})
+        var_params = np.array(var_param_list)
+
+        model = ExactAgnCountingModels()
+        model.redshift_arr = rng.random_sample(self.n_obj)*2.0
+        evaluator = VariabilityEvaluator(model)
+
+        mjd_1 = np.array([60000.0, 60001.5, 60003.0, 60010.0])
+        mjd_2 = np.array([60001.5, 60020.0, 60010.0, 60030.0])
+        for mjd_arr in (mjd_1, mjd_2):
+            test = evaluator.evaluate(self.simobjid, var_params, mjd_arr)
+            control = model.applyVariability(var_params, expmjd=mjd_arr)
+            np.testing.assert_array_equal(test, control)
+            for i_obj in agn_dex:
+                self.assertNotIn((self.simobjid[i_obj], var_params[i_obj]),
+                                 evaluator._lc_cache)
+
+        # only the counting objects were cached
+        self.assertEqual(evaluator.n_entries, (self.n_obj-len(agn_dex))*6)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -3,6 +3,10 @@ import lsst.utils.tests
 import numpy as np
 import copy
 import numbers
+import os
+import json
+import warnings
+from scipy.interpolate import InterpolatedUnivariateSpline
 
 from lsst.sims.catUtils.mixins import StellarVariabilityModels
 from lsst.sims.catUtils.mixins import ExtraGalacticVariabilityModels
@@ -163,6 +167,42 @@ class StellarVariability_at_many_times_case(unittest.TestCase):
                                      dmag_test[i_band][i_star],
                                      msg='failed on obj %d; band %d; time %d' % (i_star, i_band, i_time))
 
+    def test_RRLy_template_grid(self):
+        """
+        Test that evaluating RR Lyrae templates, either directly (few
+        epochs) or on the uniform phase grid (many epochs), agrees with
+        evaluating the template splines directly
+        """
+        rng = np.random.RandomState(7182)
+        params = {}
+        params['filename'] = ['rrly_lc/RRc/959802_per.txt',
+                              'rrly_lc/RRc/1078860_per.txt',
+                              'rrly_lc/RRab/98874_per.txt',
+                              'rrly_lc/RRab/3879827_per.txt',
+                              'rrly_lc/RRc/959802_per.txt']
+
+        n_obj = len(params['filename'])
+        params['tStartMjd'] = rng.random_sample(n_obj)*1000.0+40000.0
+        valid_dexes = [np.arange(n_obj, dtype=int)]
+
+        n_grid = self.star_var._std_periodic_grid_size
+        for n_mjd, tol in ((20, 1.0e-10), (n_grid+1, 2.0e-5)):
+            mjd_arr = rng.random_sample(n_mjd)*3653.3+59580.0
+            dmag_vector = self.star_var.applyRRly(valid_dexes, params, mjd_arr)
+
+            for i_star in range(n_obj):
+                lc = np.loadtxt(os.path.join(self.star_var.variabilityDataDir,
+                                             params['filename'][i_star]),
+                                unpack=True, comments='#')
+                period = lc[0][-1] + lc[0][1] - lc[0][0]
+                epoch = mjd_arr - params['tStartMjd'][i_star]
+                phase = epoch/period - epoch//period
+                for i_band in range(6):
+                    control = InterpolatedUnivariateSpline(lc[0]/period, lc[i_band+1])(phase)
+                    np.testing.assert_allclose(dmag_vector[i_band][i_star], control,
+                                               rtol=0.0, atol=tol,
+                                               err_msg='failed on obj %d; band %d; %d epochs' %
+                                               (i_star, i_band, n_mjd))
 
     def test_Cepeheid_many(self):
         rng = np.random.RandomState(8123)
@@ -374,11 +414,66 @@ class StellarVariability_at_many_times_case(unittest.TestCase):
             dmag_old = applyAmcvn_original(valid_dexes, params,mjd)
             for i_obj in range(n_obj):
                 for i_band in range(6):
-                    self.assertEqual(dmag_test[i_band][i_obj],
-                                     dmag_old[i_band][i_obj])
+                    self.assertAlmostEqual(dmag_test[i_band][i_obj],
+                                           dmag_old[i_band][i_obj], 10)
                     self.assertEqual(dmag_test[i_band][i_obj],
                                      dmag_vector[i_band][i_obj][i_time])
 
+    def test_Amcvn_long_before_bursts(self):
+        """
+        Test that applyAmcvn does not overflow (or warn) at epochs long
+        before the first burst of a bursting object
+        """
+        params = {}
+        params['does_burst'] = np.array([1, 1, 0])
+        params['burst_freq'] = np.array([50, 100, 80])
+        params['burst_scale'] = np.array([115.0, 115.0, 115.0])
+        params['amp_burst'] = np.array([3.0, 5.0, 4.0])
+        params['color_excess_during_burst'] = np.array([-0.3, -0.2, -0.25])
+        params['amplitude'] = np.array([0.1, 0.1, 0.1])
+        params['period'] = np.array([10.0, 20.0, 15.0])
+        params['t0'] = np.array([60000.0, 61000.0, 60500.0])
+        mjd_arr = np.array([-50000.0, 40000.0, 60100.0, 61500.0])
+        valid_dexes = [np.arange(3, dtype=int)]
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            dmag_vector = self.star_var.applyAmcvn(valid_dexes, params, mjd_arr)
+            dmag_single = self.star_var.applyAmcvn(valid_dexes, params, mjd_arr[0])
+        self.assertTrue(np.isfinite(dmag_vector).all())
+        np.testing.assert_array_equal(dmag_vector[:, :, 0], dmag_single)
+
+    def test_Amcvn_during_bursts(self):
+        """
+        Test applyAmcvn against the original implementation at epochs
+        during the bursts (including objects that burst only once or twice)
+        """
+        rng = np.random.RandomState(8812)
+        n_obj = 30
+        params = {}
+        params['does_burst'] = rng.randint(0, 2, size=n_obj)
+        params['burst_freq'] = rng.randint(10, 150, size=n_obj)
+        params['burst_freq'][:4] = [1900, 3652, 3700, 5000]
+        params['does_burst'][:4] = 1
+        params['burst_scale'] = rng.random_sample(n_obj)*100.0+5.0
+        params['amp_burst'] = rng.random_sample(n_obj)*8.0
+        params['color_excess_during_burst'] = rng.random_sample(n_obj)*0.2-0.4
+        params['amplitude'] = rng.random_sample(n_obj)*0.2
+        params['period'] = rng.random_sample(n_obj)*200.0
+        params['t0'] = 59000.0-rng.random_sample(n_obj)*500.0
+
+        mjd_arr = rng.random_sample(60)*4500.0+58500.0
+        valid_dexes = [np.arange(n_obj, dtype=int)]
+
+        dmag_vector = self.star_var.applyAmcvn(valid_dexes, params, mjd_arr)
+        self.assertEqual(dmag_vector.shape, (6, n_obj, len(mjd_arr)))
+        for i_time, mjd in enumerate(mjd_arr):
+            dmag_old = applyAmcvn_original(valid_dexes, params, mjd)
+            for i_obj in range(n_obj):
+                for i_band in range(6):
+                    self.assertAlmostEqual(dmag_vector[i_band][i_obj][i_time],
+                                           dmag_old[i_band][i_obj], 10)
+
     def test_Amcvn_many_some_invalid(self):
         """
         Test that the correct thing happens when some of the objects
@@ -420,8 +515,8 @@ class StellarVariability_at_many_times_case(unittest.TestCase):
                 for i_band in range(6):
                     if i_obj not in(1,5,6):
                         self.assertEqual(dmag_test[i_band][i_obj], 0.0)
-                    self.assertEqual(dmag_test[i_band][i_obj],
-                                     dmag_old[i_band][i_obj])
+                    self.assertAlmostEqual(dmag_test[i_band][i_obj],
+                                           dmag_old[i_band][i_obj], 10)
                     self.assertEqual(dmag_test[i_band][i_obj],
                                      dmag_vector[i_band][i_obj][i_time])
 
@@ -484,6 +579,63 @@ class StellarVariability_at_many_times_case(unittest.TestCase):
                     self.assertEqual(dmag_test[i_band][i_obj],
                                      dmag_vector[i_band][i_obj][i_time])
 
+    def test_iter_variability(self):
+        """
+        Test that iter_variability yields tiles of the output of
+        applyVariability, honoring its mask
+        """
+        rng = np.random.RandomState(6623)
+        n_obj = 23
+        var_param_list = []
+        for i_obj in range(n_obj):
+            if i_obj % 4 == 0:
+                var_param_list.append('None')
+                continue
+            var_param_list.append(json.dumps({'m': 'applyAmcvn',
+                                              'p': {'does_burst': int(rng.randint(0, 2)),
+                                                    'burst_freq': int(rng.randint(10, 150)),
+                                                    'burst_scale': 115.0,
+                                                    'amp_burst': rng.random_sample()*8.0,
+                                                    'color_excess_during_burst': rng.random_sample()*0.2-0.4,
+                                                    'amplitude': rng.random_sample()*0.2,
+                                                    'period': rng.random_sample()*200.0,
+                                                    't0': 59000.0-rng.random_sample()*500.0}}))
+        var_param_arr = np.array(var_param_list)
+        mjd_arr = rng.random_sample(31)*3653.3+59580.0
+
+        control = self.star_var.applyVariability(var_param_arr, expmjd=mjd_arr)
+        self.assertEqual(control.shape, (6, n_obj, len(mjd_arr)))
+
+        test = np.zeros(control.shape)
+        n_tiles = 0
+        for obj_slice, time_slice, dmag in self.star_var.iter_variability(var_param_arr, mjd_arr,
+                                                                         time_block_size=8,
+                                                                         obj_block_size=10):
+            n_tiles += 1
+            self.assertEqual(dmag.dtype, np.dtype(float))
+            self.assertLessEqual(dmag.shape[1], 10)
+            self.assertLessEqual(dmag.shape[2], 8)
+            test[:, obj_slice, time_slice] = dmag
+        self.assertEqual(n_tiles, 12)
+        np.testing.assert_array_equal(test, control)
+
+        mask = rng.random_sample((n_obj, len(mjd_arr))) > 0.7
+        mask[:, 3] = False
+        mask[5, :] = False
+        test = np.zeros(control.shape, dtype=np.float32)
+        for obj_slice, time_slice, dmag in self.star_var.iter_variability(var_param_arr, mjd_arr,
+                                                                         time_block_size=8,
+                                                                         mask=mask,
+                                                                         dtype=np.float32):
+            self.assertEqual(dmag.dtype, np.dtype(np.float32))
+            test[:, obj_slice, time_slice] = dmag
+        np.testing.assert_array_equal(test, np.where(mask, control, 0.0).astype(np.float32))
+
+        with self.assertRaises(RuntimeError):
+            for tile in self.star_var.iter_variability(var_param_arr, mjd_arr,
+                                                       mask=mask[:, :4]):
+                pass
+
 
 class AgnVariability_at_many_times_case(unittest.TestCase):
     """
@@ -568,6 +720,59 @@ class AgnVariability_at_many_times_case(unittest.TestCase):
                                            dmag_test[i_band][i_obj], 6,
                                            msg='failed on band %d obj %d time %d' % (i_band, i_obj, i_time))
 
+    def test_agn_iter_variability(self):
+        """
+        Test that iter_variability does not split the epochs of AGN
+        into blocks, so that the exact random walk is not restarted
+        every time_block_size epochs
+        """
+
+        class AgnIterModel(ExtraGalacticVariabilityModels):
+            _agn_walk_mode = 'exact'
+
+            def column_by_name(self, col_name):
+                return self.redshift_arr
+
+        agn_model = AgnIterModel()
+        rng = np.random.RandomState(8812)
+        n_obj = 7
+        var_param_list = []
+        for i_obj in range(n_obj):
+            var_param_list.append(json.dumps({'m': 'applyAgn',
+                                              'p': {'agn_tau': rng.random_sample()*100.0+100.0,
+                                                    'agn_sfu': rng.random_sample()*2.0,
+                                                    'agn_sfg': rng.random_sample()*2.0,
+                                                    'agn_sfr': rng.random_sample()*2.0,
+                                                    'agn_sfi': rng.random_sample()*2.0,
+                                                    'agn_sfz': rng.random_sample()*2.0,
+                                                    'agn_sfy': rng.random_sample()*2.0,
+                                                    't0_mjd': 48000.0+rng.random_sample()*5.0,
+                                                    'seed': int(rng.randint(0, 20000))}}))
+        var_param_arr = np.array(var_param_list)
+        agn_model.redshift_arr = rng.random_sample(n_obj)*5.0
+        mjd_arr = np.sort(rng.random_sample(40)*3653.3+59580.0)
+
+        control = agn_model.applyVariability(var_param_arr, expmjd=mjd_arr)
+        self.assertEqual(control.shape, (6, n_obj, len(mjd_arr)))
+
+        time_slices = []
+        test = np.zeros(control.shape)
+        for obj_slice, time_slice, dmag in agn_model.iter_variability(var_param_arr, mjd_arr,
+                                                                      time_block_size=8):
+            time_slices.append(time_slice)
+            test[:, obj_slice, time_slice] = dmag
+        self.assertEqual(time_slices, [slice(0, len(mjd_arr))])
+        np.testing.assert_array_equal(test, control)
+
+        # the mask does not change the epochs on which the walk is evaluated
+        mask = rng.random_sample((n_obj, len(mjd_arr))) > 0.5
+        test = np.zeros(control.shape)
+        for obj_slice, time_slice, dmag in agn_model.iter_variability(var_param_arr, mjd_arr,
+                                                                      time_block_size=8,
+                                                                      mask=mask):
+            test[:, obj_slice, time_slice] = dmag
+        np.testing.assert_array_equal(test, np.where(mask, control, 0.0))
+
 
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
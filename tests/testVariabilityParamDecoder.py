@@ -0,0 +1,97 @@
+import unittest
+import json
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catUtils.mixins import VariabilityParamDecoder
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class VariabilityParamDecoderTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    def test_decode(self):
+        """
+        Test that VariabilityParamDecoder produces the same parameters
+        as calling json.loads on every varParamStr
+        """
+        rng = np.random.RandomState(8812)
+        var_param_list = []
+        for ii in range(200):
+            draw = rng.randint(0, 4)
+            if draw == 0:
+                var_param_list.append(None)
+            elif draw == 1:
+                var_param_list.append(json.dumps({'m': 'kplr',
+                                                  'p': {'lc': int(rng.randint(0, 5)),
+                                                        't0': rng.random_sample()*100.0}}))
+            elif draw == 2:
+                var_param_list.append(json.dumps({'varMethodName': 'applyRRly',
+                                                  'pars': {'filename': 'rrly_%d.txt' % rng.randint(0, 3),
+                                                           'tStartMjd': 48000.0}}))
+            else:
+                var_param_list.append('None')
+
+        # add some duplicates so that the memo is exercised
+        var_param_list += var_param_list[:50]
+
+        decoder = VariabilityParamDecoder()
+        method_name_arr, params = decoder.decode(var_param_list)
+        self.assertEqual(len(method_name_arr), len(var_param_list))
+        self.assertEqual(set(params.keys()), set(['kplr', 'applyRRly']))
+
+        self.assertEqual(params['kplr']['lc'].dtype, np.int64)
+        self.assertEqual(params['kplr']['t0'].dtype, float)
+        self.assertEqual(params['applyRRly']['filename'].dtype.kind, 'U')
+        self.assertEqual(params['applyRRly']['tStartMjd'].dtype, float)
+
+        n_kplr = 0
+        n_rrly = 0
+        for ix, var_param in enumerate(var_param_list):
+            if var_param is None or var_param == 'None':
+                self.assertEqual(method_name_arr[ix], 'None')
+                continue
+            control = json.loads(var_param)
+            if 'm' in control:
+                n_kplr += 1
+                self.assertEqual(method_name_arr[ix], 'kplr')
+                self.assertEqual(params['kplr']['lc'][ix], control['p']['lc'])
+                self.assertEqual(params['kplr']['t0'][ix], control['p']['t0'])
+                self.assertTrue(np.isnan(params['applyRRly']['tStartMjd'][ix]))
+                self.assertEqual(params['applyRRly']['filename'][ix], 'None')
+            else:
+                n_rrly += 1
+                self.assertEqual(method_name_arr[ix], 'applyRRly')
+                self.assertEqual(params['applyRRly']['filename'][ix],
+                                 control['pars']['filename'])
+                self.assertEqual(params['kplr']['lc'][ix], -1)
+
+        self.assertGreater(n_kplr, 0)
+        self.assertGreater(n_rrly, 0)
+
+        # only the distinct strings should have been memoized
+        n_unique = len(set([vv for vv in var_param_list
+                            if vv is not None and vv != 'None']))
+        self.assertEqual(len(decoder.memo), n_unique)
+
+    def test_empty(self):
+        """
+        Test that an empty chunk decodes into empty outputs
+        """
+        decoder = VariabilityParamDecoder()
+        method_name_arr, params = decoder.decode([])
+        self.assertEqual(len(method_name_arr), 0)
+        self.assertEqual(len(params), 0)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catUtils.mixins import VariabilityParamDecoder
+from lsst.sims.catUtils.mixins import VariabilityParamStore
+from lsst.sims.catUtils.mixins import write_variability_param_store
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class VarParamTestDBObj(object):
+    """
+    A stand-in for a CatalogDBObject that serves simobjid and varParamStr
+    in chunks
+    """
+
+    def __init__(self, simobjid, var_param_str):
+        dtype = np.dtype([('simobjid', int), ('varParamStr', str, 200)])
+        self._data = np.rec.fromarrays([simobjid, var_param_str], dtype=dtype)
+
+    def query_columns(self, colnames=None, chunk_size=None, constraint=None):
+        for i_start in range(0, len(self._data), chunk_size):
+            yield self._data[i_start:i_start+chunk_size]
+
+    def query_columns_htmid(self, colnames=None, htmid=None, chunk_size=None,
+                            constraint=None):
+        return self.query_columns(colnames=colnames, chunk_size=chunk_size)
+
+
+class VariabilityParamStoreTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='VariabilityParamStoreTestCase-')
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def test_store_round_trip(self):
+        """
+        Test that the parameters read back from a VariabilityParamStore
+        match those decoded directly from varParamStr
+        """
+        rng = np.random.RandomState(5531)
+        n_obj = 300
+        simobjid = rng.choice(np.arange(10000), size=n_obj, replace=False)
+        var_param_list = []
+        for ii in range(n_obj):
+            draw = rng.randint(0, 3)
+            if draw == 0:
+                var_param_list.append('None')
+            elif draw == 1:
+                var_param_list.append(json.dumps({'m': 'kplr',
+                                                  'p': {'lc': int(rng.randint(0, 50)),
+                                                        't0': rng.random_sample()*100.0}}))
+            else:
+                var_param_list.append(json.dumps({'m': 'applyRRly',
+                                                  'p': {'filename': 'rrly_%d.txt' % rng.randint(0, 3),
+                                                        'tStartMjd': rng.random_sample()*1000.0}}))
+
+        db = VarParamTestDBObj(simobjid, var_param_list)
+        store = write_variability_param_store(db, self.scratch_dir, htmid=8814,
+                                              chunk_size=70)
+        self.assertEqual(store.model_names, ['applyRRly', 'kplr'])
+
+        # a second handle on the same partition
+        store = VariabilityParamStore(self.scratch_dir, htmid=8814)
+
+        # look the objects up in a different order than they were written
+        shuffled = rng.permutation(n_obj)
+        control_names, control_params = VariabilityParamDecoder().decode(np.array(var_param_list)[shuffled])
+        test_names, test_params = store.decode(simobjid[shuffled])
+
+        np.testing.assert_array_equal(control_names, test_names)
+        self.assertEqual(set(control_params.keys()), set(test_params.keys()))
+        for method_name in control_params:
+            for p_name in control_params[method_name]:
+                np.testing.assert_array_equal(control_params[method_name][p_name],
+                                              test_params[method_name][p_name])
+
+        # objects not in the store have no variability
+        test_names, test_params = store.decode(np.array([20000, 20001]))
+        self.assertEqual(list(test_names), ['None', 'None'])
+        self.assertEqual(len(test_params), 0)
+
+        # only load the requested models
+        test_names, test_params = store.decode(simobjid, model_names=['kplr'])
+        self.assertEqual(list(test_params.keys()), ['kplr'])
+
+        with self.assertRaises(RuntimeError):
+            write_variability_param_store(db, self.scratch_dir, htmid=8814)
+
+        with self.assertRaises(RuntimeError):
+            VariabilityParamStore(self.scratch_dir, htmid=8815)
+
+    def test_params_differ_between_chunks(self):
+        """
+        Test that a VariabilityParamStore is correct when parameters
+        only appear in, or change type between, some of the chunks
+        returned by the database
+        """
+        var_param_list = []
+        # first chunk: no 'period'; 'amp' is an int
+        for ii in range(10):
+            var_param_list.append(json.dumps({'m': 'applyStdPeriodic',
+                                              'p': {'filename': 'ceph_%d.txt' % ii,
+                                                    'amp': ii}}))
+        # second chunk: 'period' appears; 'amp' is a float
+        for ii in range(10):
+            var_param_list.append(json.dumps({'m': 'applyStdPeriodic',
+                                              'p': {'filename': 'ceph_%d.txt' % ii,
+                                                    'amp': 0.5*ii,
+                                                    'period': 1.0+ii}}))
+        # third chunk: 'tag' is a str here and a number below
+        for ii in range(10):
+            var_param_list.append(json.dumps({'m': 'applyStdPeriodic',
+                                              'p': {'filename': 'ceph_%d.txt' % ii,
+                                                    'amp': 0.25*ii,
+                                                    'tag': 'tag_%d' % ii}}))
+        # fourth chunk
+        for ii in range(10):
+            var_param_list.append(json.dumps({'m': 'applyStdPeriodic',
+                                              'p': {'filename': 'ceph_%d.txt' % ii,
+                                                    'period': 2.0+ii,
+                                                    'tag': ii}}))
+
+        simobjid = np.arange(len(var_param_list), dtype=int)[::-1]
+        db = VarParamTestDBObj(simobjid, var_param_list)
+        store = write_variability_param_store(db, self.scratch_dir, htmid=9921,
+                                              chunk_size=10)
+
+        control_names, control_params = VariabilityParamDecoder().decode(var_param_list)
+        test_names, test_params = store.decode(simobjid)
+
+        np.testing.assert_array_equal(control_names, test_names)
+        self.assertEqual(set(test_params['applyStdPeriodic'].keys()),
+                         set(['filename', 'amp', 'period', 'tag']))
+        self.assertEqual(test_params['applyStdPeriodic']['amp'].dtype, float)
+        self.assertEqual(test_params['applyStdPeriodic']['tag'].dtype, object)
+        for p_name in control_params['applyStdPeriodic']:
+            control = control_params['applyStdPeriodic'][p_name]
+            test = test_params['applyStdPeriodic'][p_name]
+            self.assertEqual(control.dtype, test.dtype, msg=p_name)
+            np.testing.assert_array_equal(control, test, err_msg=p_name)
+
+        # rows without 'period' are filled with NaN, not shifted
+        self.assertTrue(np.isnan(test_params['applyStdPeriodic']['period'][:10]).all())
+        np.testing.assert_array_equal(test_params['applyStdPeriodic']['period'][10:20],
+                                      1.0+np.arange(10))
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catalogs.decorators import register_method
+from lsst.sims.catUtils.mixins import Variability
+from lsst.sims.catUtils.mixins import StellarVariabilityModels
+from lsst.sims.catUtils.mixins import MLTflaringMixin
+from lsst.sims.catUtils.mixins import ExtraGalacticVariabilityModels
+from lsst.sims.catUtils.mixins import variability_columns
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class UndeclaredVariabilityMixin(Variability):
+
+    @register_method('undeclared')
+    def applyUndeclared(self, valid_dexes, params, expmjd,
+                        variability_cache=None):
+        self.undeclared_calls += 1
+        self.column_by_name('undeclared_column')
+        if len(params) == 0:
+            return np.array([[], [], [], [], [], []])
+        return np.zeros((6, self.num_variable_obj(params)))
+
+
+class DeclaredVariabilityMixin(Variability):
+
+    @register_method('declared')
+    @variability_columns('declared_column_1', 'declared_column_2')
+    def applyDeclared(self, valid_dexes, params, expmjd,
+                      variability_cache=None):
+        self.declared_calls += 1
+        if len(params) == 0:
+            return np.array([[], [], [], [], [], []])
+        return np.zeros((6, self.num_variable_obj(params)))
+
+
+class RegistryTestModels(StellarVariabilityModels, MLTflaringMixin,
+                         ExtraGalacticVariabilityModels,
+                         UndeclaredVariabilityMixin,
+                         DeclaredVariabilityMixin):
+
+    def __init__(self):
+        self.requested_columns = []
+        self.undeclared_calls = 0
+        self.declared_calls = 0
+
+    def column_by_name(self, col_name):
+        self.requested_columns.append(col_name)
+        return np.array([])
+
+
+class VariabilityRegistryTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    def test_class_registry(self):
+        """
+        Test that the registry of variability models is built per class
+        """
+        stellar_registry = StellarVariabilityModels._variability_registry()
+        self.assertEqual(stellar_registry['methods']['applyRRly'], 'applyRRly')
+        self.assertEqual(stellar_registry['methods']['applyAmcvn'], 'applyAmcvn')
+        self.assertNotIn('MLT', stellar_registry['methods'])
+        self.assertNotIn('declared', stellar_registry['methods'])
+
+        registry = RegistryTestModels._variability_registry()
+        self.assertEqual(registry['methods']['MLT'], 'applyMLTflaring')
+        self.assertEqual(registry['methods']['applyAgn'], 'applyAgn')
+        self.assertEqual(registry['methods']['declared'], 'applyDeclared')
+        self.assertEqual(registry['columns']['MLT'], ('parallax', 'ebv'))
+        self.assertEqual(registry['columns']['applyAgn'], ('redshift',))
+        self.assertEqual(registry['columns']['applyRRly'], ())
+        self.assertIsNone(registry['columns']['undeclared'])
+        self.assertTrue(registry['all_epochs']['applyAgn'])
+        self.assertFalse(registry['all_epochs']['applyRRly'])
+        self.assertFalse(registry['all_epochs']['undeclared'])
+        self.assertEqual(sorted(registry['method_ints'].values()),
+                         list(range(len(registry['methods']))))
+
+        # instances share their class's registry
+        model_1 = RegistryTestModels()
+        model_2 = RegistryTestModels()
+        model_1._build_variability_registry()
+        model_2._build_variability_registry()
+        self.assertIs(model_1._methodRegistry, model_2._methodRegistry)
+
+    def test_column_dependencies(self):
+        """
+        Test that an empty chunk requests the declared columns without
+        calling the models that declared them
+        """
+        model = RegistryTestModels()
+        dmag = model.applyVariability(np.array([]), expmjd=60000.0)
+        self.assertEqual(dmag.shape, (6, 0))
+        self.assertEqual(model.declared_calls, 0)
+        self.assertEqual(model.undeclared_calls, 1)
+        for col_name in ('parallax', 'ebv', 'redshift', 'undeclared_column',
+                         'declared_column_1', 'declared_column_2'):
+            self.assertIn(col_name, model.requested_columns)
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
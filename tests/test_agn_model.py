@@ -1,8 +1,68 @@
 import numpy as np
+import math
+import numbers
 import unittest
 import lsst.utils.tests
 
 from lsst.sims.catUtils.mixins import VariabilityAGN
+from lsst.sims.catUtils.mixins.VariabilityMixin import _balance_agn_batches
+from lsst.sims.catUtils.mixins.VariabilityMixin import _get_agn_pool
+
+
+def simulate_agn_original(expmjd, tau, time_dilation, sf_u, seed, start_date):
+    """
+    The step-by-step damped random walk that was used by
+    ExtraGalacticVariabilityModels._simulate_agn before it was
+    vectorized.  Used to verify that the vectorized version
+    reproduces the same light curves.
+    """
+    if not isinstance(expmjd, numbers.Number):
+        d_m_out = np.zeros(len(expmjd))
+        duration_observer_frame = max(expmjd) - start_date
+    else:
+        duration_observer_frame = expmjd - start_date
+
+    rng = np.random.RandomState(seed)
+    dt = tau/100.
+    duration_rest_frame = duration_observer_frame/time_dilation
+    nbins = int(math.ceil(duration_rest_frame/dt))+1
+
+    time_dexes = np.round((expmjd-start_date)/(time_dilation*dt)).astype(int)
+    time_dex_map = {}
+    if not isinstance(time_dexes, numbers.Number):
+        for i_t_dex, t_dex in enumerate(time_dexes):
+            if t_dex in time_dex_map:
+                time_dex_map[t_dex].append(i_t_dex)
+            else:
+                time_dex_map[t_dex] = [i_t_dex]
+        time_dexes = set(time_dexes)
+    else:
+        time_dex_map[time_dexes] = [0]
+        time_dexes = set([time_dexes])
+
+    dx2 = 0.0
+    x1 = 0.0
+    x2 = 0.0
+
+    dt_over_tau = dt/tau
+    es = rng.normal(0., 1., nbins)*math.sqrt(dt_over_tau)
+    for i_time in range(nbins):
+        dx1 = dx2
+        dx2 = -dx1*dt_over_tau + sf_u*es[i_time] + dx1
+        x1 = x2
+        x2 += dt
+
+        if i_time in time_dexes:
+            if isinstance(expmjd, numbers.Number):
+                dm_val = ((expmjd-start_date)*(dx1-dx2)/time_dilation+dx2*x1-dx1*x2)/(x1-x2)
+                d_m_out = dm_val
+            else:
+                for i_time_out in time_dex_map[i_time]:
+                    local_end = (expmjd[i_time_out]-start_date)/time_dilation
+                    dm_val = (local_end*(dx1-dx2)+dx2*x1-dx1*x2)/(x1-x2)
+                    d_m_out[i_time_out] = dm_val
+
+    return d_m_out
 
 
 def setup_module(module):
@@ -281,6 +341,129 @@ class AgnModelTestCase(unittest.TestCase):
         np.testing.assert_array_equal(dmag_control, dmag_threaded)
 
 
+    def test_exact_walk_structure_function(self):
+        """
+        Test that drawing the damped random walk only at the requested
+        dates (_agn_walk_mode = 'exact') produces light curves with the
+        same structure function as the fine-grid simulation
+        (_agn_walk_mode = 'grid')
+        """
+        agn_grid = VariabilityAGN()
+        agn_exact = VariabilityAGN()
+        agn_exact._agn_walk_mode = 'exact'
+        self.assertEqual(agn_grid._agn_walk_mode, 'grid')
+
+        n_obj = 10
+        d_mjd = 1.0
+        rng = np.random.RandomState(4421)
+        mjd_grid = np.arange(61000.0, 101000.0, d_mjd)
+        agn_params = {}
+        agn_params['seed'] = rng.randint(10, high=1000, size=n_obj)
+        agn_params['agn_tau'] = rng.random_sample(n_obj)*25.0+75.0
+        for bp in ('u', 'g', 'r', 'i', 'z', 'y'):
+            agn_params['agn_sf%s' % bp] = rng.random_sample(n_obj)*100.0+5.0
+
+        redshift = rng.random_sample(n_obj)*0.5
+        dmag_grid = agn_grid.applyAgn([np.arange(n_obj)], agn_params, mjd_grid,
+                                      redshift=redshift)
+        dmag_exact = agn_exact.applyAgn([np.arange(n_obj)], agn_params, mjd_grid,
+                                        redshift=redshift)
+        self.assertEqual(dmag_exact.shape, dmag_grid.shape)
+
+        for i_obj in range(n_obj):
+            tau = agn_params['agn_tau'][i_obj]*(1.0+redshift[i_obj])
+            for i_bp, bp in enumerate(('u', 'g', 'r', 'i', 'z', 'y')):
+                sf_inf = agn_params['agn_sf%s' % bp][i_obj]
+                for delta_i_t in range(5, 2000, 100):
+                    delta_t = d_mjd*delta_i_t
+                    sf_th = sf_inf*np.sqrt(1.0-np.exp(-delta_t/tau))
+                    sf_values = []
+                    for dmag_arr in (dmag_grid, dmag_exact):
+                        dmag_0 = dmag_arr[i_bp][i_obj][:-delta_i_t]
+                        dmag_1 = dmag_arr[i_bp][i_obj][delta_i_t:]
+                        sf_values.append(np.sqrt(np.mean((dmag_1-dmag_0)**2)))
+                        self.assertLess(np.abs(1.0-sf_values[-1]/sf_th), 0.1)
+                    self.assertLess(np.abs(1.0-sf_values[1]/sf_values[0]), 0.15)
+
+        # the exact mode must not depend on the order of the dates
+        mjd = 59580.0+rng.random_sample(9)*1000.0
+        dmag_vector = agn_exact.applyAgn([np.arange(n_obj)], agn_params, mjd,
+                                         redshift=redshift)
+        dmag_sorted = agn_exact.applyAgn([np.arange(n_obj)], agn_params, np.sort(mjd),
+                                         redshift=redshift)
+        np.testing.assert_array_equal(dmag_vector[:, :, np.argsort(mjd)], dmag_sorted)
+        self.assertEqual(dmag_vector.shape, (6, n_obj, len(mjd)))
+
+        agn_exact._agn_walk_mode = 'fast'
+        with self.assertRaises(RuntimeError):
+            agn_exact.applyAgn([np.arange(n_obj)], agn_params, mjd,
+                               redshift=redshift)
+
+    def test_balance_agn_batches(self):
+        """
+        Test that the AGN are divided among processes so that each
+        AGN is simulated exactly once and the costs are balanced
+        """
+        rng = np.random.RandomState(1423)
+        n_steps = rng.random_sample(200)*1.0e5
+        batch_list = _balance_agn_batches(n_steps, 7)
+        self.assertEqual(len(batch_list), 7)
+        np.testing.assert_array_equal(np.sort(np.concatenate(batch_list)),
+                                      np.arange(len(n_steps)))
+        cost = np.array([n_steps[batch].sum() for batch in batch_list])
+        self.assertLess(cost.max()-cost.min(), n_steps.max())
+
+        # never more batches than AGN
+        batch_list = _balance_agn_batches(n_steps[:3], 7)
+        self.assertEqual(len(batch_list), 3)
+
+        # the worker pool persists between calls
+        self.assertIs(_get_agn_pool(2), _get_agn_pool(2))
+
+    def test_batch_simulation(self):
+        """
+        Test that the batched damped random walk reproduces the
+        step-by-step simulation, regardless of how the AGN are
+        divided into batches
+        """
+        agn_obj = VariabilityAGN()
+        rng = np.random.RandomState(77123)
+        n_agn = 20
+        tau_arr = rng.random_sample(n_agn)*50.0+1.0
+        time_dilation_arr = rng.random_sample(n_agn)*2.0+1.0
+        sf_u_arr = rng.random_sample(n_agn)*2.0+0.1
+        seed_arr = rng.randint(2, high=1000, size=n_agn)
+        mjd = 59580.0+rng.random_sample(17)*1000.0
+
+        dmag_batch = agn_obj._simulate_agn_batch(mjd, tau_arr, time_dilation_arr,
+                                                 sf_u_arr, seed_arr)
+        self.assertEqual(dmag_batch.shape, (n_agn, len(mjd)))
+
+        dmag_scalar = agn_obj._simulate_agn_batch(mjd[5], tau_arr, time_dilation_arr,
+                                                  sf_u_arr, seed_arr)
+        self.assertEqual(dmag_scalar.shape, (n_agn,))
+
+        agn_obj._agn_batch_steps = 20000
+        dmag_small_batch = agn_obj._simulate_agn_batch(mjd, tau_arr, time_dilation_arr,
+                                                       sf_u_arr, seed_arr)
+        np.testing.assert_array_equal(dmag_batch, dmag_small_batch)
+
+        for i_agn in range(n_agn):
+            control = simulate_agn_original(mjd, tau_arr[i_agn], time_dilation_arr[i_agn],
+                                            sf_u_arr[i_agn], seed_arr[i_agn],
+                                            agn_obj._agn_walk_start_date)
+            np.testing.assert_allclose(dmag_batch[i_agn], control, rtol=0.0, atol=1.0e-10)
+
+            control = simulate_agn_original(mjd[5], tau_arr[i_agn], time_dilation_arr[i_agn],
+                                            sf_u_arr[i_agn], seed_arr[i_agn],
+                                            agn_obj._agn_walk_start_date)
+            self.assertAlmostEqual(dmag_scalar[i_agn], control, 10)
+
+            single = agn_obj._simulate_agn(mjd, tau_arr[i_agn], time_dilation_arr[i_agn],
+                                           sf_u_arr[i_agn], seed_arr[i_agn])
+            np.testing.assert_array_equal(single, dmag_batch[i_agn])
+
+
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
 
@@ -6,6 +6,8 @@ import sqlite3
 import shutil
 import numbers
 import gc
+import json
+from collections import OrderedDict
 import lsst.utils.tests
 
 from lsst.utils import getPackageDir
@@ -18,11 +20,16 @@ from lsst.sims.coordUtils import chipNameFromPupilCoordsLSST
 from lsst.sims.catUtils.utils import ObservationMetaDataGenerator
 from lsst.sims.catUtils.utils import AlertStellarVariabilityCatalog
 from lsst.sims.catUtils.utils import AlertDataGenerator
+from lsst.sims.catUtils.utils import AlertObservationContext
 from lsst.sims.catUtils.utils import StellarAlertDBObjMixin
+from lsst.sims.catUtils.utils.alertDataGenerator import _detectable_variability_mask
+from lsst.sims.catUtils.utils.alertDataGenerator import _lsst_focal_plane_footprint
+from lsst.sims.catUtils.utils.alertDataGenerator import _in_focal_plane_footprint
 
 from lsst.sims.utils import applyProperMotion
 from lsst.sims.utils import ModifiedJulianDate
 from lsst.sims.utils import findHtmid
+from lsst.sims.utils import levelFromHtmid
 from lsst.sims.utils import angularSeparation
 from lsst.sims.photUtils import Sed
 from lsst.sims.coordUtils import chipNameFromRaDecLSST
@@ -522,6 +529,389 @@ class AlertDataGeneratorTestCase(unittest.TestCase):
         self.assertLess(len(obshistid_unqid_simulated_set), n_total_observations)
         self.assertGreater(n_tot_ast_simulated, 0)
 
+    def alert_test_classes(self):
+        """
+        Return the CatalogDBObject class connecting to the test database
+        and the alert catalog class with the test variability model
+        """
+        _max_var_param_str = self.max_str_len
+
+        class StarAlertTestDBObj(StellarAlertDBObjMixin, CatalogDBObject):
+            objid = 'star_alert'
+            tableid = 'stars'
+            idColKey = 'simobjid'
+            raColName = 'ra'
+            decColName = 'dec'
+            objectTypeId = 0
+            columns = [('raJ2000', 'ra*0.01745329252'),
+                       ('decJ2000', 'dec*0.01745329252'),
+                       ('parallax', 'px*0.01745329252/3600.0'),
+                       ('properMotionRa', 'pmra*0.01745329252/3600.0'),
+                       ('properMotionDec', 'pmdec*0.01745329252/3600.0'),
+                       ('radialVelocity', 'vrad'),
+                       ('variabilityParameters', 'varParamStr', str, _max_var_param_str)]
+
+        class TestAlertsVarCat(AlertStellarVariabilityCatalog):
+
+            @register_method('alert_test')
+            def applyAlertTest(self, valid_dexes, params, expmjd, variability_cache=None):
+                if len(params) == 0:
+                    return np.array([[], [], [], [], [], []])
+
+                if isinstance(expmjd, numbers.Number):
+                    dmags_out = np.zeros((6, self.num_variable_obj(params)))
+                else:
+                    dmags_out = np.zeros((6, self.num_variable_obj(params), len(expmjd)))
+
+                for i_star in range(self.num_variable_obj(params)):
+                    if params['amp'][i_star] is not None:
+                        dmags = params['amp'][i_star]*np.cos(params['per'][i_star]*expmjd)
+                        for i_filter in range(6):
+                            dmags_out[i_filter][i_star] = dmags
+
+                return dmags_out
+
+        return StarAlertTestDBObj, TestAlertsVarCat
+
+    def test_observation_context(self):
+        """
+        Test that a single catalog switched between AlertObservationContexts
+        calculates the same columns as one catalog per observation
+        """
+        StarAlertTestDBObj = self.alert_test_classes()[0]
+        star_db = StarAlertTestDBObj(database=self.star_db_name, driver='sqlite')
+        column_query = ['simobjid', 'htmid', 'raJ2000', 'decJ2000',
+                        'properMotionRa', 'properMotionDec', 'parallax',
+                        'radialVelocity', 'varParamStr',
+                        'umag', 'gmag', 'rmag', 'imag', 'zmag', 'ymag']
+        chunk = list(star_db.query_columns(colnames=column_query))[0]
+        self.assertGreater(len(chunk), 10)
+
+        rng = np.random.RandomState(611)
+        delta_mag = rng.random_sample((6, len(chunk)))
+        xpup = rng.random_sample(len(chunk))*0.01
+        ypup = rng.random_sample(len(chunk))*0.01
+
+        def column_cache():
+            cache = {}
+            cache['deltaMagAvro'] = OrderedDict([('delta_%smag' % 'ugrizy'[i_mag], delta_mag[i_mag])
+                                                 for i_mag in range(6)])
+            cache['chipName'] = np.array(['R:2,2 S:1,1']*len(chunk))
+            cache['pupilFromSky'] = OrderedDict([('x_pupil', xpup), ('y_pupil', ypup)])
+            return cache
+
+        bp_dict = BandpassDict.loadTotalBandpassesFromFiles()
+        shared_cat = AlertStellarVariabilityCatalog(star_db, obs_metadata=self.obs_list[0])
+        shared_cat.lsstBandpassDict = bp_dict
+        context_list = [AlertObservationContext(obs) for obs in self.obs_list]
+        for context in context_list:
+            self.assertEqual(context.obshistid, context.obs_metadata.OpsimMetaData['obsHistID'])
+            self.assertEqual('ugrizy'[context.i_band], context.obs_metadata.bandpass)
+            self.assertEqual(context.tai, context.obs_metadata.mjd.TAI)
+            self.assertIsNone(context.gamma)
+
+            shared_cat.set_observation_context(context)
+            test = list(shared_cat.iter_catalog_chunks(query_cache=[chunk],
+                                                       column_cache=column_cache()))
+            self.assertEqual(len(test), 1)
+            self.assertIsNotNone(context.gamma)
+
+            control_cat = AlertStellarVariabilityCatalog(star_db, obs_metadata=context.obs_metadata)
+            control_cat.lsstBandpassDict = bp_dict
+            control = list(control_cat.iter_catalog_chunks(query_cache=[chunk],
+                                                           column_cache=column_cache()))
+            for col_name in shared_cat.iter_column_names():
+                np.testing.assert_array_equal(test[0][0][test[0][1][col_name]],
+                                              control[0][0][control[0][1][col_name]],
+                                              err_msg=col_name)
+
+        # the columns really do differ between observations
+        self.assertGreater(len(np.unique([context.tai for context in context_list])), 1)
+
+    def test_run_parallel(self):
+        """
+        Test that run_parallel, splitting the most expensive trixels
+        into their children, simulates the same alerts as running
+        alert_data_from_htmid serially on every trixel
+        """
+        StarAlertTestDBObj, TestAlertsVarCat = self.alert_test_classes()
+
+        def db_factory():
+            return StarAlertTestDBObj(database=self.star_db_name, driver='sqlite')
+
+        alert_gen = AlertDataGenerator(testing=True)
+        alert_gen.subdivide_obs(self.obs_list, htmid_level=6)
+        parent_list = list(alert_gen.htmid_list)
+
+        with self.assertRaises(RuntimeError):
+            alert_gen.parallel_task_list(n_obj_dict={})
+
+        # without object counts, the cost is the number of observations
+        task_list = alert_gen.parallel_task_list()
+        self.assertEqual(sorted([task[0] for task in task_list]), sorted(parent_list))
+        for htmid, cost in task_list:
+            self.assertEqual(cost, alert_gen.n_obs(htmid))
+        cost_list = [task[1] for task in task_list]
+        self.assertEqual(cost_list, sorted(cost_list, reverse=True))
+
+        n_obj_dict = dict([(htmid, 2.0*i_htmid) for i_htmid, htmid in enumerate(parent_list)])
+        task_list = alert_gen.parallel_task_list(n_obj_dict=n_obj_dict)
+        for htmid, cost in task_list:
+            self.assertEqual(cost, n_obj_dict[htmid]*alert_gen.n_obs(htmid))
+
+        # count_htmid returns the number of rows query_columns_htmid returns
+        db = db_factory()
+        for htmid in parent_list:
+            n_rows = 0
+            for chunk in db.query_columns_htmid(colnames=['simobjid'], htmid=htmid,
+                                                chunk_size=1000):
+                n_rows += len(chunk)
+            self.assertEqual(db.count_htmid(htmid), n_rows)
+
+        # as run_parallel does, count the objects in the trixels
+        # (including split children)
+        task_list = alert_gen.parallel_task_list(count_objects=db.count_htmid)
+        split_cost = 0.5*task_list[0][1]
+        self.assertGreater(split_cost, 0.0)
+        task_list = alert_gen.parallel_task_list(split_cost=split_cost, max_split_level=8,
+                                                 count_objects=db.count_htmid)
+        self.assertGreater(max([levelFromHtmid(task[0]) for task in task_list]), 6)
+        for htmid, cost in task_list:
+            level = levelFromHtmid(htmid)
+            self.assertTrue(cost <= split_cost or level == 8)
+            self.assertEqual(cost, db.count_htmid(htmid)*alert_gen.n_obs(htmid))
+            parent = htmid >> 2*(level-6)
+            self.assertIn(parent, parent_list)
+            parent_obs = set([obs.OpsimMetaData['obsHistID']
+                              for obs in alert_gen.obs_from_htmid(parent)])
+            for obs in alert_gen.obs_from_htmid(htmid):
+                self.assertIn(obs.OpsimMetaData['obsHistID'], parent_obs)
+
+        serial_dir = tempfile.mkdtemp(dir=ROOT, prefix='alert_gen_serial')
+        parallel_dir = tempfile.mkdtemp(dir=ROOT, prefix='alert_gen_parallel')
+        try:
+            log_file_name = os.path.join(serial_dir, 'log.txt')
+            n_rows_serial = 0
+            for htmid in parent_list:
+                n_rows_serial += alert_gen.alert_data_from_htmid(htmid, db_factory(),
+                                                                 photometry_class=TestAlertsVarCat,
+                                                                 output_prefix='alert_test',
+                                                                 output_dir=serial_dir,
+                                                                 dmag_cutoff=0.005,
+                                                                 log_file_name=log_file_name)
+
+            log_file_name = os.path.join(parallel_dir, 'log.txt')
+            results = alert_gen.run_parallel(db_factory, 2, log_file_name,
+                                             split_cost=split_cost, max_split_level=8,
+                                             photometry_class=TestAlertsVarCat,
+                                             output_prefix='alert_test',
+                                             output_dir=parallel_dir,
+                                             dmag_cutoff=0.005)
+
+            self.assertEqual(sorted(results.keys()), sorted([task[0] for task in task_list]))
+            self.assertNotIn(None, list(results.values()))
+            self.assertEqual(sum(results.values()), n_rows_serial)
+            self.assertGreater(n_rows_serial, 0)
+
+            alert_set = {}
+            for dir_name in (serial_dir, parallel_dir):
+                alert_set[dir_name] = set()
+                for file_name in os.listdir(dir_name):
+                    if not file_name.endswith('db'):
+                        continue
+                    with sqlite3.connect(os.path.join(dir_name, file_name)) as conn:
+                        cursor = conn.cursor()
+                        for row in cursor.execute('SELECT uniqueId, obshistId FROM alert_data'):
+                            alert_set[dir_name].add(row)
+            self.assertEqual(alert_set[serial_dir], alert_set[parallel_dir])
+
+            status_dict = {}
+            with open('%s_progress.json' % log_file_name, 'r') as in_file:
+                for line in in_file:
+                    record = json.loads(line)
+                    status_dict[(record['htmid'], record['status'])] = record
+            for htmid, cost in task_list:
+                for status in ('queued', 'start', 'done'):
+                    self.assertIn((htmid, status), status_dict)
+                self.assertEqual(status_dict[(htmid, 'done')]['n_rows'], results[htmid])
+                self.assertEqual(status_dict[(htmid, 'done')]['cost'], cost)
+        finally:
+            shutil.rmtree(serial_dir)
+            shutil.rmtree(parallel_dir)
+
+        del alert_gen
+        gc.collect()
+
+    def test_checkpoint_resume(self):
+        """
+        Test that a checkpointed alert_data_from_htmid which dies part
+        way through a trixel can be resumed and yields the same output
+        as an uninterrupted run
+        """
+        StarAlertTestDBObj, TestAlertsVarCat = self.alert_test_classes()
+        star_db = StarAlertTestDBObj(database=self.star_db_name, driver='sqlite')
+
+        class CrashingVarCat(TestAlertsVarCat):
+            """
+            Raise after n_calls_to_crash calls to get_alertFlux (never,
+            if n_calls_to_crash is None); count the calls.
+            """
+            n_calls = 0
+            n_calls_to_crash = None
+
+            @compound('flux', 'dflux', 'SNR')
+            def get_alertFlux(self):
+                CrashingVarCat.n_calls += 1
+                if CrashingVarCat.n_calls == CrashingVarCat.n_calls_to_crash:
+                    raise ValueError('the process died')
+                return TestAlertsVarCat.get_alertFlux(self)
+
+        alert_gen = AlertDataGenerator(testing=True)
+        alert_gen.subdivide_obs(self.obs_list, htmid_level=6)
+
+        control_dir = tempfile.mkdtemp(dir=ROOT, prefix='alert_gen_control')
+        resume_dir = tempfile.mkdtemp(dir=ROOT, prefix='alert_gen_resume')
+        kwargs = {'photometry_class': CrashingVarCat, 'output_prefix': 'alert_test',
+                  'dmag_cutoff': 0.005, 'chunk_size': 5, 'write_every': 1}
+        try:
+            log_file_name = os.path.join(control_dir, 'log.txt')
+
+            # find the trixel requiring the most calls to get_alertFlux
+            n_calls_dict = {}
+            n_rows_dict = {}
+            for htmid in alert_gen.htmid_list:
+                CrashingVarCat.n_calls = 0
+                n_rows_dict[htmid] = alert_gen.alert_data_from_htmid(htmid, star_db,
+                                                                     output_dir=control_dir,
+                                                                     log_file_name=log_file_name,
+                                                                     **kwargs)
+                n_calls_dict[htmid] = CrashingVarCat.n_calls
+            htmid = max(n_calls_dict, key=lambda key: n_calls_dict[key])
+            self.assertGreater(n_calls_dict[htmid], 2)
+            self.assertGreater(n_rows_dict[htmid], 0)
+
+            log_file_name = os.path.join(resume_dir, 'log.txt')
+            CrashingVarCat.n_calls = 0
+            CrashingVarCat.n_calls_to_crash = n_calls_dict[htmid]//2+1
+            with self.assertRaises(ValueError):
+                alert_gen.alert_data_from_htmid(htmid, star_db, output_dir=resume_dir,
+                                                log_file_name=log_file_name,
+                                                checkpoint=True, **kwargs)
+
+            file_name = 'alert_test_%d_sqlite.db' % htmid
+            with sqlite3.connect(os.path.join(resume_dir, file_name)) as conn:
+                cursor = conn.cursor()
+                checkpoints = cursor.execute('SELECT i_chunk, simobjid, n_rows, complete '
+                                             'FROM checkpoint').fetchall()
+                n_rows_partial = cursor.execute('SELECT COUNT(*) FROM alert_data').fetchall()[0][0]
+            self.assertGreater(len(checkpoints), 0)
+            self.assertEqual(checkpoints[-1][3], 0)
+            self.assertEqual(checkpoints[-1][2], n_rows_partial)
+            self.assertLess(n_rows_partial, n_rows_dict[htmid])
+
+            # resuming only simulates the objects after the last checkpoint
+            CrashingVarCat.n_calls = 0
+            CrashingVarCat.n_calls_to_crash = None
+            n_rows = alert_gen.alert_data_from_htmid(htmid, star_db, output_dir=resume_dir,
+                                                     log_file_name=log_file_name,
+                                                     checkpoint=True, **kwargs)
+            self.assertEqual(n_rows, n_rows_dict[htmid])
+            self.assertLess(CrashingVarCat.n_calls, n_calls_dict[htmid])
+
+            with sqlite3.connect(os.path.join(resume_dir, file_name)) as conn:
+                cursor = conn.cursor()
+                with sqlite3.connect(os.path.join(control_dir, file_name)) as control_conn:
+                    control_cursor = control_conn.cursor()
+                    for table_name in ('alert_data', 'metadata', 'quiescent_flux',
+                                       'baseline_astrometry'):
+                        query = 'SELECT * FROM %s' % table_name
+                        self.assertEqual(sorted(cursor.execute(query).fetchall()),
+                                         sorted(control_cursor.execute(query).fetchall()),
+                                         msg=table_name)
+
+            # a complete trixel is not simulated again
+            CrashingVarCat.n_calls = 0
+            n_rows = alert_gen.alert_data_from_htmid(htmid, star_db, output_dir=resume_dir,
+                                                     log_file_name=log_file_name,
+                                                     checkpoint=True, **kwargs)
+            self.assertEqual(n_rows, n_rows_dict[htmid])
+            self.assertEqual(CrashingVarCat.n_calls, 0)
+        finally:
+            shutil.rmtree(control_dir)
+            shutil.rmtree(resume_dir)
+
+        del alert_gen
+        gc.collect()
+
+
+class DetectableVariabilityMaskTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    def test_detectable_variability_mask(self):
+        """
+        Test that _detectable_variability_mask agrees with a loop over
+        objects, bands and valid observations
+        """
+        rng = np.random.RandomState(81123)
+        obs_mag_cutoff = (23.68, 24.89, 24.43, 24.0, 24.45, 22.60)
+        dmag_cutoff = 0.005
+        n_detectable = 0
+        for i_trial in range(20):
+            n_obj = rng.randint(1, 40)
+            n_time = rng.randint(1, 12)
+            dmag = rng.normal(0.0, 0.01, size=(n_obj, 6, n_time))
+            time_arr = np.where(rng.random_sample((n_obj, n_time)) > 0.5, 1, -1)
+            q_mags = rng.random_sample((6, n_obj))*3.0 + 22.5
+
+            control = np.zeros(n_obj, dtype=bool)
+            for i_obj in range(n_obj):
+                valid_times = np.where(time_arr[i_obj] > 0)
+                if len(valid_times[0]) == 0:
+                    continue
+                for i_filter in range(6):
+                    if np.abs(dmag[i_obj][i_filter][valid_times]).max() > dmag_cutoff:
+                        dmag_min = dmag[i_obj][i_filter][valid_times].min()
+                        if q_mags[i_filter][i_obj] + dmag_min <= obs_mag_cutoff[i_filter]:
+                            control[i_obj] = True
+                            break
+
+            test = _detectable_variability_mask(dmag, time_arr, q_mags,
+                                                dmag_cutoff, obs_mag_cutoff)
+            np.testing.assert_array_equal(test, control)
+            n_detectable += control.sum()
+        self.assertGreater(n_detectable, 0)
+
+
+class FocalPlaneFootprintTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    @classmethod
+    def tearDownClass(cls):
+        clean_up_lsst_camera()
+
+    def test_focal_plane_footprint(self):
+        """
+        Test that the focal plane prefilter never rejects a point which
+        lands on a detector, but does reject points off the focal plane
+        """
+        footprint = _lsst_focal_plane_footprint()
+        rng = np.random.RandomState(44156)
+        xpup = rng.random_sample(200000)*0.09-0.045
+        ypup = rng.random_sample(200000)*0.09-0.045
+        on_chip = np.not_equal(chipNameFromPupilCoordsLSST(xpup, ypup), None)
+        in_footprint = _in_focal_plane_footprint(xpup, ypup, footprint)
+        self.assertGreater(on_chip.sum(), 1000)
+        self.assertEqual(np.logical_and(on_chip, np.logical_not(in_footprint)).sum(), 0)
+        self.assertGreater(np.logical_not(in_footprint).sum(), len(xpup)//2)
+        self.assertLessEqual(np.sqrt(xpup[on_chip]**2 + ypup[on_chip]**2).max(),
+                             footprint['max_radius'])
+
+        # points outside of the bitmap are rejected
+        self.assertFalse(_in_focal_plane_footprint(np.array([0.1]), np.array([0.0]),
+                                                   footprint)[0])
+
 
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass
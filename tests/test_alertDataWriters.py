@@ -0,0 +1,313 @@
+import unittest
+import os
+import numbers
+import sqlite3
+import tempfile
+import shutil
+import numpy as np
+import lsst.utils.tests
+
+from lsst.sims.catUtils.utils import SqliteAlertDataWriter
+from lsst.sims.catUtils.utils import NpyAlertDataWriter
+from lsst.sims.catUtils.utils import NpzAlertDataWriter
+from lsst.sims.catUtils.utils import NpyAlertDataReader
+from lsst.sims.catUtils.utils import alert_data_writer_class
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class AlertDataWritersTestCase(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp(dir=ROOT, prefix='AlertDataWritersTestCase-')
+        rng = np.random.RandomState(5512)
+        self.obshistid = np.array([112, 54, 230])
+        self.tai = rng.random_sample(3)*100.0+59580.0
+        self.band = np.array([2, 0, 2])
+
+        # the data caches handed to write_alert_data by
+        # AlertDataGenerator.alert_data_from_htmid
+        self.data_cache_list = []
+        self.unique_id = np.arange(1024, 1024*40, 1024)
+        for i_write in range(2):
+            data_cache = {}
+            for obshistid in self.obshistid[:2]:
+                cache_tag = '%d_%d' % (obshistid, i_write)
+                unq = rng.choice(self.unique_id, size=rng.randint(5, 20), replace=False)
+                data_cache[cache_tag] = {}
+                data_cache[cache_tag]['uniqueId'] = unq
+                data_cache[cache_tag]['chipNum'] = rng.randint(0, 200, size=len(unq)).astype(float)
+                for col_name in ('xPix', 'yPix', 'dflux', 'SNR', 'raICRS', 'decICRS', 'flux'):
+                    data_cache[cache_tag][col_name] = rng.random_sample(len(unq))
+            self.data_cache_list.append(data_cache)
+
+        self.q_flux = rng.random_sample((6, len(self.unique_id)))
+        self.q_snr = rng.random_sample((6, len(self.unique_id)))
+        self.astrometry = rng.random_sample((5, len(self.unique_id)))
+
+    def tearDown(self):
+        if os.path.exists(self.scratch_dir):
+            shutil.rmtree(self.scratch_dir)
+
+    def write_data(self, writer):
+        """
+        Write the test data with writer; return the number of alert_data rows
+        """
+        n_rows = 0
+        with writer:
+            writer.write_metadata(self.obshistid, self.tai, self.band)
+            half = len(self.unique_id)//2
+            for i_write, obj_slice in enumerate((slice(0, half), slice(half, None))):
+                unq = self.unique_id[obj_slice]
+                writer.write_quiescent_flux(np.tile(unq, 6),
+                                            np.repeat(np.arange(6), len(unq)),
+                                            self.q_flux[:, obj_slice].flatten(),
+                                            self.q_snr[:, obj_slice].flatten())
+                writer.write_baseline_astrometry(unq, *(list(self.astrometry[:, obj_slice]) +
+                                                        [59580.0]))
+                n_rows += writer.write_alert_data(self.data_cache_list[i_write])
+        return n_rows
+
+    def test_writer_class(self):
+        self.assertIs(alert_data_writer_class('sqlite'), SqliteAlertDataWriter)
+        self.assertIs(alert_data_writer_class('npy'), NpyAlertDataWriter)
+        self.assertIs(alert_data_writer_class('npz'), NpzAlertDataWriter)
+        with self.assertRaises(RuntimeError):
+            alert_data_writer_class('parquet')
+
+        # the 'npz' writer is constructed the way alert_data_from_htmid
+        # constructs writers, and writes compressed parts
+        writer_class = alert_data_writer_class('npz')
+        self.write_data(writer_class(self.scratch_dir, 'test', 1234, checkpoint=False))
+        metadata_dir = os.path.join(self.scratch_dir, 'test_1234_npy', 'metadata', 'all')
+        self.assertEqual(os.listdir(metadata_dir), ['part_000000.npz'])
+        data = NpyAlertDataReader(os.path.join(self.scratch_dir, 'test_1234_npy')).read('metadata')
+        np.testing.assert_array_equal(data['obshistId'], self.obshistid)
+
+    def test_sqlite_writer(self):
+        """
+        Test that SqliteAlertDataWriter writes every row of its caches
+        with the right types and counts the rows without querying
+        the database
+        """
+        writer = SqliteAlertDataWriter(self.scratch_dir, 'test', 1234)
+        with sqlite3.connect(writer.file_name) as conn:
+            cursor = conn.cursor()
+            self.assertEqual(cursor.execute('PRAGMA journal_mode').fetchall()[0][0], 'wal')
+        self.assertEqual(writer._cursor.execute('PRAGMA synchronous').fetchall()[0][0], 0)
+        n_rows = self.write_data(writer)
+
+        n_total = 0
+        with sqlite3.connect(os.path.join(self.scratch_dir, 'test_1234_sqlite.db')) as conn:
+            cursor = conn.cursor()
+            for data_cache in self.data_cache_list:
+                for cache_tag in data_cache:
+                    obshistid = int(cache_tag.split('_')[0])
+                    local_cache = data_cache[cache_tag]
+                    n_total += len(local_cache['uniqueId'])
+                    for i_obj in range(len(local_cache['uniqueId'])):
+                        rows = cursor.execute('SELECT * FROM alert_data WHERE uniqueId=? '
+                                              'AND obshistId=? AND xPix=?',
+                                              (int(local_cache['uniqueId'][i_obj]), obshistid,
+                                               local_cache['xPix'][i_obj])).fetchall()
+                        self.assertEqual(len(rows), 1)
+                        row = rows[0]
+                        self.assertIsInstance(row[4], numbers.Integral)
+                        self.assertEqual(row[4], int(local_cache['chipNum'][i_obj]))
+                        self.assertEqual(row[5], local_cache['dflux'][i_obj])
+                        self.assertEqual(row[6], local_cache['SNR'][i_obj])
+                        self.assertAlmostEqual(row[7], np.degrees(local_cache['raICRS'][i_obj]), 10)
+                        self.assertAlmostEqual(row[8], np.degrees(local_cache['decICRS'][i_obj]), 10)
+
+            self.assertEqual(n_rows, n_total)
+            self.assertEqual(cursor.execute('SELECT COUNT(*) FROM alert_data').fetchall()[0][0],
+                             n_total)
+            self.assertEqual(cursor.execute('SELECT COUNT(*) FROM quiescent_flux').fetchall()[0][0],
+                             6*len(self.unique_id))
+            self.assertEqual(cursor.execute('SELECT COUNT(*) FROM baseline_astrometry').fetchall()[0][0],
+                             len(self.unique_id))
+            indexes = cursor.execute("SELECT name FROM sqlite_master WHERE type='index'").fetchall()
+            self.assertEqual(len(indexes), 4)
+
+    def test_sqlite_checkpoint(self):
+        """
+        Test that a checkpointed sqlite file can be reopened at its last
+        checkpoint and completed without duplicating any rows
+        """
+        control_dir = os.path.join(self.scratch_dir, 'control')
+        os.mkdir(control_dir)
+        n_rows_control = self.write_data(SqliteAlertDataWriter(control_dir, 'test', 1234))
+
+        half = len(self.unique_id)//2
+        with self.assertRaises(ValueError):
+            with SqliteAlertDataWriter(self.scratch_dir, 'test', 1234, checkpoint=True) as writer:
+                self.assertIsNone(writer.last_checkpoint)
+                # checkpoints must survive a crash: synchronous=NORMAL
+                self.assertEqual(writer._cursor.execute('PRAGMA synchronous').fetchall()[0][0], 1)
+                writer.write_metadata(self.obshistid, self.tai, self.band)
+                unq = self.unique_id[:half]
+                writer.write_quiescent_flux(np.tile(unq, 6), np.repeat(np.arange(6), len(unq)),
+                                            self.q_flux[:, :half].flatten(),
+                                            self.q_snr[:, :half].flatten())
+                writer.write_baseline_astrometry(unq, *(list(self.astrometry[:, :half]) +
+                                                        [59580.0]))
+                with self.assertRaises(RuntimeError):
+                    writer.write_alert_data({})
+                n_rows_0 = writer.write_alert_data(self.data_cache_list[0], i_chunk=3, simobjid=77)
+                self.assertEqual(writer.n_rows, n_rows_0)
+
+                # these rows are lost with the process
+                writer.write_quiescent_flux(np.tile(self.unique_id[half:], 6),
+                                            np.repeat(np.arange(6), len(self.unique_id)-half),
+                                            self.q_flux[:, half:].flatten(),
+                                            self.q_snr[:, half:].flatten())
+                raise ValueError('the process died')
+
+        with SqliteAlertDataWriter(self.scratch_dir, 'test', 1234, checkpoint=True) as writer:
+            self.assertEqual(writer.last_checkpoint, {'i_chunk': 3, 'simobjid': 77,
+                                                      'n_rows': n_rows_0, 'complete': False})
+            self.assertFalse(writer.complete)
+            self.assertEqual(writer.n_rows, n_rows_0)
+            unq = self.unique_id[half:]
+            writer.write_quiescent_flux(np.tile(unq, 6), np.repeat(np.arange(6), len(unq)),
+                                        self.q_flux[:, half:].flatten(),
+                                        self.q_snr[:, half:].flatten())
+            writer.write_baseline_astrometry(unq, *(list(self.astrometry[:, half:]) +
+                                                    [59580.0]))
+            writer.write_alert_data(self.data_cache_list[1], i_chunk=5, simobjid=102)
+            self.assertEqual(writer.n_rows, n_rows_control)
+
+        with sqlite3.connect(os.path.join(self.scratch_dir, 'test_1234_sqlite.db')) as conn:
+            cursor = conn.cursor()
+            with sqlite3.connect(os.path.join(control_dir, 'test_1234_sqlite.db')) as control_conn:
+                control_cursor = control_conn.cursor()
+                for table_name in ('alert_data', 'metadata', 'quiescent_flux',
+                                   'baseline_astrometry'):
+                    query = 'SELECT * FROM %s' % table_name
+                    self.assertEqual(sorted(cursor.execute(query).fetchall()),
+                                     sorted(control_cursor.execute(query).fetchall()),
+                                     msg=table_name)
+            checkpoints = cursor.execute('SELECT * FROM checkpoint').fetchall()
+            self.assertEqual(checkpoints, [(3, 77, n_rows_0, 0),
+                                           (5, 102, n_rows_control, 0),
+                                           (5, 102, n_rows_control, 1)])
+
+        # a complete file is left as it is
+        with SqliteAlertDataWriter(self.scratch_dir, 'test', 1234, checkpoint=True) as writer:
+            self.assertTrue(writer.complete)
+            self.assertEqual(writer.n_rows, n_rows_control)
+
+        # files written without checkpoints cannot be resumed
+        with self.assertRaises(RuntimeError):
+            SqliteAlertDataWriter(control_dir, 'test', 1234, checkpoint=True)
+        with self.assertRaises(RuntimeError):
+            NpyAlertDataWriter(control_dir, 'test', 1234, checkpoint=True)
+
+    def test_npy_matches_sqlite(self):
+        """
+        Test that the columnar backend stores the same tables as the
+        sqlite backend
+        """
+        n_rows_sqlite = self.write_data(SqliteAlertDataWriter(self.scratch_dir, 'test', 1234))
+        for compressed in (False, True):
+            npy_dir = os.path.join(self.scratch_dir, 'npy_%s' % compressed)
+            os.mkdir(npy_dir)
+            n_rows_npy = self.write_data(NpyAlertDataWriter(npy_dir, 'test', 1234,
+                                                            compressed=compressed))
+            self.assertEqual(n_rows_npy, n_rows_sqlite)
+
+            # the temporary directory has been moved into place
+            self.assertEqual(os.listdir(npy_dir), ['test_1234_npy'])
+            reader = NpyAlertDataReader(os.path.join(npy_dir, 'test_1234_npy'))
+            self.assertEqual(reader.obshistid_list, sorted(self.obshistid[:2]))
+
+            with sqlite3.connect(os.path.join(self.scratch_dir, 'test_1234_sqlite.db')) as conn:
+                cursor = conn.cursor()
+                for table_name, order_by in (('metadata', 'obshistId'),
+                                             ('quiescent_flux', 'band, uniqueId'),
+                                             ('baseline_astrometry', 'uniqueId')):
+                    data = reader.read(table_name)
+                    control = np.array(cursor.execute('SELECT * FROM %s ORDER BY %s' %
+                                                      (table_name, order_by)).fetchall())
+                    col_names = list(data.keys())
+                    order = np.lexsort([data[col_name] for col_name in
+                                        reversed(order_by.replace(' ', '').split(','))])
+                    for i_col, col_name in enumerate(col_names):
+                        np.testing.assert_array_equal(data[col_name][order], control[:, i_col],
+                                                      err_msg='%s.%s' % (table_name, col_name))
+
+                for obshistid in self.obshistid:
+                    # predicate pushdown on obshistid
+                    data = reader.read('alert_data', obshistid=obshistid)
+                    control = np.array(cursor.execute('SELECT * FROM alert_data WHERE obshistId=%d '
+                                                      'ORDER BY uniqueId' % obshistid).fetchall())
+                    self.assertEqual(reader.n_rows('alert_data', obshistid=obshistid), len(control))
+                    self.assertEqual(len(data['uniqueId']), len(control))
+                    if len(control) == 0:
+                        continue
+                    order = np.argsort(data['uniqueId'], kind='mergesort')
+                    for i_col, col_name in enumerate(data):
+                        np.testing.assert_array_equal(data[col_name][order], control[:, i_col],
+                                                      err_msg='alert_data.%s' % col_name)
+
+                    # the join performed by AvroAlertGenerator.write_alerts
+                    query = 'SELECT alert.uniqueId, alert.xPix, alert.yPix, '
+                    query += 'alert.chipNum, alert.dflux, alert.snr, alert.ra, alert.dec, '
+                    query += 'meta.band, meta.TAI, quiescent.flux, quiescent.snr '
+                    query += 'FROM alert_data as alert '
+                    query += 'INNER JOIN metadata AS meta ON alert.obshistId=meta.obshistId '
+                    query += 'INNER JOIN quiescent_flux AS quiescent '
+                    query += 'ON quiescent.uniqueId=alert.uniqueID '
+                    query += 'AND quiescent.band=meta.band '
+                    query += 'WHERE alert.obshistId=%d ' % obshistid
+                    query += 'ORDER BY alert.uniqueId, alert.xPix'
+                    control = np.array(cursor.execute(query).fetchall())
+                    diasource_data = reader.diasource_data(obshistid)
+                    order = np.lexsort((diasource_data['xPix'], diasource_data['uniqueId']))
+                    for i_col, col_name in enumerate(diasource_data.dtype.names):
+                        np.testing.assert_array_equal(diasource_data[col_name][order],
+                                                      control[:, i_col],
+                                                      err_msg='diasource %s' % col_name)
+
+    def test_npy_mmap(self):
+        """
+        Test that uncompressed columns are memory-mapped (unless asked
+        not to be) and that a failed write leaves nothing behind
+        """
+        self.write_data(NpyAlertDataWriter(self.scratch_dir, 'test', 1234))
+        npy_dir = os.path.join(self.scratch_dir, 'test_1234_npy')
+        data = NpyAlertDataReader(npy_dir).read('alert_data', obshistid=self.obshistid[0],
+                                                columns=['uniqueId', 'dflux'])
+        self.assertEqual(list(data.keys()), ['uniqueId', 'dflux'])
+        # two writes yield two parts, which are concatenated
+        self.assertNotIsInstance(data['dflux'], np.memmap)
+        data = NpyAlertDataReader(npy_dir).read('metadata')
+        self.assertIsInstance(data['TAI'], np.memmap)
+        data = NpyAlertDataReader(npy_dir, mmap=False).read('metadata')
+        self.assertNotIsInstance(data['TAI'], np.memmap)
+        with self.assertRaises(RuntimeError):
+            NpyAlertDataReader(npy_dir).read('metadata', obshistid=self.obshistid[0])
+        with self.assertRaises(RuntimeError):
+            NpyAlertDataReader(npy_dir).read('alert_data', columns=['flux'])
+
+        shutil.rmtree(npy_dir)
+        with self.assertRaises(ValueError):
+            with NpyAlertDataWriter(self.scratch_dir, 'test', 1234) as writer:
+                writer.write_metadata(self.obshistid, self.tai, self.band)
+                raise ValueError('fail')
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+
+class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -40,6 +40,12 @@ except ImportError:
     _avro_is_installed = False
     pass
 
+_fastavro_is_installed = True
+try:
+    import fastavro
+except ImportError:
+    _fastavro_is_installed = False
+
 
 ROOT = os.path.abspath(os.path.dirname(__file__))
 
@@ -626,6 +632,359 @@ class AvroAlertTestCase(unittest.TestCase):
 
         self.assertEqual(alert_ct, len(true_alert_dict))
 
+    def test_avro_alert_generation_npy(self):
+        """
+        Make sure that the AvroAlertGenerator writes the same alerts
+        whether the AlertDataGenerator wrote sqlite or npy output
+        """
+        dmag_cutoff = 0.005
+        star_db = StarAlertTestDBObj_avro(database=self.star_db_name, driver='sqlite')
+        npy_output_dir = tempfile.mkdtemp(dir=ROOT, prefix='avro_gen_npy_output')
+
+        log_file_name = tempfile.mktemp(dir=self.alert_data_output_dir, suffix='log.txt')
+        alert_gen = AlertDataGenerator(testing=True)
+        alert_gen.subdivide_obs(self.obs_list, htmid_level=6)
+
+        obshistid_to_htmid = {}
+        for htmid in alert_gen.htmid_list:
+            for output_dir, output_format in ((self.alert_data_output_dir, 'sqlite'),
+                                              (npy_output_dir, 'npy')):
+                alert_gen.alert_data_from_htmid(htmid, star_db,
+                                                photometry_class=TestAlertsVarCat_avro,
+                                                output_prefix='alert_test',
+                                                output_dir=output_dir,
+                                                dmag_cutoff=dmag_cutoff,
+                                                log_file_name=log_file_name,
+                                                output_format=output_format)
+
+            for obs in alert_gen.obs_from_htmid(htmid):
+                obshistid = obs.OpsimMetaData['obsHistID']
+                if obshistid not in obshistid_to_htmid:
+                    obshistid_to_htmid[obshistid] = []
+                obshistid_to_htmid[obshistid].append(htmid)
+
+        avro_gen = AvroAlertGenerator()
+        avro_gen.load_schema(os.path.join(getPackageDir('sims_catUtils'), 'tests', 'testData', 'avroSchema'))
+        alert_dict = {}
+        for data_dir, out_prefix in ((self.alert_data_output_dir, 'test_sqlite'),
+                                     (npy_output_dir, 'test_npy')):
+            alert_dict[out_prefix] = {}
+            for obshistid in obshistid_to_htmid:
+                avro_gen.write_alerts(obshistid, data_dir, ['alert_test'],
+                                      obshistid_to_htmid[obshistid],
+                                      self.avro_out_dir, out_prefix,
+                                      dmag_cutoff)
+
+                full_name = os.path.join(self.avro_out_dir, '%s_%d.avro' % (out_prefix, obshistid))
+                with DataFileReader(open(full_name, 'rb'), DatumReader()) as data_reader:
+                    for alert in data_reader:
+                        alert_dict[out_prefix][alert['alertId']] = alert
+
+        shutil.rmtree(npy_output_dir)
+        del alert_gen
+        gc.collect()
+
+        self.assertGreater(len(alert_dict['test_sqlite']), 10)
+        self.assertEqual(set(alert_dict['test_sqlite'].keys()), set(alert_dict['test_npy'].keys()))
+        for alert_id in alert_dict['test_sqlite']:
+            sqlite_alert = alert_dict['test_sqlite'][alert_id]
+            npy_alert = alert_dict['test_npy'][alert_id]
+            self.assertEqual(sqlite_alert['l1dbId'], npy_alert['l1dbId'])
+            for field in ('diaSourceId', 'ccdVisitId', 'x', 'y', 'ra', 'decl',
+                          'midPointTai', 'psFlux', 'totFlux', 'snr'):
+                self.assertEqual(sqlite_alert['diaSource'][field], npy_alert['diaSource'][field],
+                                 msg=field)
+            for field in ('ra', 'decl', 'pmRa', 'pmDecl', 'parallax', 'radecTai'):
+                self.assertEqual(sqlite_alert['diaObject'][field], npy_alert['diaObject'][field],
+                                 msg=field)
+
+    def test_avro_alert_generation_by_trixel(self):
+        """
+        Make sure that write_alerts_by_trixel writes the same alerts
+        as calling write_alerts on each obsHistID
+        """
+        dmag_cutoff = 0.005
+        star_db = StarAlertTestDBObj_avro(database=self.star_db_name, driver='sqlite')
+        npy_output_dir = tempfile.mkdtemp(dir=ROOT, prefix='avro_gen_npy_output')
+
+        log_file_name = tempfile.mktemp(dir=self.alert_data_output_dir, suffix='log.txt')
+        alert_gen = AlertDataGenerator(testing=True)
+        alert_gen.subdivide_obs(self.obs_list, htmid_level=6)
+
+        obshistid_to_htmid = {}
+        for htmid in alert_gen.htmid_list:
+            for output_dir, output_format in ((self.alert_data_output_dir, 'sqlite'),
+                                              (npy_output_dir, 'npy')):
+                alert_gen.alert_data_from_htmid(htmid, star_db,
+                                                photometry_class=TestAlertsVarCat_avro,
+                                                output_prefix='alert_test',
+                                                output_dir=output_dir,
+                                                dmag_cutoff=dmag_cutoff,
+                                                log_file_name=log_file_name,
+                                                output_format=output_format)
+
+            for obs in alert_gen.obs_from_htmid(htmid):
+                obshistid = obs.OpsimMetaData['obsHistID']
+                if obshistid not in obshistid_to_htmid:
+                    obshistid_to_htmid[obshistid] = []
+                obshistid_to_htmid[obshistid].append(htmid)
+
+        schema_dir = os.path.join(getPackageDir('sims_catUtils'), 'tests', 'testData', 'avroSchema')
+
+        # diaSourceIds are assigned in order of obsHistID
+        avro_gen = AvroAlertGenerator()
+        avro_gen.load_schema(schema_dir)
+        for obshistid in sorted(obshistid_to_htmid):
+            avro_gen.write_alerts(obshistid, self.alert_data_output_dir, ['alert_test'],
+                                  obshistid_to_htmid[obshistid],
+                                  self.avro_out_dir, 'test_control', dmag_cutoff)
+
+        alert_ct = {}
+        for data_dir, out_prefix, n_proc in ((self.alert_data_output_dir, 'test_sqlite', 2),
+                                             (npy_output_dir, 'test_npy', 2),
+                                             (self.alert_data_output_dir, 'test_serial', 1)):
+            avro_gen = AvroAlertGenerator()
+            avro_gen.load_schema(schema_dir)
+            # max_open_files=1 forces the writers to re-open files in append mode
+            alert_ct[out_prefix] = avro_gen.write_alerts_by_trixel(data_dir, ['alert_test'],
+                                                                   alert_gen.htmid_list,
+                                                                   self.avro_out_dir, out_prefix,
+                                                                   dmag_cutoff, n_proc=n_proc,
+                                                                   n_writers=2, max_open_files=1)
+
+        alert_dict = {}
+        for out_prefix in ('test_control', 'test_sqlite', 'test_npy', 'test_serial'):
+            alert_dict[out_prefix] = {}
+            for obshistid in obshistid_to_htmid:
+                full_name = os.path.join(self.avro_out_dir, '%s_%d.avro' % (out_prefix, obshistid))
+                if not os.path.exists(full_name):
+                    self.assertNotEqual(out_prefix, 'test_control')
+                    self.assertNotIn(obshistid, alert_ct[out_prefix])
+                    continue
+                alert_id_set = set()
+                with DataFileReader(open(full_name, 'rb'), DatumReader()) as data_reader:
+                    for alert in data_reader:
+                        self.assertEqual(alert['alertId'] >> 20, obshistid)
+                        self.assertNotIn(alert['alertId'], alert_id_set)
+                        alert_id_set.add(alert['alertId'])
+                        alert_dict[out_prefix][(obshistid, alert['l1dbId'])] = alert
+                if out_prefix != 'test_control':
+                    self.assertEqual(alert_ct[out_prefix][obshistid], len(alert_id_set))
+
+        shutil.rmtree(npy_output_dir)
+        del alert_gen
+        gc.collect()
+
+        self.assertGreater(len(alert_dict['test_control']), 10)
+        for out_prefix in ('test_sqlite', 'test_npy'):
+            self.assertEqual(set(alert_dict[out_prefix].keys()),
+                             set(alert_dict['test_control'].keys()), msg=out_prefix)
+            for alert_key in alert_dict['test_control']:
+                control_alert = alert_dict['test_control'][alert_key]
+                test_alert = alert_dict[out_prefix][alert_key]
+                for field in ('diaSourceId', 'ccdVisitId', 'diaObjectId', 'x', 'y', 'ra', 'decl',
+                              'midPointTai', 'psFlux', 'totFlux', 'snr'):
+                    self.assertEqual(control_alert['diaSource'][field], test_alert['diaSource'][field],
+                                     msg=field)
+                for field in ('ra', 'decl', 'pmRa', 'pmDecl', 'parallax', 'radecTai'):
+                    self.assertEqual(control_alert['diaObject'][field], test_alert['diaObject'][field],
+                                     msg=field)
+
+        # the random fields are seeded per trixel, so they do not
+        # depend on the number of processes
+        self.assertEqual(set(alert_dict['test_serial'].keys()),
+                         set(alert_dict['test_sqlite'].keys()))
+        for alert_key in alert_dict['test_sqlite']:
+            for record in ('diaSource', 'diaObject'):
+                self.assertEqual(alert_dict['test_serial'][alert_key][record],
+                                 alert_dict['test_sqlite'][alert_key][record], msg=record)
+
+    @unittest.skipIf(not _fastavro_is_installed, 'fastavro is not installed on this system')
+    def test_fastavro_backend(self):
+        """
+        Make sure that the fastavro backend writes the same alerts as the
+        avro backend (in files readable with avro) for any codec and
+        sync_interval
+        """
+        dmag_cutoff = 0.005
+        star_db = StarAlertTestDBObj_avro(database=self.star_db_name, driver='sqlite')
+
+        log_file_name = tempfile.mktemp(dir=self.alert_data_output_dir, suffix='log.txt')
+        alert_gen = AlertDataGenerator(testing=True)
+        alert_gen.subdivide_obs(self.obs_list, htmid_level=6)
+
+        obshistid_to_htmid = {}
+        for htmid in alert_gen.htmid_list:
+            alert_gen.alert_data_from_htmid(htmid, star_db,
+                                            photometry_class=TestAlertsVarCat_avro,
+                                            output_prefix='alert_test',
+                                            output_dir=self.alert_data_output_dir,
+                                            dmag_cutoff=dmag_cutoff,
+                                            log_file_name=log_file_name)
+
+            for obs in alert_gen.obs_from_htmid(htmid):
+                obshistid = obs.OpsimMetaData['obsHistID']
+                if obshistid not in obshistid_to_htmid:
+                    obshistid_to_htmid[obshistid] = []
+                obshistid_to_htmid[obshistid].append(htmid)
+
+        schema_dir = os.path.join(getPackageDir('sims_catUtils'), 'tests', 'testData', 'avroSchema')
+
+        backend_kwargs = {'test_avro': {},
+                          'test_fastavro': {'backend': 'fastavro'},
+                          'test_deflate': {'backend': 'fastavro', 'codec': 'deflate',
+                                           'sync_interval': 1000}}
+
+        alert_dict = {}
+        for out_prefix in backend_kwargs:
+            avro_gen = AvroAlertGenerator(**backend_kwargs[out_prefix])
+            avro_gen.load_schema(schema_dir)
+            for obshistid in sorted(obshistid_to_htmid):
+                avro_gen.write_alerts(obshistid, self.alert_data_output_dir, ['alert_test'],
+                                      obshistid_to_htmid[obshistid],
+                                      self.avro_out_dir, out_prefix, dmag_cutoff)
+
+            alert_dict[out_prefix] = {}
+            for obshistid in obshistid_to_htmid:
+                full_name = os.path.join(self.avro_out_dir, '%s_%d.avro' % (out_prefix, obshistid))
+                with DataFileReader(open(full_name, 'rb'), DatumReader()) as data_reader:
+                    for alert in data_reader:
+                        alert_dict[out_prefix][alert['alertId']] = alert
+
+        # the fastavro backend re-opens files in append mode when
+        # max_open_files is exceeded
+        avro_gen = AvroAlertGenerator(backend='fastavro', codec='deflate')
+        avro_gen.load_schema(schema_dir)
+        alert_ct = avro_gen.write_alerts_by_trixel(self.alert_data_output_dir, ['alert_test'],
+                                                   alert_gen.htmid_list, self.avro_out_dir,
+                                                   'test_trixel', dmag_cutoff, max_open_files=1)
+        trixel_alert_dict = {}
+        for obshistid in alert_ct:
+            full_name = os.path.join(self.avro_out_dir, 'test_trixel_%d.avro' % obshistid)
+            with DataFileReader(open(full_name, 'rb'), DatumReader()) as data_reader:
+                for alert in data_reader:
+                    trixel_alert_dict[alert['diaSource']['diaSourceId']] = alert
+
+        del alert_gen
+        gc.collect()
+
+        self.assertGreater(len(alert_dict['test_avro']), 10)
+        for out_prefix in ('test_fastavro', 'test_deflate'):
+            self.assertEqual(alert_dict[out_prefix], alert_dict['test_avro'], msg=out_prefix)
+
+        self.assertEqual(sum(alert_ct.values()), len(alert_dict['test_avro']))
+        for alert in alert_dict['test_avro'].values():
+            trixel_alert = trixel_alert_dict[alert['diaSource']['diaSourceId']]
+            # the random fields are drawn in a different order
+            for field in ('ccdVisitId', 'diaObjectId', 'x', 'y', 'ra', 'decl',
+                          'midPointTai', 'psFlux', 'totFlux', 'snr'):
+                self.assertEqual(trixel_alert['diaSource'][field], alert['diaSource'][field],
+                                 msg=field)
+
+        with self.assertRaises(RuntimeError) as context:
+            AvroAlertGenerator(backend='not_a_backend')
+        self.assertIn('backend', context.exception.args[0])
+
+        with self.assertRaises(RuntimeError) as context:
+            AvroAlertGenerator(sync_interval=1000)
+        self.assertIn('sync_interval', context.exception.args[0])
+
+        avro_gen = AvroAlertGenerator(backend='fastavro', codec='not_a_codec')
+        with self.assertRaises(RuntimeError) as context:
+            avro_gen.load_schema(schema_dir)
+        self.assertIn('not_a_codec', context.exception.args[0])
+
+
+class AvroRecordTestCase(unittest.TestCase):
+    """
+    Test the construction of diaSource and diaObject records
+    (which does not need avro)
+    """
+
+    longMessage = True
+
+    def setUp(self):
+        rng = np.random.RandomState(8812)
+        n_rows = 20
+        self.diasource_data = np.recarray(n_rows,
+                                          dtype=np.dtype([('uniqueId', int), ('xPix', float),
+                                                          ('yPix', float), ('chipNum', int),
+                                                          ('dflux', float), ('tot_snr', float),
+                                                          ('ra', float), ('dec', float),
+                                                          ('band', int), ('TAI', float),
+                                                          ('quiescent_flux', float),
+                                                          ('quiescent_snr', float)]))
+        for name in self.diasource_data.dtype.names:
+            self.diasource_data[name] = rng.random_sample(n_rows)*100.0+1.0
+        self.diasource_data['uniqueId'] = (rng.randint(0, 5, n_rows)+1)*1024
+        self.diasource_data['chipNum'] = rng.randint(0, 190, n_rows)
+        self.diasource_data['band'] = rng.randint(0, 6, n_rows)
+
+        self.diaobject_data = np.recarray(5, dtype=np.dtype([('uniqueId', int), ('ra', float),
+                                                             ('dec', float), ('TAI', float),
+                                                             ('pmRA', float), ('pmDec', float),
+                                                             ('parallax', float)]))
+        for name in self.diaobject_data.dtype.names:
+            self.diaobject_data[name] = rng.random_sample(5)
+        self.diaobject_data['uniqueId'] = (np.arange(5)+1)*1024
+
+    def test_legacy_random_stream(self):
+        """
+        Test that legacy_random_stream=True draws the random fields
+        one record at a time from RandomState(7123) and that both
+        modes agree on every other field
+        """
+        legacy_gen = AvroAlertGenerator(legacy_random_stream=True)
+        fast_gen = AvroAlertGenerator()
+        legacy_sources = legacy_gen._create_sources(77, self.diasource_data)
+        legacy_objects = legacy_gen._create_objects(self.diaobject_data)
+        fast_sources = fast_gen._create_sources(77, self.diasource_data)
+        fast_objects = fast_gen._create_objects(self.diaobject_data)
+
+        rng = np.random.RandomState(7123)
+        self.assertEqual(len(legacy_sources), len(self.diasource_data))
+        source_ct = {}
+        for i_source, (legacy, fast) in enumerate(zip(legacy_sources, fast_sources)):
+            row = self.diasource_data[i_source]
+            self.assertEqual(legacy['flags'], rng.randint(10, 1000))
+            self.assertEqual(legacy['ra_decl_Cov']['raSigma'], rng.random_sample()*0.001)
+            self.assertEqual(legacy['ra_decl_Cov']['declSigma'], rng.random_sample()*0.001)
+            self.assertEqual(legacy['ra_decl_Cov']['ra_decl_Cov'], rng.random_sample()*0.001)
+            self.assertEqual(legacy['x_y_Cov']['xSigma'], rng.random_sample()*0.001*3600.0/0.2)
+            self.assertEqual(legacy['x_y_Cov']['ySigma'], rng.random_sample()*0.001*3600.0/0.2)
+            self.assertEqual(legacy['x_y_Cov']['x_y_Cov'], rng.random_sample()*0.001)
+
+            unq = row['uniqueId']
+            source_ct[unq] = source_ct.get(unq, 0) + 1
+            self.assertEqual(legacy['diaSourceId'], (unq << 10) + source_ct[unq])
+            self.assertEqual(legacy['ccdVisitId'], row['chipNum']*10**7 + 77)
+            self.assertEqual(legacy['filterName'], 'ugrizy'[row['band']])
+            tot_flux = row['dflux'] + row['quiescent_flux']
+            self.assertAlmostEqual(legacy['totFlux'], tot_flux, 10)
+            self.assertAlmostEqual(legacy['totFluxErr'], tot_flux/row['tot_snr'], 10)
+
+            self.assertEqual(set(legacy.keys()), set(fast.keys()))
+            for field in legacy:
+                if field in ('flags', 'ra_decl_Cov', 'x_y_Cov'):
+                    continue
+                self.assertEqual(legacy[field], fast[field], msg=field)
+            self.assertGreaterEqual(fast['flags'], 10)
+            self.assertLess(fast['flags'], 1000)
+
+        self.assertEqual(set(legacy_objects.keys()), set(self.diaobject_data['uniqueId']))
+        for row in self.diaobject_data:
+            legacy = legacy_objects[row['uniqueId']]
+            fast = fast_objects[row['uniqueId']]
+            self.assertEqual(legacy['flags'], rng.randint(10, 1000))
+            self.assertEqual(legacy['ra_decl_Cov']['raSigma'], rng.random_sample()*0.001)
+            self.assertEqual(legacy['ra_decl_Cov']['declSigma'], rng.random_sample()*0.001)
+            self.assertEqual(legacy['ra_decl_Cov']['ra_decl_Cov'], rng.random_sample()*0.001)
+            self.assertEqual(legacy['pmParallaxLnL'], rng.random_sample())
+            self.assertEqual(legacy['pmParallaxChi2'], rng.random_sample())
+            for field in ('diaObjectId', 'ra', 'decl', 'radecTai', 'pmRa', 'pmDecl',
+                          'parallax', 'pm_parallax_Cov', 'pmParallaxNdata'):
+                self.assertEqual(legacy[field], fast[field], msg=field)
+
 
 class MemoryTestClass(lsst.utils.tests.MemoryTestCase):
     pass